@@ -0,0 +1,103 @@
+"""Measure the memory a Datastore needs per loaded site.
+
+Loads synthetic csv style site rows through Datastore.add_many and reports
+the growth of the resident set size divided by the number of sites. The same
+rows are first loaded into DictSite objects, the layout of a site before the
+compact records, so the report compares both.
+
+Usage: python benchmarks/memory_benchmark.py [number_of_sites]
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from data_transformer import datastore  # noqa: E402
+
+
+def resident_bytes():
+    """Return the current resident set size of this process in bytes."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class DictSite(object):
+    """Baseline site keeping its values and data weights in two dicts."""
+
+    _mandatory_properties = {'bill_of_materials': 'Unknown',
+                             'status': 'Unknown',
+                             'data_type': 'site'}
+
+    def __init__(self):
+        self._data_weights = {}
+        self._data = DictSite._mandatory_properties.copy()
+        self._feature = None
+        self._coordinates = None
+        self._location_version = 0
+
+    def update_columns(self, values, data_weight):
+        """Merge (column_name, value) pairs loaded at one weight."""
+        data, data_weights = self._data, self._data_weights
+        for column_name, value in values:
+            if data_weight >= data_weights.get(column_name, 0):
+                data_weights[column_name] = data_weight
+                data[column_name] = value
+        self._coordinates = (float(data['longitude']),
+                             float(data['latitude']))
+        return self
+
+
+def load_dict_sites(rows, schema):
+    """Return {site id: DictSite} of the rows, like Datastore.add_many."""
+    sites = {}
+    for row in rows:
+        weight = int(row[schema.weight_index] or 0)
+        site_id = datastore.Site.normalize_id(row[schema.id_index])
+        values = [(name, row[index]) for index, name in schema.columns
+                  if row[index] != '']
+        values.extend(schema.constants)
+        sites[site_id] = sites.get(site_id, DictSite()).update_columns(
+            values, weight)
+    return sites
+
+
+def site_rows(count):
+    """Yield synthetic site rows shaped like a typical site csv file."""
+    rng = random.Random(0)
+    for index in range(count):
+        yield ['{}M{}'.format(index % 100, index),
+               '{:.8f}'.format(37.3 + rng.random() / 10),
+               '{:.8f}'.format(-121.9 + rng.random() / 10),
+               str(rng.choice([0, 10, 50])),
+               rng.choice(['CN odroid', 'DN DN odroid', 'DN']),
+               rng.choice(['planned', 'installed', 'surveyed']),
+               'S {} ST {}'.format(rng.randint(1, 20), index)]
+
+
+def main(count):
+    """Load count sites both ways and print the bytes used per site."""
+    schema = datastore.ColumnSchema(
+        ['site_id', 'latitude', 'longitude', 'data_weight',
+         'bill_of_materials', 'status', 'description'],
+        data_source='benchmark.csv', data_type='site')
+    # Both stay loaded so the second load cannot reuse memory of the first.
+    before = resident_bytes()
+    baseline = load_dict_sites(site_rows(count), schema)
+    baseline_bytes = float(resident_bytes() - before) / count
+
+    ds = datastore.Datastore()
+    before = resident_bytes()
+    ds.add_many(site_rows(count), schema)
+    compact_bytes = float(resident_bytes() - before) / count
+
+    print('{} sites'.format(ds.count_sites()))
+    print('  dict sites:    {:.0f} bytes per site'.format(baseline_bytes))
+    print('  compact sites: {:.0f} bytes per site ({:.0%} of dict sites)'
+          ''.format(compact_bytes, compact_bytes / baseline_bytes))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
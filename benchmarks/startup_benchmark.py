@@ -0,0 +1,64 @@
+"""Guard the startup cost of the command line interface.
+
+Times `python -m data_transformer --help` in fresh interpreters and checks
+that importing the command line interface loads none of the format backend
+libraries, which should only be imported once their format is used.
+
+Exits with 1 if a backend library is imported at startup or the fastest run
+is slower than the budget.
+
+Usage: python benchmarks/startup_benchmark.py [runs] [budget_seconds]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Top level packages only the format backends may import.
+BACKEND_MODULES = ('lxml', 'pykml', 'pydot', 'geojson', 'simplejson')
+
+LOADED_MODULES_SCRIPT = '''
+import sys
+sys.argv = ['data_transformer']
+import data_transformer.__main__
+print(' '.join(sorted(set(name.split('.')[0] for name in sys.modules))))
+'''
+
+
+def startup_seconds(runs):
+    """Return the fastest wall time of running the --help command."""
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(
+                [sys.executable, '-m', 'data_transformer', '--help'],
+                cwd=ROOT, stdout=devnull)
+            timings.append(time.time() - start)
+    return min(timings)
+
+
+def loaded_backends():
+    """Return the backend libraries loaded by importing the interface."""
+    output = subprocess.check_output(
+        [sys.executable, '-c', LOADED_MODULES_SCRIPT], cwd=ROOT)
+    return sorted(set(output.split()) & set(BACKEND_MODULES))
+
+
+def main(runs, budget):
+    """Print the startup time and return 1 if the guard fails."""
+    seconds = startup_seconds(runs)
+    backends = loaded_backends()
+    print('startup: {:.3f}s (best of {}, budget {:.3f}s)'.format(
+        seconds, runs, budget))
+    print('backends loaded at startup: {}'.format(
+        ', '.join(backends) or 'none'))
+    return 1 if backends or seconds > budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5,
+                  float(sys.argv[2]) if len(sys.argv) > 2 else 0.5))
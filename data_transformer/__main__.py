@@ -3,11 +3,20 @@
 Import/Export feature properties in misc formats.
 """
 
+import argparse
+import backends
 import datastore
+import fnmatch
+import graph
+import instrumentation
+import json
+import multiprocessing
 import os
 import reports
 import signal
 import sys
+import time
+from collections import OrderedDict
 
 
 def signal_handler(signal, frame):
@@ -28,22 +37,26 @@ def get_user_general_choice(prompt, default_choice, valid_options):
             print('Invalid selection.')
 
 
-import_valid_options = ['1', '2', '3']
+import_valid_options = ['1', '2', '3', '4']
 import_prompt = ('\n============IMPORT MENU================='
                  '\nLoad multiple data sets in the following ways:'
                  '\n1 => Import multiple files from a folder'
                  '\n2 => Import one specific file'
                  '\n3 => Do not load additional files'
+                 '\n4 => Load a saved snapshot'
                  '\nEnter menu choice[{}]: ')
 
-export_valid_options = ['1', '2', '3']
+export_valid_options = ['1', '2', '3', '4']
 export_prompt = ('\n============EXPORT MENU================='
                  '\nSave current data set to multiple locations/formats:'
                  '\n1 => Export data to a folder'
                  '\n2 => Change destination folder'
                  '\n3 => Do not save in additional formats/locations'
+                 '\n4 => Save a snapshot of the data set'
                  '\nEnter choice[{}]: ')
 
+DEFAULT_SNAPSHOT = 'datastore.snapshot'
+
 main_valid_options = ['1', '2', '3']
 main_prompt = ('\n============MAIN MENU================='
                '\nSelect an action to perform:'
@@ -83,7 +96,9 @@ def import_menu(datastore, folder, file_path=None, choice='1'):
             folder_prompt = 'Enter folder to import[{}]: '.format(folder)
             folder = raw_input(folder_prompt) or folder
             files_names = get_user_file_choices(os.listdir(folder))
-            datastore.import_all_files(folder, files_names)
+            datastore.import_all_files(folder, files_names,
+                                       jobs=multiprocessing.cpu_count(),
+                                       strict=False)
             break
 
         elif choice is '2':
@@ -97,7 +112,8 @@ def import_menu(datastore, folder, file_path=None, choice='1'):
                     break
                 elif os.path.isfile(file_path):
                     datastore.import_all_files(os.path.dirname(file_path),
-                                           [os.path.basename(file_path)])
+                                           [os.path.basename(file_path)],
+                                           strict=False)
                     break
                 else:
                     print('Enter legit file path')
@@ -106,6 +122,16 @@ def import_menu(datastore, folder, file_path=None, choice='1'):
         elif choice is '3':
             break
 
+        elif choice is '4':
+            snapshot_prompt = 'Enter snapshot file[{}]: '.format(
+                DEFAULT_SNAPSHOT)
+            snapshot_path = raw_input(snapshot_prompt) or DEFAULT_SNAPSHOT
+            try:
+                datastore.load_snapshot(snapshot_path)
+                break
+            except (IOError, ValueError) as error:
+                print('Unable to load snapshot: {}'.format(error))
+
 
 def export_menu(datastore, folder='exports', choice='1'):
     """Export data based on user supplied input."""
@@ -116,9 +142,18 @@ def export_menu(datastore, folder='exports', choice='1'):
                                          valid_options=export_valid_options)
         if choice is '1':
             datastore.update_all_properties()
-            reports.export_all_files(to_folder=folder,
-                                     sites=datastore.sites,
-                                     links=datastore.links)
+            try:
+                outputs = reports.export_all_files(to_folder=folder,
+                                                   sites=datastore.sites,
+                                                   links=datastore.links,
+                                                   frame=datastore.to_frame())
+            except reports.ExportError as error:
+                print(error)
+                outputs = error.written
+            recorder = instrumentation.active()
+            if recorder is not None:
+                recorder.write(os.path.join(os.path.dirname(outputs[0]),
+                                            'timings.json'))
             break
 
         if choice is '2':
@@ -129,31 +164,414 @@ def export_menu(datastore, folder='exports', choice='1'):
         if choice is '3':
             break
 
+        if choice is '4':
+            snapshot_prompt = 'Enter snapshot file[{}]: '.format(
+                DEFAULT_SNAPSHOT)
+            datastore.save_snapshot(raw_input(snapshot_prompt) or
+                                    DEFAULT_SNAPSHOT)
+            break
+
+
+EXIT_OK = 0
+EXIT_FAILURES = 1
+EXIT_USAGE = 2
+
+INPUT_PATTERNS = ['*.gv', '*.csv', '*.json', '*.geojson']
+
+
+def comma_separated(value):
+    """Split a comma separated command line value."""
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def export_formats(value):
+    """Parse --formats into a list of backends.export_formats()."""
+    formats = comma_separated(value)
+    known = backends.export_formats()
+    unknown = [f for f in formats if f not in known]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            'unknown format {}, choose from {}'.format(
+                ', '.join(unknown), ','.join(known)))
+    return formats
+
+
+def length_thresholds(value):
+    """Parse --length-thresholds into ascending floats."""
+    try:
+        thresholds = [float(t) for t in comma_separated(value)]
+    except ValueError:
+        raise argparse.ArgumentTypeError('thresholds must be numbers')
+    if not thresholds or thresholds != sorted(set(thresholds)):
+        raise argparse.ArgumentTypeError('thresholds must be ascending')
+    return thresholds
+
+
+def pop_values(value):
+    """Parse --pop-values into a list of values."""
+    values = comma_separated(value)
+    if not values:
+        raise argparse.ArgumentTypeError('at least one value is required')
+    return values
+
+
+def build_argument_parser():
+    """Return the parser of the headless command line interface."""
+    parser = argparse.ArgumentParser(
+        prog='data_transformer',
+        description='Transform deployment data without the interactive '
+                    'menu. Run without arguments for the menu.')
+    commands = parser.add_subparsers(dest='command')
+
+    build = commands.add_parser(
+        'build', help='import data files and export the design',
+        description='Import every matching data file, then write the '
+                    'reports and design layouts. Exits with 0 on success, '
+                    '1 if any file or record failed to import and 2 for '
+                    'usage errors.')
+    build.add_argument('--input', '-i', nargs='+', default=[],
+                       metavar='PATH',
+                       help='folders or files to import')
+    build.add_argument('--snapshot', metavar='PATH',
+                       help='start from a snapshot saved by a previous run')
+    build.add_argument('--save-snapshot', metavar='PATH',
+                       help='save a snapshot of the imported data to PATH')
+    build.add_argument('--database', metavar='PATH',
+                       help='keep the data set in a SQLite database at PATH '
+                            'instead of memory, for designs too large for '
+                            'RAM. Later runs add to the same database.')
+    build.add_argument('--output', '-o', default='exports', metavar='DIR',
+                       help='folder to export to [%(default)s]')
+    build.add_argument('--formats', type=export_formats,
+                       default=list(reports.EXPORT_FORMATS),
+                       help='comma separated design layout formats to '
+                            'write, any of {} [{}]'.format(
+                                ','.join(backends.export_formats()),
+                                ','.join(reports.EXPORT_FORMATS)))
+    build.add_argument('--jobs', '-j', type=int,
+                       default=multiprocessing.cpu_count(),
+                       help='worker processes parsing files [%(default)s]')
+    build.add_argument('--include', action='append', metavar='GLOB',
+                       help='only import files matching GLOB, may be '
+                            'repeated [{}]'.format(' '.join(INPUT_PATTERNS)))
+    build.add_argument('--exclude', action='append', default=[],
+                       metavar='GLOB',
+                       help='skip files matching GLOB, may be repeated')
+    build.add_argument('--dem', metavar='PATH',
+                       help='set the altitude of every site from a local '
+                            'elevation raster, a GeoTIFF or a raw grid with '
+                            'an ESRI .hdr header')
+    build.add_argument('--elevation-url', metavar='URL',
+                       help='set the altitude of every site from an online '
+                            'elevation API at URL that accepts batched '
+                            'locations like the Google elevation API')
+    build.add_argument('--elevation-cache', default='elevation_cache.txt',
+                       metavar='PATH',
+                       help='file caching the elevations looked up with '
+                            '--elevation-url between runs [%(default)s]')
+    build.add_argument('--kml-validation', default='sample',
+                       choices=('off', 'sample', 'full'),
+                       help='KML schema validation [%(default)s]')
+    build.add_argument('--length-thresholds', type=length_thresholds,
+                       default=list(reports.DEFAULT_LENGTH_THRESHOLDS),
+                       metavar='M,M',
+                       help='link length buckets of the summary in meters '
+                            '[{}]'.format(','.join(
+                                str(t) for t in
+                                reports.DEFAULT_LENGTH_THRESHOLDS)))
+    build.add_argument('--pop-column', default=graph.POP_COLUMN,
+                       metavar='NAME',
+                       help='site property marking the POP sites that hop '
+                            'counts are measured from [%(default)s]')
+    build.add_argument('--pop-values', type=pop_values,
+                       default=list(graph.POP_VALUES), metavar='VALUE,VALUE',
+                       help='values of --pop-column marking a POP, compared '
+                            'without case [{}]'.format(
+                                ','.join(graph.POP_VALUES)))
+    build.add_argument('--profile', metavar='PATH',
+                       help='profile the run with cProfile and save the '
+                            'statistics to PATH for the pstats module')
+    build.add_argument('--summary', metavar='PATH',
+                       help='write the JSON run summary to PATH, - for '
+                            'stdout [build_summary.json in the export '
+                            'folder]')
+    build.set_defaults(run=build_command)
+
+    plan = commands.add_parser(
+        'plan', help='list candidate links between nearby sites',
+        description='Import every matching data file and write a .gv file '
+                    'with a candidate link between every pair of sites in '
+                    'a distance band that is not linked yet. The file can be '
+                    'imported like any other .gv file.')
+    plan.add_argument('--input', '-i', nargs='+', required=True,
+                      metavar='PATH', help='folders or files to import')
+    plan.add_argument('--output', '-o', default='candidate_links.gv',
+                      metavar='PATH',
+                      help='.gv file to write, - for stdout [%(default)s]')
+    plan.add_argument('--min-distance', type=float, default=20.0,
+                      metavar='M',
+                      help='shortest candidate link in meters [%(default)s]')
+    plan.add_argument('--max-distance', type=float, default=250.0,
+                      metavar='M',
+                      help='longest candidate link in meters [%(default)s]')
+    plan.add_argument('--bill-of-materials', action='append', metavar='BOM',
+                      help='only link sites with this bill_of_materials, '
+                           'may be repeated')
+    plan.add_argument('--status', action='append',
+                      help='only link sites with this status, may be '
+                           'repeated')
+    plan.add_argument('--jobs', '-j', type=int,
+                      default=multiprocessing.cpu_count(),
+                      help='worker processes parsing files [%(default)s]')
+    plan.add_argument('--include', action='append', metavar='GLOB',
+                      help='only import files matching GLOB, may be '
+                           'repeated [{}]'.format(' '.join(INPUT_PATTERNS)))
+    plan.add_argument('--exclude', action='append', default=[],
+                      metavar='GLOB',
+                      help='skip files matching GLOB, may be repeated')
+    plan.set_defaults(run=plan_command)
+    return parser
+
+
+def find_input_files(inputs, include=None, exclude=()):
+    """Return the files of the input folders and files matching the globs.
+
+    Globs are matched against both the file name and the path.
+    :raises IOError: if an input does not exist
+    """
+    def matches(path, patterns):
+        return any(fnmatch.fnmatch(os.path.basename(path), pattern) or
+                   fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, f)
+                         for f in sorted(os.listdir(path))
+                         if os.path.isfile(os.path.join(path, f)))
+        elif os.path.isfile(path):
+            paths.append(path)
+        else:
+            raise IOError('Input {} does not exist'.format(path))
+
+    return [path for path in paths
+            if matches(path, include or INPUT_PATTERNS) and
+            not matches(path, exclude)]
+
+
+def build_command(args):
+    """Run an import and export without prompts and return the exit code.
+
+    With --summary - the progress messages go to stderr, so stdout only holds
+    the JSON run summary.
+    """
+    stdout = sys.stdout
+    if args.summary == '-':
+        sys.stdout = sys.stderr
+    try:
+        return run_build(args, stdout)
+    finally:
+        sys.stdout = stdout
+
+
+def run_build(args, stdout):
+    """Run a build, see build_command.
+
+    :param stdout: stream the JSON run summary is written to for --summary -
+    """
+    summary = OrderedDict([('command', 'build'), ('status', 'failed')])
+    start = time.time()
+
+    if not args.input and not args.snapshot:
+        sys.stderr.write('data_transformer: --input or --snapshot is '
+                         'required\n')
+        return EXIT_USAGE
+    try:
+        paths = find_input_files(args.input, args.include, args.exclude)
+    except IOError as error:
+        sys.stderr.write('data_transformer: {}\n'.format(error))
+        return EXIT_USAGE
+    if args.input and not paths:
+        sys.stderr.write('data_transformer: no input files matched\n')
+        return EXIT_USAGE
+
+    if args.database and (args.snapshot or args.save_snapshot):
+        sys.stderr.write('data_transformer: snapshots cannot be used with '
+                         '--database\n')
+        return EXIT_USAGE
+
+    if args.dem and args.elevation_url:
+        sys.stderr.write('data_transformer: --dem and --elevation-url cannot '
+                         'be combined\n')
+        return EXIT_USAGE
+
+    elevations = None
+    if args.dem:
+        import elevation  # Only needed for altitudes.
+        try:
+            elevations = elevation.open_dem(args.dem)
+        except (IOError, KeyError, ValueError) as error:
+            sys.stderr.write('data_transformer: unable to read DEM {}: {}\n'
+                             ''.format(args.dem, error))
+            return EXIT_USAGE
+    elif args.elevation_url:
+        import elevation  # Only needed for altitudes.
+        elevations = elevation.ElevationClient(
+            base_url=args.elevation_url, cache_path=args.elevation_cache)
+
+    recorder = instrumentation.Recorder()
+    with instrumentation.recording(recorder, profile_path=args.profile):
+        if args.database:
+            import sqlite_datastore  # Only needed for --database.
+            ds = sqlite_datastore.SQLiteDatastore(args.database)
+        else:
+            ds = datastore.Datastore()
+        if args.snapshot:
+            with instrumentation.stage('load_snapshot'):
+                try:
+                    ds.load_snapshot(args.snapshot)
+                except (IOError, ValueError) as error:
+                    sys.stderr.write('data_transformer: {}\n'.format(error))
+                    return EXIT_FAILURES
+        with instrumentation.stage('import'):
+            imports = ds.import_all_files('', paths, jobs=max(args.jobs, 1),
+                                          strict=False)
+        if args.save_snapshot:
+            with instrumentation.stage('save_snapshot'):
+                ds.save_snapshot(args.save_snapshot)
+        if elevations is not None:
+            with instrumentation.stage('altitudes'):
+                ds.add_altitudes(elevations)
+        ds.update_all_properties(pop_column=args.pop_column,
+                                 pop_values=args.pop_values)
+        with instrumentation.stage('export'):
+            try:
+                outputs = reports.export_all_files(
+                    to_folder=args.output, sites=ds.sites, links=ds.links,
+                    frame=ds.to_frame(), kml_validation=args.kml_validation,
+                    length_thresholds=args.length_thresholds,
+                    formats=args.formats, ordered=bool(args.database),
+                    pop_column=args.pop_column, pop_values=args.pop_values)
+                invalid_outputs = []
+            except reports.ExportError as error:
+                sys.stderr.write('data_transformer: {}\n'.format(error))
+                outputs, invalid_outputs = error.written, error.file_names
+    # The run summary holds the seconds of the stages of timings.json.
+    timings = recorder.stage_seconds()
+    timings['total'] = round(time.time() - start, 3)
+
+    failed_files = [path for path, loads in imports.items()
+                    if 'error' in loads]
+    rejected = sum(loads.get('rejected', 0) for loads in imports.values())
+    exit_code = (EXIT_FAILURES if failed_files or rejected or invalid_outputs
+                 else EXIT_OK)
+
+    summary['status'] = 'ok' if exit_code == EXIT_OK else 'failed'
+    summary['exit_code'] = exit_code
+    summary['inputs'] = imports
+    summary['counts'] = OrderedDict([('files', len(paths)),
+                                     ('failed_files', len(failed_files)),
+                                     ('rejected_records', rejected),
+                                     ('sites', ds.count_sites()),
+                                     ('links', ds.count_links()),
+                                     ('invalid_outputs',
+                                      len(invalid_outputs))])
+    timings_path = os.path.join(os.path.dirname(outputs[0]), 'timings.json')
+    recorder.write(timings_path)
+    summary['outputs'] = outputs + [timings_path]
+    if args.profile:
+        summary['profile'] = args.profile
+    summary['timings'] = timings
+    if args.database:
+        ds.close()
+
+    text = json.dumps(summary, indent=4, separators=(',', ': '))
+    if args.summary == '-':
+        stdout.write(text + '\n')
+    else:
+        summary_path = args.summary or os.path.join(
+            os.path.dirname(outputs[0]), 'build_summary.json')
+        with open(summary_path, 'w') as f:
+            f.write(text + '\n')
+        print('Run summary written to {}'.format(summary_path))
+
+    return exit_code
+
+
+def plan_command(args):
+    """Write the candidate links of the input files and return the exit
+    code."""
+    if not 0 <= args.min_distance <= args.max_distance:
+        sys.stderr.write('data_transformer: the distance band must satisfy '
+                         '0 <= --min-distance <= --max-distance\n')
+        return EXIT_USAGE
+    try:
+        paths = find_input_files(args.input, args.include, args.exclude)
+    except IOError as error:
+        sys.stderr.write('data_transformer: {}\n'.format(error))
+        return EXIT_USAGE
+    if not paths:
+        sys.stderr.write('data_transformer: no input files matched\n')
+        return EXIT_USAGE
+
+    ds = datastore.Datastore()
+    imports = ds.import_all_files('', paths, jobs=max(args.jobs, 1),
+                                  strict=False)
+    links = ds.candidate_links(min_distance=args.min_distance,
+                               max_distance=args.max_distance,
+                               bill_of_materials=args.bill_of_materials,
+                               status=args.status)
+    features = [link.as_geojson() for link in links]
+    if args.output == '-':
+        reports.write_gv(sys.stdout, [], features,
+                         graph_name='candidate_links')
+    else:
+        with open(args.output, 'w') as f:
+            reports.write_gv(f, [], features, graph_name='candidate_links')
+        print('{} candidate links written to {}'.format(len(links),
+                                                        args.output))
+
+    if any('error' in loads or loads.get('rejected')
+           for loads in imports.values()):
+        return EXIT_FAILURES
+    return EXIT_OK
+
+
+def main(argv=None):
+    """Main function for direct execution.
+
+    Command line arguments run the headless interface, see
+    build_argument_parser. Without arguments the interactive menu is shown.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        args = build_argument_parser().parse_args(argv)
+        sys.exit(args.run(args))
 
-def main():
-    """Main function for direct execution."""
     choice = '1'
     ds = datastore.Datastore()
-    while True:
-        choice = get_user_general_choice(prompt=main_prompt,
-                                         default_choice=choice,
-                                         valid_options=main_valid_options)
+    # Exports write the timings of the whole session next to summary.txt.
+    with instrumentation.recording():
+        while True:
+            choice = get_user_general_choice(prompt=main_prompt,
+                                             default_choice=choice,
+                                             valid_options=main_valid_options)
 
-        if choice is '1':
-            import_menu(datastore=ds, folder=os.getcwd())
-            choice = '2'
+            if choice is '1':
+                import_menu(datastore=ds, folder=os.getcwd())
+                choice = '2'
 
-        elif choice is '2':
-            export_menu(datastore=ds)
-            choice = '3'
+            elif choice is '2':
+                export_menu(datastore=ds)
+                choice = '3'
 
-        elif choice is '3':
-            sys.exit(0)
+            elif choice is '3':
+                sys.exit(0)
 
-        else:
-            print('Invalid choice')
+            else:
+                print('Invalid choice')
 
-        print('\n' * 1)
+            print('\n' * 1)
 
 
 if __name__ == '__main__':
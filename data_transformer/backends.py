@@ -0,0 +1,119 @@
+"""Registry of the file format backends.
+
+Readers parse a data file into record batches for Datastore.load_batches and
+writers export features to a design layout file. Both are registered by file
+extension as 'module:function' names and the module is only imported the
+first time its format is used, so runs that never touch a format never pay
+for importing its parsing or serialization libraries.
+
+Every writer is called as write(file_obj, sites, links, **options) with
+geojson.Features of the sites and links. reports.export_all_files passes the
+options ordered, see reports.write_geojson, and validation, see
+kml_writer.write_kml. Writers ignore the options they do not use.
+"""
+
+_READERS = {}
+_WRITERS = {}
+_EXPORT_FILES = {}
+_loaded = {}
+
+
+def register_reader(extension, target):
+    """Register the reader of a file extension.
+
+    :param extension: file extension including the dot, such as '.csv'
+    :type extension: str
+    :param target: 'module:function' of a function taking a file path and
+        returning (ColumnSchema, rows) batches
+    :type target: str
+    """
+    _READERS[extension] = target
+
+
+def register_writer(extension, target, file_name=None, all_sites=False):
+    """Register the writer of a file extension.
+
+    :param extension: file extension including the dot, such as '.kml'
+    :type extension: str
+    :param target: 'module:function' of the writer
+    :type target: str
+    :param file_name: name of the file export_all_files writes with it, None
+        if the format is not an export format
+    :type file_name: str
+    :param all_sites: the writer gets every site instead of only the sites
+        with a link
+    :type all_sites: bool
+    """
+    _WRITERS[extension] = target
+    if file_name is not None:
+        _EXPORT_FILES[extension] = (file_name, all_sites)
+
+
+def reader_extensions():
+    """Return the file extensions that have a reader."""
+    return sorted(_READERS)
+
+
+def export_formats():
+    """Return the formats export_all_files can write, such as 'kml'."""
+    return sorted(extension[1:] for extension in _EXPORT_FILES)
+
+
+def export_file(export_format):
+    """Return the (file name, all_sites) an export format is written as.
+
+    :raises ValueError: if the format is not an export format
+    """
+    try:
+        return _EXPORT_FILES['.' + export_format]
+    except KeyError:
+        raise ValueError('Unknown export format {}'.format(export_format))
+
+
+def has_reader(extension):
+    """Return True if files with the extension can be imported."""
+    return extension in _READERS
+
+
+def get_reader(extension):
+    """Return the reader of a file extension, importing it if needed.
+
+    :raises ValueError: if no reader is registered for the extension
+    """
+    return _load(_READERS, extension, 'reader')
+
+
+def get_writer(extension):
+    """Return the writer of a file extension, importing it if needed.
+
+    :raises ValueError: if no writer is registered for the extension
+    """
+    return _load(_WRITERS, extension, 'writer')
+
+
+def _load(registry, extension, kind):
+    """Import and return the function registered for an extension."""
+    target = registry.get(extension)
+    if target is None:
+        raise ValueError('No {} is registered for {} files'.format(
+            kind, extension))
+    function = _loaded.get(target)
+    if function is None:
+        module_name, function_name = target.split(':')
+        # Imported like an import statement in this package would be.
+        module = __import__(module_name, globals(), {}, [function_name])
+        function = _loaded[target] = getattr(module, function_name)
+    return function
+
+
+register_reader('.csv', 'datastore:read_csv_file')
+register_reader('.gv', 'datastore:read_gv_file')
+register_reader('.json', 'datastore:read_geojson_file')
+register_reader('.geojson', 'datastore:read_geojson_file')
+
+register_writer('.geojson', 'reports:write_geojson',
+                file_name='design_layout.geojson')
+register_writer('.csv', 'reports:write_sites_csv',
+                file_name='aggregated_site_data.csv', all_sites=True)
+register_writer('.kml', 'kml_writer:write_kml', file_name='design_layout.kml')
+register_writer('.gv', 'reports:write_gv', file_name='design_layout.gv')
@@ -4,49 +4,348 @@ Working data storage.
 Load and export serialized data in text documents from python objects and vic
 versa. Also provides helper functions to manage Feature objects.
 """
+import array
+import backends
 import csv
-import geojson
+from frame import Frame
+import gc
+import graph
+import hashlib
+import instrumentation
+import gv_reader
+import itertools
+import marshal
 import utilities
+import multiprocessing
 import os
-import pydot
+import struct
+import sys
+import time
+import zlib
+from collections import defaultdict, OrderedDict
 
 
-class Datastore(dict):
+def normalize_column_name(column_name):
+    """Normalize an input data field name."""
+    return _intern(column_name.lower().replace(' ', '_').strip())
+
+
+class ColumnSchema(object):
+    """Column layout of an input file, compiled once for bulk loading.
+
+    Rows loaded with a schema are plain sequences of values in the order of
+    the column names. Constant columns, such as the data_source of a file,
+    are applied to every row.
+    """
+
+    def __init__(self, column_names, **constants):
+        """Initilize the ColumnSchema from the header of a file.
+
+        :param column_names: raw column names in file order
+        :type column_names: list of str
+        :param constants: column name => value applied to every row
+        """
+        self.column_names = list(column_names)
+        self.columns = [(index, normalize_column_name(name))
+                        for index, name in enumerate(self.column_names)
+                        if name is not None]
+        self.constants = [(normalize_column_name(name), value)
+                          for name, value in sorted(constants.items())]
+        self.data_type = constants.get('data_type', 'site')
+
+        indexes = dict((name, index) for index, name in self.columns)
+        self.weight_index = indexes.get('data_weight')
+        self.id_index = indexes.get('site_id', indexes.get('id'))
+
+    def as_dict(self, row):
+        """Return a row as the raw_data dict accepted by Datastore.add."""
+        raw_data = dict((self.column_names[index], row[index])
+                        for index, _ in self.columns if index < len(row))
+        raw_data.update(self.constants)
+        return raw_data
+
+
+class FileLoader(object):
+    """Load parsed files through the add and add_many methods of a store."""
+
+    def load_batches(self, file_name, batches):
+        """Merge the record batches parsed from one file.
+
+        :param file_name: name of the file the batches were read from
+        :type file_name: str
+        :param batches: (ColumnSchema, rows) pairs as returned by read_file.
+            A batch without a schema holds raw_data dicts for add().
+        :type batches: list
+        :returns: OrderedDict of data_type => records loaded, with the number
+            of records that could not be added under 'rejected'
+        """
+        with instrumentation.stage('load', file=file_name) as stage:
+            loads = self._load_batches(file_name, batches)
+            stage.rows = sum(loads.values())
+        return loads
+
+    def _load_batches(self, file_name, batches):
+        """Merge the record batches parsed from one file, see load_batches.
+        """
+        loads = OrderedDict()
+        rejected = 0
+        for schema, rows in batches:
+            if schema is None:
+                batch_loads = OrderedDict()
+                for raw_data in rows:
+                    data_type = raw_data.get('data_type') or 'site'
+                    loaded = self.add(raw_data)
+                    batch_loads[data_type] = (batch_loads.get(data_type, 0) +
+                                              loaded)
+                    rejected += 1 - loaded
+            else:
+                counter = itertools.count()
+                # izip draws from rows first, so counter ends at the number of
+                # rows once rows are exhausted.
+                added = self.add_many(
+                    (row for row, _ in itertools.izip(rows, counter)), schema)
+                batch_loads = OrderedDict([(schema.data_type, added)])
+                rejected += next(counter) - added
+            for data_type, count in batch_loads.items():
+                print('  Loaded {} {}s from {}'.format(count, data_type,
+                                                       file_name))
+                loads[data_type] = loads.get(data_type, 0) + count
+        loads['rejected'] = rejected
+        return loads
+
+    def load_geojson_file(self, file_path):
+        """Load a FeatureCollection from a single geojson document."""
+        return self.load_batches(os.path.basename(file_path),
+                                 read_geojson_file(file_path))
+
+    def load_csv_file(self, file_path):
+        """Load features from single csv document."""
+        file_name = os.path.basename(file_path)
+        with open(file_path, 'r') as f:
+            reader = csv.reader(f)
+            schema = ColumnSchema(next(reader, []), data_source=file_name,
+                                  data_type='site')
+            return self.load_batches(file_name, [(schema, reader)])
+
+    def load_gv_file(self, file_path):
+        """Load features from single gv document.
+
+        Records are added as they are parsed, so the file is never held in
+        memory as a whole.
+        """
+        return self.load_batches(os.path.basename(file_path),
+                                 [(None, iter_gv_records(file_path))])
+
+
+class Datastore(FileLoader, dict):
     """
     Manage data from local files and online files in a pythonic way.
 
     The Datastore class manages deployment data and exposes the data in
-    native python objects thatgeojson. The class could be extended to
-    support database repositories.
+    native python objects thatgeojson. Designs too large for memory can be
+    kept in a database with sqlite_datastore.SQLiteDatastore.
 
     """
 
+    _indexed_properties = ('data_source', 'status')
+
     def __init__(self):
         """Initilize the the Datastore class."""
         super(Datastore, self).__init__()
+        self._sites = {}
+        self._links = {}
+        self._indexes = {name: defaultdict(set)
+                         for name in Datastore._indexed_properties}
+        self._indexed_values = {}
+        self._adjacency = {}
+        self._imports = OrderedDict()
+        self._contributions = {}
+        self._source = None
+
+    def __setitem__(self, key, value):
+        """Store an object and keep the type and property indexes current.
+
+        An object replaced by another object is released, see __delitem__.
+        """
+        values = tuple([value.get(name)
+                        for name in Datastore._indexed_properties])
+        if key in self:
+            current = dict.__getitem__(self, key)
+            if current is value and self._indexed_values[key] == values:
+                return
+            self._unindex(key)
+            if current is not value and isinstance(current, _Record):
+                current.release()
+        super(Datastore, self).__setitem__(key, value)
+
+        if isinstance(value, Site):
+            self._sites[key] = value
+            self._index(key, values)
+        elif isinstance(value, Link):
+            self._links[key] = value
+            self._index(key, values, (value._source_site.id,
+                                      value._destination_site.id))
+        else:
+            self._index(key, values)
+
+    def _index(self, key, values, endpoint_ids=()):
+        """Add a stored key to the property and adjacency indexes.
+
+        :param values: values of the _indexed_properties of the object
+        :param endpoint_ids: site ids a link connects
+        """
+        for site_id in endpoint_ids:
+            self._adjacency.setdefault(site_id, set()).add(key)
+        for name, property_value in zip(Datastore._indexed_properties, values):
+            self._indexes[name][property_value].add(key)
+        self._indexed_values[key] = values
+
+    def __delitem__(self, key):
+        """Remove an object, drop it from every index and release it.
+
+        The weight slot of a released Site or Link goes to the next new
+        object, see _Record.release. Use pop to keep using the object.
+        """
+        value = self.pop(key)
+        if isinstance(value, _Record):
+            value.release()
+
+    def _unindex(self, key):
+        """Remove a key from the type and property indexes."""
+        self._sites.pop(key, None)
+        link = self._links.pop(key, None)
+        if link is not None:
+            for site_id in (link._source_site.id, link._destination_site.id):
+                link_ids = self._adjacency.get(site_id, set())
+                link_ids.discard(key)
+                if not link_ids:
+                    self._adjacency.pop(site_id, None)
+        values = self._indexed_values.pop(key, ())
+        for name, property_value in zip(Datastore._indexed_properties, values):
+            keys = self._indexes[name][property_value]
+            keys.discard(key)
+            if not keys:
+                del self._indexes[name][property_value]
+
+    # The dict methods below would bypass __setitem__ and __delitem__, so they
+    # are routed through them to keep the indexes current.
+
+    def update(self, *args, **kwargs):
+        """Store every object of a dict or (key, object) pairs."""
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        """Return the object of a key, storing default first if missing."""
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        """Remove an object and return it, or default if given and missing.
+
+        The object is not released and can be stored again.
+        """
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = dict.__getitem__(self, key)
+        self._unindex(key)
+        super(Datastore, self).__delitem__(key)
+        return value
+
+    def popitem(self):
+        """Remove and return any (key, object) pair."""
+        if not self:
+            raise KeyError('popitem(): datastore is empty')
+        key = next(self.iterkeys())
+        return key, self.pop(key)
+
+    def clear(self):
+        """Remove and release every object and empty the indexes."""
+        for value in self.itervalues():
+            if isinstance(value, _Record):
+                value.release()
+        super(Datastore, self).clear()
+        self._sites.clear()
+        self._links.clear()
+        for index in self._indexes.values():
+            index.clear()
+        self._indexed_values.clear()
+        self._adjacency.clear()
 
     @property
     def sites(self):
-        """Return all sites in the datastore."""
-        return [f for f in self.values() if isinstance(f, Site)]
+        """Return a live view of all sites in the datastore."""
+        return self._sites.viewvalues()
 
     @property
     def links(self):
-        """Return all links in the datastore."""
-        return [f for f in self.values() if isinstance(f, Link)]
+        """Return a live view of all links in the datastore."""
+        return self._links.viewvalues()
 
     @property
     def all(self):
-        """Return all sites and links in the datastore."""
-        return [f for f in self.values()]
+        """Return a live view of all sites and links in the datastore."""
+        return self.viewvalues()
+
+    def count_sites(self):
+        """Return the number of sites in the datastore."""
+        return len(self._sites)
+
+    def count_links(self):
+        """Return the number of links in the datastore."""
+        return len(self._links)
+
+    def lookup(self, property_name, value):
+        """Return all sites and links with an indexed property value.
+
+        :param property_name: 'data_source' or 'status'
+        :type property_name: str
+        :param value: property value to match exactly
+        :returns: list of Site and Link objects ordered by id
+        """
+        keys = self._indexes[property_name].get(value, ())
+        return [self[key] for key in sorted(keys)]
+
+    @property
+    def adjacencies(self):
+        """Return the live adjacency index of site id => set of link ids.
+
+        The index is maintained as links are stored and must not be modified
+        by callers.
+        """
+        return self._adjacency
+
+    @property
+    def imports(self):
+        """Return the manifest of every file imported into the datastore.
+
+        Maps the absolute file path to its size, modification time, sha1
+        content hash and load counts, including the imports of a loaded
+        snapshot. Files are listed in import order.
+        """
+        return self._imports
+
+    def _contribute(self, key, weight, values):
+        """Record the values a row of the file being imported gave an object.
+
+        :param values: normalized (column_name, value) pairs
+        :type values: list
+        """
+        if self._source is not None:
+            self._source.add(key, weight, values)
 
     @property
     def all_connected(self):
         """Return only sites and links in the datastore that are associated."""
-        adjacencies = utilities.get_adjacencies(
-            edges=[l.as_geojson() for l in self.links],
-            nodes=[s.as_geojson() for s in self.sites])
-        return [s for s in self.sites if s.id in adjacencies]
+        return [site for site_id, site in self._sites.iteritems()
+                if site_id in self._adjacency]
+
+    def connected_links(self, site_id):
+        """Return the ordered ids of all links attached to a site."""
+        return sorted(self._adjacency.get(site_id, ()))
 
     def add(self, raw_data):
         """Validate and add raw_data to the Datastore set.
@@ -58,11 +357,15 @@ class Datastore(dict):
         :type raw_data: a dict of keys
         :returns: 1 if successful and 0 if unsuccessful
         """
-        if raw_data['data_type'] == 'site':
-            site = self.get(raw_data.get('site_id', 'unknown').upper(), Site())
-            self[site.id] = site.update_raw_data(raw_data)
+        values, weight = _Record.parse_raw_data(raw_data)
+        if raw_data.get('data_type') == 'site':
+            site = self.get(raw_data.get('site_id', 'unknown').upper())
+            if site is None:
+                site = Site()
+            self[site.id] = site.update_columns(values, weight)
+            self._contribute(site.id, weight, values)
             return 1
-        elif raw_data['data_type'] is 'link':
+        elif raw_data.get('data_type') == 'link':
             # TODO: Implement better handeling of weighted link data.
             try:
                 source_site = self[Site.normalize_id(raw_data['source_id'])]
@@ -80,110 +383,1221 @@ class Datastore(dict):
 
             link = Link(source_site=source_site,
                         destination_site=destination_site)
-            self[link.id] = link.update_raw_data(raw_data)
+            self[link.id] = link.update_columns(values, weight)
+            self._contribute(link.id, weight, values)
             return 1
         return 0
 
-    def update_all_properties(self):
-        """Traverse the DataStore and add/update properties."""
-        adjacencies = utilities.get_adjacencies(
-            edges=[l.as_geojson() for l in self.links],
-            nodes=[s.as_geojson() for s in self.sites])
+    def add_many(self, rows, schema):
+        """Validate and add many rows sharing one ColumnSchema.
+
+        This is the bulk form of add(). Column names are normalized once by
+        the schema and each row's data_weight is parsed once before its values
+        are merged. Rows without a site_id are rejected. Rows that are not
+        sites are passed on to add().
+        :param rows: value sequences ordered like schema.column_names
+        :type rows: iterable
+        :param schema: compiled layout of the rows
+        :type schema: ColumnSchema
+        :returns: number of rows successfully added
+        """
+        if schema.data_type != 'site':
+            return sum(self.add(schema.as_dict(row)) for row in rows)
+
+        loads = 0
+        columns, constants = schema.columns, schema.constants
+        weight_index, id_index = schema.weight_index, schema.id_index
+        for row in rows:
+            width = len(row)
+            site_id = row_site_id(row, id_index)
+            if not site_id:
+                continue
+            try:
+                weight = (int(row[weight_index]) if weight_index is not None
+                          and weight_index < width and row[weight_index]
+                          else 0)
+            except ValueError:
+                print('  Weight Error: {} is not an integer data_weight'
+                      ''.format(row[weight_index]))
+                continue
+
+            site = self.get(site_id) or Site()
+
+            values = [(name, row[index]) for index, name in columns
+                      if index < width and row[index] not in ('', None)]
+            values.extend(constants)
+            site.update_columns(values, weight)
+            self[site.id] = site
+            if self._source is not None:
+                self._source.add_row(site.id, weight, schema, row)
+            loads += 1
+
+        return loads
+
+    @instrumentation.measured('update_all_properties')
+    def update_all_properties(self, pop_column=graph.POP_COLUMN,
+                              pop_values=graph.POP_VALUES):
+        """Traverse the DataStore and add/update properties.
+
+        Connected sites also get the properties of graph.site_properties,
+        with hop counts measured from the sites whose pop_column holds one
+        of pop_values. Graph properties of an earlier run are dropped first.
+        """
+        for site in self._sites.itervalues():
+            site.drop_columns(graph.SITE_PROPERTIES)
+
+        design = self.to_graph()
+        pops = [graph.is_pop(self._sites[site_id].get(pop_column), pop_values)
+                for site_id in design.node_ids]
+        graph_properties = graph.site_properties(design, pops)
 
         for site in self.all_connected:
-            updates = {'connected_links': ', '.join(adjacencies[site.id])}
+            updates = {'connected_links': ', '.join(
+                self.connected_links(site.id))}
+            updates.update(graph_properties.get(site.id, {}))
             self[site.id] = site.update_raw_data(updates)
 
-        for link in self.links:
-            try:
-                coords1, coords2 = link.as_geojson().geometry.coordinates
-            except:
-                coords1, coords2 = '0.0,0.0', '0.0,0.0'
+        links = list(self._links.itervalues())
+        lengths = utilities.distances(
+            [(link._source_site.latitude, link._source_site.longitude)
+             for link in links],
+            [(link._destination_site.latitude,
+              link._destination_site.longitude) for link in links])
+        geometry = link_geometry([link._source_site for link in links],
+                                 [link._destination_site for link in links])
 
-            updates = {'link_id': link.id,
-                       'length': utilities.distance(coords1, coords2)}
+        for link, length, pointing in zip(links, lengths.tolist(), geometry):
+            updates = {'link_id': link.id, 'length': length}
+            updates.update(pointing)
             self[link.id] = link.update_raw_data(updates)
 
-    def load_geojson_file(self, file_path):
-        """Load a FeatureCollection from a single geojson document."""
-        loads = 0
-        file_name = os.path.basename(file_path)
-        with open(file_path, 'r') as f:
-            features1 = geojson.loads(f.read())
-            if geojson.is_valid(features1)['valid'] == 'yes':
-                for feature in features1:
-                    loads += self.add(feature)
-        print('  Loaded {} sites from {}'.format(loads, file_name))
-        print('  Failed to load json file. Def not complete.')
+    def add_altitudes(self, provider, offset=0.0):
+        """Set the altitude of every site from an elevation provider.
 
-    def load_csv_file(self, file_path):
-        """Load features from single csv document."""
-        loads = 0
-        file_name = os.path.basename(file_path)
-        with open(file_path, 'r') as f:
-            reader = csv.DictReader(f)
-            for row_data in reader:
-                row_data['data_source'] = file_name
-                row_data['data_type'] = 'site'
-                loads += self.add(row_data)
+        All sites are looked up in one vectorized call and the altitude is
+        loaded with a data_weight of 0, rounded to 0.1m like
+        utilities.get_altitude. Sites the provider has no elevation for are
+        left unchanged.
+        :param provider: source of the elevations
+        :type provider: elevation.ElevationProvider
+        :param offset: meters added to every elevation
+        :type offset: float
+        :returns: number of sites given an altitude
+        """
+        sites = list(self._sites.itervalues())
+        altitudes = provider.elevations([site.latitude for site in sites],
+                                        [site.longitude for site in sites])
+        updated = 0
+        for site, altitude in zip(sites, (altitudes + offset).round(1)):
+            if altitude != altitude:  # NaN, no elevation data.
+                continue
+            site.update_columns([('altitude', altitude.item())], 0)
+            self[site.id] = site
+            updated += 1
+        return updated
 
-        print('  Loaded {} sites from {}'.format(loads, file_name))
+    def candidate_links(self, min_distance=20.0, max_distance=250.0,
+                        bill_of_materials=None, status=None):
+        """Return a candidate link for every pair of sites in a distance band.
 
-    def load_gv_file(self, file_path):
-        """Load features from single gv document."""
-        edge_loads = 0
-        node_loads = 0
-        try:
-            graphs = pydot.graph_from_dot_file(file_path)
-        except:
-            print('  Error: Unable to interpret .gv file. Please review.')
+        Pairs are found with a spatial grid, see utilities.pairs_within, so
+        the planner scales to city sized site lists. Pairs that are already
+        linked are skipped. Filters accept one value or a collection of
+        values the property of both sites must equal.
+        :param min_distance: minimum link length in meters
+        :type min_distance: float
+        :param max_distance: maximum link length in meters
+        :type max_distance: float
+        :param bill_of_materials: only plan links between these values
+        :param status: only plan links between sites with this status
+        :returns: list of new Link objects with the status 'candidate' and
+            their length, ordered by id. They are not added to the
+            datastore, see reports.write_gv to save them. Each link holds a
+            weight slot until it is released, see _Record.release.
+        """
+        def accepted(value, allowed):
+            if allowed is None:
+                return True
+            if isinstance(allowed, basestring):
+                return value == allowed
+            return value in allowed
 
-        graph = graphs[0]  # TODO: Implement multiple graphs in one file.
-        file_name = os.path.basename(file_path)
-        for node in graph.get_node_list():
-            node_loads += 1
-            # TODO: Implement passing site info via graphvis format.
+        locations = [(site_id, site.latitude, site.longitude)
+                     for site_id, site in sorted(self._sites.iteritems())
+                     if accepted(site.get('bill_of_materials'),
+                                 bill_of_materials) and
+                     accepted(site.get('status'), status)]
 
-        for edge in graph.get_edge_list():
-            data = {
+        links = []
+        for source_id, destination_id, length in utilities.pairs_within(
+                locations, min_distance, max_distance):
+            link = Link(self._sites[source_id], self._sites[destination_id])
+            if link.id in self._links:
+                link.release()
+                continue
+            links.append(link.update_raw_data({
                 'data_type': 'link',
-                'data_source': file_name,
-                'source_id': Site.normalize_id(edge.get_source()),
-                'destination_id': Site.normalize_id(edge.get_destination())}
+                'status': 'candidate',
+                'source_id': link._source_site.id,
+                'destination_id': link._destination_site.id,
+                'length': length}))
+        return sorted(links, key=lambda link: link.id)
+
+    def to_frame(self):
+        """Return a columnar Frame snapshot of all sites and links.
+
+        Rows are ordered by id. The Frame is a copy and does not follow later
+        changes to the datastore.
+        """
+        def link_row(link_id, link):
+            """Return a link as a Frame row with the properties it exports."""
+            source_id = link._source_site.id
+            destination_id = link._destination_site.id
+            properties = [(k, v) for k, v in link.items()
+                          if k not in ('longitude', 'latitude', 'source_id',
+                                       'destination_id')]
+            properties.extend([('source_id', source_id),
+                               ('destination_id', destination_id)])
+            return link_id, source_id, destination_id, properties
 
-            edge_loads += self.add(data)
-        print('  Loaded {} links from {}'.format(edge_loads, file_name))
+        return Frame.build(
+            sites=[(site_id, site.latitude, site.longitude, site.items())
+                   for site_id, site in sorted(self._sites.iteritems())],
+            links=[link_row(link_id, link)
+                   for link_id, link in sorted(self._links.iteritems())])
 
-    def import_all_files(self, folder, files_names):
-        """Wrapper function to import all provided files."""
+    def to_graph(self):
+        """Return a graph.Graph of all sites and links, rows ordered by id."""
+        site_ids = sorted(self._sites)
+        rows = {site_id: row for row, site_id in enumerate(site_ids)}
+        links = list(self._links.itervalues())
+        return graph.Graph.build(
+            site_ids,
+            [rows.get(link._source_site.id, -1) for link in links],
+            [rows.get(link._destination_site.id, -1) for link in links])
+
+    def merge_close_sites(self, radius=1.0):
+        """Merge every cluster of sites within radius meters into one Site.
+
+        The site loaded with the highest data_weight in each cluster survives
+        and keeps its id. Values of the other sites only replace its values
+        where they were loaded with a higher weight. Links to merged sites are
+        moved to the survivor, with source_id and destination_id set to the
+        sites they now connect, and links between two merged sites are
+        dropped.
+        :param radius: maximum distance in meters between clustered sites
+        :type radius: float
+        :returns: list of merged site id tuples with the survivor first
+        """
+        clusters = utilities.cluster_locations(
+            [(site_id, site.latitude, site.longitude)
+             for site_id, site in self._sites.iteritems()], radius=radius)
+
+        merged = []
+        for cluster in clusters:
+            sites = sorted((self[site_id] for site_id in cluster),
+                           key=lambda s: (-s.weight('data_weight'), s.id))
+            survivor, others = sites[0], sites[1:]
+            other_ids = [site.id for site in others]
+
+            for site in others:
+                survivor.merge(site)
+                for link_id in self.connected_links(site.id):
+                    link = self.pop(link_id)
+                    ends = [survivor if end.id in cluster else end
+                            for end in (link._source_site,
+                                        link._destination_site)]
+                    if ends[0] is not ends[1]:
+                        moved_link = Link(*ends)
+                        if moved_link.id in self:
+                            moved_link.release()
+                            moved_link = self[moved_link.id]
+                        moved_link.merge(link).store_endpoint_ids()
+                        self[moved_link.id] = moved_link
+                    link.release()
+                del self[site.id]
+
+            updates = {'merged_site_ids': ', '.join(other_ids)}
+            self[survivor.id] = survivor.update_raw_data(updates)
+            merged.append(tuple([survivor.id] + other_ids))
+
+        return merged
+
+    def import_all_files(self, folder, files_names, jobs=1, strict=True):
+        """Wrapper function to import all provided files.
+
+        Files are merged ordered by extension so sites load before the links
+        that reference them. With more than one job, files are parsed by a
+        pool of worker processes while this process merges their records in
+        the same order as a serial import, so the result is identical.
+
+        Imports are incremental. Every row loaded from a file is kept as a
+        contribution of that file and the file is added to the imports
+        manifest with its content hash. Importing a file again skips it if
+        its content is unchanged. A changed file has its old contributions
+        retracted before it is loaded again, and files in the manifest that
+        no longer exist in the imported folders are retracted. Files of other
+        folders, such as those of a snapshot made on another machine, are
+        kept. Every object the retracted files touched is then rebuilt from
+        the remaining contributions in manifest order, see retract_source.
+        Files that had rejected rows are always imported again, as the rows
+        may reference objects of other files.
+        :param files_names: file names relative to folder. Paths to files in
+            other folders can be given with an empty folder.
+        :type files_names: list
+        :param jobs: number of worker processes parsing files
+        :type jobs: int
+        :param strict: raise the first error reading a file. Otherwise the
+            error is reported and the import moves on to the next file.
+        :type strict: bool
+        :returns: OrderedDict of file path => load counts as returned by
+            load_batches, {'unchanged': True} for skipped files or
+            {'error': message} for files that failed
+        """
         files_names.sort(key=lambda f: os.path.splitext(f)[1])
-        for f in files_names:
-            path = os.path.join(folder, f)
-            if path.endswith('.csv'):
-                self.load_csv_file(path)
-            elif path.endswith(('.json', '.geojson')):
-                self.load_geojson_file(path)
-            elif path.endswith('.gv'):
-                self.load_gv_file(path)
-            else:
-                print('File format not supported for {}'.format(f))
+        paths = [os.path.join(folder, f) for f in files_names]
+        results = OrderedDict()
+
+        # Only the folders of this import are scanned for deleted files.
+        if folder:
+            folders = [os.path.abspath(folder)]
+        else:
+            folders = set(os.path.dirname(os.path.abspath(path))
+                          for path in paths)
+        folders = tuple(os.path.join(path, '') for path in folders)
+
+        affected = set()
+        for source in [source for source in self._imports
+                       if source.startswith(folders) and
+                       not os.path.exists(source)]:
+            print('  Retracting deleted file {}'.format(source))
+            affected.update(self._retract(source))
+            del self._imports[source]
+
+        digests = {}
+        supported = []
+        for path in paths:
+            if not backends.has_reader(os.path.splitext(path)[1]):
+                continue
+            source = os.path.abspath(path)
+            digests[path] = file_digest(path)
+            manifest = self._imports.get(source)
+            if manifest is not None and \
+                    manifest.get('sha1') == digests[path] and \
+                    not manifest['loads'].get('rejected'):
+                print('  Skipping unchanged {}'.format(os.path.basename(path)))
+                results[path] = {'unchanged': True}
+                continue
+            if manifest is not None:
+                affected.update(self._retract(source))
+            supported.append(path)
+        paths = [path for path in paths if path not in results]
+
+        def load(path, read):
+            """Load one file, recording the error when not strict."""
+            file_name = os.path.basename(path)
+            if path not in supported:
+                print('File format not supported for {}'.format(file_name))
+                results[path] = {'error': 'unsupported file format'}
+                return
+            source = os.path.abspath(path)
+            reloaded = source in self._imports
+            self._source = self._contributions[source] = Contributions()
+            try:
+                results[path] = read(path)
+                self._imports[source] = {
+                    'size': os.path.getsize(path),
+                    'modified': os.path.getmtime(path),
+                    'sha1': digests[path],
+                    'loads': dict(results[path])}
+            except Exception as error:
+                if strict:
+                    raise
+                print('  Import Error: {} could not be read: {}'
+                      ''.format(file_name, error))
+                results[path] = {'error': str(error)}
+            finally:
+                self._source = None
+            if reloaded:
+                affected.update(self._contributions[source].keys())
+
+        if jobs > 1 and len(supported) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(supported)))
+            try:
+                parsed = pool.imap(_read_file_safely, supported)
+
+                def merge(path):
+                    """Merge the next file parsed by the pool."""
+                    batches, error, seconds = next(parsed)
+                    recorder = instrumentation.active()
+                    if recorder is not None:
+                        recorder.record('parse', seconds, rows=sum(
+                            len(rows) for _, rows in batches or ()),
+                            file=os.path.basename(path))
+                    if error is not None:
+                        raise error
+                    return self.load_batches(os.path.basename(path), batches)
+
+                for path in paths:
+                    load(path, merge)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            # csv and gv files are streamed into the datastore, any other
+            # format is parsed by its registered reader first.
+            streaming = {'.csv': self.load_csv_file, '.gv': self.load_gv_file}
+
+            def read(path):
+                """Load one file with a streaming loader or its reader."""
+                extension = os.path.splitext(path)[1]
+                if extension in streaming:
+                    return streaming[extension](path)
+                return self.load_batches(os.path.basename(path),
+                                         backends.get_reader(extension)(path))
+
+            for path in paths:
+                load(path, read)
+
+        if affected:
+            self._rebuild(affected)
         print('\nImports complete!')
+        return results
+
+    def retract_source(self, file_path):
+        """Remove everything a file contributed to the datastore.
+
+        Every site and link the file touched is rebuilt from the
+        contributions of the remaining files in manifest order, so each field
+        again holds the value with the highest data weight. Objects left
+        without contributions are deleted together with the links attached
+        to deleted sites. Values set outside of a file import, such as those
+        of update_all_properties or merge_close_sites, are dropped from
+        rebuilt objects and should be computed again.
+        :param file_path: path of an imported file
+        :type file_path: str
+        :returns: ids of the sites and links that were rebuilt or deleted
+        """
+        source = os.path.abspath(file_path)
+        affected = self._retract(source)
+        self._imports.pop(source, None)
+        self._rebuild(affected)
+        return affected
+
+    def _retract(self, source):
+        """Forget the contributions of a source and return the keys touched.
+
+        The objects are not rebuilt, see _rebuild.
+        """
+        contributions = self._contributions.pop(source, None)
+        return set(contributions.keys()) if contributions else set()
+
+    def _rebuild(self, keys):
+        """Rebuild objects from the contributions of all imported files.
+
+        Contributions are applied in manifest order, reproducing the result
+        of importing the remaining files from scratch.
+        """
+        sources = [self._contributions[source] for source in self._imports
+                   if source in self._contributions]
+        for key in sorted(keys):
+            record = dict.get(self, key)
+            if record is None:
+                continue
+            contributions = [contribution for source in sources
+                             for contribution in source.get(key)]
+            if not contributions:
+                for link_id in list(self._adjacency.get(key, ())):
+                    del self[link_id]
+                del self[key]
+                continue
+            record.reset()
+            for weight, values in contributions:
+                record.update_columns(values, weight)
+            self[key] = record
+
+    def save_snapshot(self, file_path):
+        """Save all sites, links, data weights, imports and contributions.
+
+        The file is a versioned binary snapshot, see write_snapshot. Loading
+        it with load_snapshot is much faster than importing the source files
+        again.
+        """
+        site_ids, link_ids = sorted(self._sites), sorted(self._links)
+        sites = Site.snapshot([self._sites[key] for key in site_ids])
+        sites['ids'] = site_ids
+        links = Link.snapshot([self._links[key] for key in link_ids])
+        links['ids'] = link_ids
+        write_snapshot(file_path, {
+            'sites': sites,
+            'links': links,
+            'imports': [(path, info) for path, info in
+                        self._imports.iteritems()],
+            'contributions': {source: contributions.as_plain_data()
+                              for source, contributions in
+                              self._contributions.iteritems()}})
+        print('  Saved {} sites and {} links to {}'.format(
+            len(site_ids), len(link_ids), file_path))
+
+    def load_snapshot(self, file_path):
+        """Load a snapshot written by save_snapshot into the datastore.
+
+        Snapshot sites and links that are already in the datastore are merged
+        into the existing objects by data weight, as if their files had been
+        imported again.
+        :raises ValueError: if the file is not a snapshot of a supported
+            version
+        """
+        snapshot = read_snapshot(file_path)
+        sites, links = snapshot['sites'], snapshot['links']
+
+        # Every restored object stays alive, so cyclic garbage collection
+        # passes triggered by the allocations are wasted work.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._add_restored(self._sites, sites['ids'], Site.restore(sites),
+                               itertools.repeat(()))
+            self._add_restored(self._links, links['ids'],
+                               Link.restore(links, self._sites),
+                               links['endpoints'])
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        self._imports.update(snapshot['imports'])
+        for source, data in snapshot.get('contributions', {}).iteritems():
+            self._contributions[source] = Contributions.from_plain_data(data)
+        print('  Loaded {} sites and {} links from {}'.format(
+            len(snapshot['sites']['values']),
+            len(snapshot['links']['values']), file_path))
+
+    def _add_restored(self, store, keys, records, endpoints):
+        """Store objects restored from a snapshot.
+
+        New objects are indexed directly with the ids and link endpoints
+        stored in the snapshot instead of deriving them again per object.
+        Objects already in the datastore are merged by data weight.
+        :param store: self._sites or self._links
+        :param endpoints: site ids each object connects, () for sites
+        """
+        names = Datastore._indexed_properties
+        indexes = [self._indexes[name] for name in names]
+        adjacency, indexed_values = self._adjacency, self._indexed_values
+        for key, record, endpoint_ids in itertools.izip(keys, records,
+                                                        endpoints):
+            existing = store.get(key)
+            if existing is not None:
+                self[key] = existing.merge(record)
+                record.release()
+                continue
+            dict.__setitem__(self, key, record)
+            store[key] = record
+            for site_id in endpoint_ids:
+                adjacency.setdefault(site_id, set()).add(key)
+            # Indexed properties are never coordinates, so the plain column
+            # lookup is enough.
+            values = tuple([_Record.get(record, name) for name in names])
+            for index, value in itertools.izip(indexes, values):
+                index[value].add(key)
+            indexed_values[key] = values
+
+
+def link_geometry(sources, destinations):
+    """Return the pointing properties of links between pairs of sites.
+
+    The geometry of all links is computed in one vectorized pass by
+    utilities.link_geometry, using the altitude property of the sites.
+    :param sources: source site of every link
+    :param destinations: destination site of every link
+    :returns: list of dicts of azimuth, elevation_angle, reverse_azimuth,
+        reverse_elevation_angle and slant_range, one per link
+    """
+    geometry = utilities.link_geometry(
+        [site.latitude for site in sources],
+        [site.longitude for site in sources],
+        [site.latitude for site in destinations],
+        [site.longitude for site in destinations],
+        [utilities.parse_altitude(site.get('altitude')) for site in sources],
+        [utilities.parse_altitude(site.get('altitude'))
+         for site in destinations])
+    names = sorted(geometry)
+    return [dict(zip(names, values))
+            for values in zip(*[geometry[name].tolist() for name in names])]
+
+
+def row_site_id(row, id_index):
+    """Return the normalized site id of a csv style row, '' if it has none.
+
+    Rows without a site id are reported unless they are blank.
+    """
+    site_id = (Site.normalize_id(row[id_index])
+               if id_index is not None and id_index < len(row) else '')
+    if not site_id and any(value not in ('', None) for value in row):
+        print('  Site Error: skipping a row without a site_id')
+    return site_id
+
+
+def file_digest(file_path):
+    """Return the sha1 hex digest of the content of a file."""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_csv_file(file_path):
+    """Parse a csv document into a batch of site rows."""
+    file_name = os.path.basename(file_path)
+    with open(file_path, 'r') as f:
+        reader = csv.reader(f)
+        schema = ColumnSchema(next(reader, []), data_source=file_name,
+                              data_type='site')
+        return [(schema, list(reader))]
+
+
+def iter_gv_records(file_path):
+    """Yield raw_data records for the nodes and edges of a gv document.
+
+    Uses the streaming gv_reader parser and falls back to pydot for syntax it
+    does not support. The document is parsed once to check its syntax before
+    any record is yielded, so a document that needs the fallback is never
+    partly loaded by both parsers. Nodes only produce site records when they
+    carry attributes. Attributes of nodes and edges become columns of the
+    records.
+    :raises ValueError: if neither parser can interpret the document
+    """
+    file_name = os.path.basename(file_path)
+
+    def record(data_type, attributes, **ids):
+        raw_data = dict(attributes)
+        raw_data.update({name: Site.normalize_id(value)
+                         for name, value in ids.items()})
+        raw_data.update({'data_type': data_type, 'data_source': file_name})
+        return raw_data
+
+    try:
+        with open(file_path, 'r') as f:
+            for _ in gv_reader.iter_records(f):
+                pass
+    except gv_reader.DotSyntaxError as error:
+        print('  {} Falling back to pydot for {}.'.format(error, file_name))
+    else:
+        with open(file_path, 'r') as f:
+            for kind, key, attributes in gv_reader.iter_records(f):
+                if kind == 'node':
+                    yield record('site', attributes, site_id=key)
+                else:
+                    yield record('link', attributes, source_id=key[0],
+                                 destination_id=key[1])
+        return
+
+    import pydot  # Only needed for documents gv_reader cannot parse.
+    try:
+        graphs = pydot.graph_from_dot_file(file_path)
+    except:
+        graphs = None
+    if graphs is None:
+        raise ValueError('Unable to interpret .gv file. Please review.')
+
+    def unquote(value):
+        if len(value) > 1 and value[0] == value[-1] == '"':
+            return value[1:-1].replace('\\"', '"')
+        return value
+
+    def pydot_attributes(element):
+        # pydot keeps the quotes of quoted ids and has no value for an
+        # attribute without one, which DOT and gv_reader read as true.
+        return {unquote(name): 'true' if value is None else unquote(value)
+                for name, value in element.get_attributes().items()}
+
+    for graph in graphs:
+        for node in graph.get_node_list():
+            if node.get_name() not in ('node', 'edge', 'graph') and \
+                    node.get_attributes():
+                yield record('site', pydot_attributes(node),
+                             site_id=node.get_name())
+        for edge in graph.get_edge_list():
+            if not all(isinstance(end, basestring) for end in
+                       (edge.get_source(), edge.get_destination())):
+                print('  Skipping edge to a subgraph in {}.'.format(file_name))
+                continue
+            yield record('link', pydot_attributes(edge),
+                         source_id=edge.get_source(),
+                         destination_id=edge.get_destination())
+
+
+def read_gv_file(file_path):
+    """Parse a gv document into a batch of site and link records."""
+    return [(None, list(iter_gv_records(file_path)))]
+
+
+def read_geojson_file(file_path):
+    """Parse a FeatureCollection into batches of raw features.
+
+    Point features are read as sites, with the latitude and longitude of
+    their coordinates, and LineString features as links between the
+    source_id and destination_id of their properties, so a
+    design_layout.geojson loads back. Sites are returned before links.
+    :raises ValueError: if the document is not a valid FeatureCollection
+    """
+    import geojson  # Loaded on first use, see backends.
+    file_name = os.path.basename(file_path)
+    with open(file_path, 'r') as f:
+        collection = geojson.load(f)
+    if not isinstance(collection, geojson.FeatureCollection):
+        raise ValueError('{} is not a FeatureCollection'.format(file_name))
+    if not collection.is_valid:
+        raise ValueError('Invalid GeoJSON in {}: {}'.format(
+            file_name, collection.errors()))
+
+    sites, links = [], []
+    for feature in collection.features:
+        raw_data = dict(feature.properties or {})
+        raw_data['data_source'] = file_name
+        geometry = feature.geometry
+        if isinstance(geometry, geojson.Point):
+            raw_data['data_type'] = 'site'
+            raw_data.setdefault('site_id', feature.get('id'))
+            raw_data['longitude'], raw_data['latitude'] = \
+                geometry.coordinates[0:2]
+            sites.append(raw_data)
+        elif isinstance(geometry, geojson.LineString):
+            raw_data['data_type'] = 'link'
+            links.append(raw_data)
+        else:
+            print('  Skipping feature {} of {}: not a Point or LineString'
+                  ''.format(feature.get('id'), file_name))
+    return [(None, sites), (None, links)]
+
+
+def read_file(file_path):
+    """Parse a supported file into plain record batches.
+
+    The batches only hold builtin types and ColumnSchema objects, so files can
+    be parsed in worker processes and merged by Datastore.load_batches.
+    """
+    return backends.get_reader(os.path.splitext(file_path)[1])(file_path)
+
+
+def _read_file_safely(file_path):
+    """Return (batches, None, seconds) or (None, error, seconds) for a worker
+    process, seconds being the time spent parsing.
+
+    Errors are returned rather than raised so one bad file does not stop the
+    pool from handing back the files parsed after it.
+    """
+    start = time.time()
+    try:
+        return read_file(file_path), None, time.time() - start
+    except Exception as error:
+        return None, error, time.time() - start
+
+
+SNAPSHOT_MAGIC = 'DTSNAP'
+# Version 2 added the per file contributions. Version 1 snapshots still load,
+# but the files they were built from cannot be retracted.
+SNAPSHOT_VERSION = 2
+READABLE_SNAPSHOT_VERSIONS = (1, 2)
+
+
+def write_snapshot(file_path, snapshot):
+    """Write snapshot data to a file.
+
+    The file starts with SNAPSHOT_MAGIC and SNAPSHOT_VERSION as a big endian
+    unsigned short, followed by the zlib compressed marshal dump of the
+    snapshot. Only builtin types are stored, so no code runs when a snapshot
+    is read. The file is replaced atomically.
+    :param snapshot: builtin types only
+    :type snapshot: dict
+    """
+    temporary_path = file_path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + struct.pack('>H', SNAPSHOT_VERSION))
+        f.write(zlib.compress(marshal.dumps(snapshot, 2), 1))
+    os.rename(temporary_path, file_path)
+
+
+def read_snapshot(file_path):
+    """Return the snapshot data of a file written by write_snapshot.
+
+    :raises ValueError: if the file is not a snapshot of a supported version
+    """
+    header_size = len(SNAPSHOT_MAGIC) + 2
+    with open(file_path, 'rb') as f:
+        header = f.read(header_size)
+        if len(header) != header_size or \
+                not header.startswith(SNAPSHOT_MAGIC):
+            raise ValueError('{} is not a datastore snapshot'.format(
+                file_path))
+        version, = struct.unpack('>H', header[len(SNAPSHOT_MAGIC):])
+        if version not in READABLE_SNAPSHOT_VERSIONS:
+            raise ValueError('{} is a version {} snapshot, only versions {} '
+                             'are supported'.format(
+                                 file_path, version, ', '.join(
+                                     str(v) for v in
+                                     READABLE_SNAPSHOT_VERSIONS)))
+        return marshal.loads(zlib.decompress(f.read()))
+
+
+_MISSING = object()
+_NO_WEIGHT = -sys.maxint - 1
+
+# Values of these columns repeat across most sites and links, so one shared
+# string is kept per distinct value.
+CATEGORICAL_COLUMNS = frozenset(['bill_of_materials', 'status', 'data_source',
+                                 'data_type', 'site_type'])
+
+
+def _intern(value):
+    """Return the shared copy of a byte string value."""
+    return intern(value) if type(value) is str else value
 
 
-class Site(object):
+class Contributions(object):
+    """Rows one imported file contributed to each site and link.
+
+    Rows loaded through a ColumnSchema are kept as the raw row and a layout
+    shared by every row of the schema, which takes far less memory than
+    keeping the normalized (column_name, value) pairs of each row.
+    """
+
+    __slots__ = ('_layouts', '_layout_indexes', '_objects')
+
+    def __init__(self):
+        """Initilize empty contributions."""
+        self._layouts = []
+        self._layout_indexes = {}
+        self._objects = {}
+
+    def add(self, key, weight, values):
+        """Record normalized (column_name, value) pairs given to an object."""
+        self._objects.setdefault(key, []).append((weight, -1, values))
+
+    def add_row(self, key, weight, schema, row):
+        """Record a raw row loaded through a ColumnSchema into an object."""
+        layout = self._layout_indexes.get(id(schema))
+        if layout is None:
+            layout = self._layout_indexes[id(schema)] = len(self._layouts)
+            self._layouts.append((tuple(schema.columns),
+                                  tuple(schema.constants)))
+        self._objects.setdefault(key, []).append((weight, layout, row))
+
+    def keys(self):
+        """Return the ids of every object the file contributed to."""
+        return self._objects.keys()
+
+    def get(self, key):
+        """Return the (weight, column_name value pairs) given to an object.
+
+        Pairs are listed in the order the rows were loaded.
+        """
+        contributions = []
+        for weight, layout, values in self._objects.get(key, ()):
+            if layout >= 0:
+                columns, constants = self._layouts[layout]
+                row, width = values, len(values)
+                values = [(name, row[index]) for index, name in columns
+                          if index < width and row[index] not in ('', None)]
+                values.extend(constants)
+            contributions.append((weight, values))
+        return contributions
+
+    def as_plain_data(self):
+        """Return the contributions as builtin types for a snapshot."""
+        return {'layouts': self._layouts, 'objects': self._objects}
+
+    @classmethod
+    def from_plain_data(cls, data):
+        """Return contributions saved with as_plain_data."""
+        contributions = cls()
+        contributions._layouts = [
+            (tuple(tuple(column) for column in columns),
+             tuple(tuple(constant) for constant in constants))
+            for columns, constants in data['layouts']]
+        contributions._objects = data['objects']
+        return contributions
+
+
+class ColumnTable(object):
+    """Column layout and data weights shared by every object of a class.
+
+    Objects keep their values in a list ordered by the column positions of
+    the table. Data weights are kept per column in one integer array indexed
+    by the slot number of each object instead of a dict per object. The slot
+    of an object dropped by a Datastore is handed to the next new object, see
+    _Record.release.
+    """
+
+    def __init__(self, mandatory_properties):
+        """Initilize the ColumnTable with the columns every object has.
+
+        :param mandatory_properties: column name => default value
+        :type mandatory_properties: dict
+        """
+        self.positions = {}
+        self.names = []
+        self._weights = []
+        self._slot_count = 0
+        self._free_slots = []
+        for column_name in sorted(mandatory_properties):
+            self.position(column_name)
+        self.defaults = [mandatory_properties[name] for name in self.names]
+
+    @property
+    def slot_count(self):
+        """Number of slots in use."""
+        return self._slot_count - len(self._free_slots)
+
+    def new_slot(self):
+        """Return the weight slot number for a new object."""
+        if self._free_slots:
+            return self.reuse_slots(1)[0]
+        self._slot_count += 1
+        return self._slot_count - 1
+
+    def reserve_slots(self, count):
+        """Return the first of count consecutive new slot numbers."""
+        self._slot_count += count
+        return self._slot_count - count
+
+    def reuse_slots(self, count):
+        """Return up to count released slot numbers with cleared weights."""
+        count = min(count, len(self._free_slots))
+        if not count:
+            return []
+        slots = self._free_slots[-count:]
+        del self._free_slots[-count:]
+        for weights in self._weights:
+            size = len(weights)
+            for slot in slots:
+                if slot < size:
+                    weights[slot] = _NO_WEIGHT
+        return slots
+
+    def release_slot(self, slot):
+        """Hand the slot of a released object to a new object.
+
+        Weights are cleared when the slot is reused.
+        """
+        self._free_slots.append(slot)
+
+    def position(self, column_name):
+        """Return the position of a column, adding the column if needed."""
+        position = self.positions.get(column_name)
+        if position is None:
+            column_name = _intern(column_name)
+            position = self.positions[column_name] = len(self.names)
+            self.names.append(column_name)
+            self._weights.append(array.array('l'))
+        return position
+
+    def weight(self, position, slot):
+        """Return the weight that set a column of an object, None if unset."""
+        weights = self._weights[position]
+        if slot < len(weights) and weights[slot] != _NO_WEIGHT:
+            return weights[slot]
+        return None
+
+    def set_weight(self, position, slot, weight):
+        """Record the weight that set a column of an object."""
+        weights = self._weights[position]
+        if slot >= len(weights):
+            weights.extend([_NO_WEIGHT] * (slot + 1 - len(weights)))
+        weights[slot] = weight
+
+    def slot_weights(self, position, slots):
+        """Return the weights of a column for a list of slots.
+
+        Unset weights are returned as _NO_WEIGHT.
+        """
+        weights = self._weights[position]
+        size = len(weights)
+        return [weights[slot] if slot < size else _NO_WEIGHT
+                for slot in slots]
+
+    def load_weights(self, position, reused_slots, first_slot, weights):
+        """Set the weights of a column for the slots of restored objects.
+
+        :param reused_slots: slots of the first weights, from reuse_slots
+        :param first_slot: slot of the remaining weights, from reserve_slots
+        :param weights: weights with _NO_WEIGHT for unset columns
+        :type weights: list
+        """
+        for slot, weight in zip(reused_slots, weights):
+            self.set_weight(position, slot, weight)
+        column = self._weights[position]
+        if len(column) < first_slot:
+            column.extend([_NO_WEIGHT] * (first_slot - len(column)))
+        column.extend(weights[len(reused_slots):])
+
+
+class _Record(object):
+    """Compact storage of weighted column values shared by Site and Link.
+
+    Values are held in a list ordered by the ColumnTable of the class and the
+    serialized feature is cached until a loaded value actually changes.
+    """
+
+    __slots__ = ('_slot', '_values', '_feature')
+
+    _table = None
+    _float_columns = ()
+    _merge_exclusions = ()
+
+    def __init__(self):
+        """Initilize the record with the mandatory properties."""
+        self._slot = self._table.new_slot()
+        self._values = list(self._table.defaults)
+        self._feature = None
+
+    def release(self):
+        """Hand the weight slot of the record to the next new record.
+
+        A Datastore releases the records it drops. A released record keeps
+        its values, but its weights can no longer be read or set.
+        """
+        if self._slot is not None:
+            self._table.release_slot(self._slot)
+            self._slot = None
+
+    def _copy_feature(self):
+        """Return the cached feature with its own properties dict.
+
+        The geometry is shared, callers replace it rather than modify it.
+        """
+        import geojson  # Loaded on first use, see backends.
+        feature = self._feature
+        return geojson.Feature(id=feature.id, geometry=feature.geometry,
+                               properties=dict(feature.properties))
+
+    @classmethod
+    def snapshot(cls, records):
+        """Return the values and data weights of records as plain data.
+
+        Unset values are stored as None and listed by record in 'missing'.
+        """
+        table = cls._table
+        values, missing = [], {}
+        for index, record in enumerate(records):
+            record_values = record._values
+            gaps = [position for position, value in enumerate(record_values)
+                    if value is _MISSING]
+            if gaps:
+                record_values = list(record_values)
+                for position in gaps:
+                    record_values[position] = None
+                missing[index] = gaps
+            values.append(record_values)
+
+        slots = [record._slot for record in records]
+        return {'columns': list(table.names),
+                'values': values,
+                'missing': missing,
+                'weights': [table.slot_weights(position, slots)
+                            for position in range(len(table.names))]}
+
+    @classmethod
+    def restore(cls, snapshot):
+        """Return new records holding the values and weights of a snapshot.
+
+        Snapshot columns are mapped onto the columns of this process, so a
+        snapshot loads into a table that already knows other columns.
+        """
+        table = cls._table
+        positions = [table.position(name) for name in snapshot['columns']]
+        remap = positions != range(len(positions))
+        width = len(table.names)
+        count = len(snapshot['values'])
+        reused_slots = table.reuse_slots(count)
+        first_slot = table.reserve_slots(count - len(reused_slots))
+        slots = reused_slots + range(first_slot,
+                                     first_slot + count - len(reused_slots))
+        missing = snapshot['missing']
+
+        records = []
+        for index, values in enumerate(snapshot['values']):
+            for position in missing.get(index, ()):
+                values[position] = _MISSING
+            if remap:
+                remapped = [_MISSING] * width
+                for position, value in zip(positions, values):
+                    remapped[position] = value
+                values = remapped
+            record = cls.__new__(cls)
+            record._slot = slots[index]
+            record._values = values
+            record._feature = None
+            records.append(record)
+
+        for position, weights in zip(positions, snapshot['weights']):
+            table.load_weights(position, reused_slots, first_slot, weights)
+        return records
+
+    def get(self, column_name, default=None):
+        """Return the current value of a column."""
+        position = self._table.positions.get(column_name)
+        if position is None or position >= len(self._values):
+            return default
+        value = self._values[position]
+        return default if value is _MISSING else value
+
+    def items(self):
+        """Return (column_name, value) pairs of all set columns."""
+        names = self._table.names
+        return [(names[position], value)
+                for position, value in enumerate(self._values)
+                if value is not _MISSING]
+
+    def weight(self, column_name):
+        """Return the data weight that set a column, 0 if never set."""
+        position = self._table.positions.get(column_name)
+        if position is None:
+            return 0
+        weight = self._table.weight(position, self._slot)
+        return 0 if weight is None else weight
+
+    def weights(self):
+        """Return (column_name, weight) pairs of all loaded columns."""
+        table, slot = self._table, self._slot
+        weights = [(name, table.weight(position, slot))
+                   for position, name in enumerate(table.names)]
+        return [(name, weight) for name, weight in weights
+                if weight is not None]
+
+    def _store(self, position, column_name, value):
+        """Set a column value, dropping the cached feature if it changed."""
+        values = self._values
+        if position >= len(values):
+            values.extend([_MISSING] * (position + 1 - len(values)))
+        elif values[position] == value:
+            return
+        if column_name in CATEGORICAL_COLUMNS:
+            value = _intern(value)
+        values[position] = value
+        self._feature = None
+
+    def merge(self, other):
+        """Fold the data of another record into this one.
+
+        A value of the other record replaces a value of this record only if it
+        was loaded with a higher weight or this record never loaded the
+        column.
+        """
+        table, slot = self._table, self._slot
+        for column_name, weight in other.weights():
+            if column_name in self._merge_exclusions:
+                continue
+            position = table.position(column_name)
+            current = table.weight(position, slot)
+            if current is None or weight > current:
+                table.set_weight(position, slot, weight)
+                self._store(position, column_name, other.get(column_name))
+
+        return self
+
+    def update_raw_data(self, raw_data):
+        """Update the record with the appropriate data.
+
+        Take raw_data weight into consideration for which fields should be
+        updated to new values.
+        """
+        return self.update_columns(*_Record.parse_raw_data(raw_data))
+
+    @staticmethod
+    def parse_raw_data(raw_data):
+        """Return the normalized (column_name, value) pairs and data weight of
+        a raw_data dict, skipping empty values.
+        """
+        return ([(normalize_column_name(k), v) for k, v in raw_data.items()
+                 if v != ''], int(raw_data.get('data_weight', 0)))
+
+    def drop_columns(self, column_names):
+        """Unset columns, dropping their values and weights."""
+        table, slot, values = self._table, self._slot, self._values
+        for column_name in column_names:
+            position = table.positions.get(column_name)
+            if (position is None or position >= len(values) or
+                    values[position] is _MISSING):
+                continue
+            values[position] = _MISSING
+            table.set_weight(position, slot, _NO_WEIGHT)
+            self._feature = None
+
+    def reset(self):
+        """Drop every loaded value and weight, keeping only the defaults."""
+        table, slot = self._table, self._slot
+        for weights in table._weights:
+            if slot < len(weights):
+                weights[slot] = _NO_WEIGHT
+        self._values = list(table.defaults)
+        self._feature = None
+
+    def update_columns(self, values, data_weight):
+        """Merge normalized (column_name, value) pairs loaded at one weight.
+
+        A value replaces the current value of a column unless the current
+        value was loaded with a higher weight. This is the inner loop of every
+        import, so the weight and value bookkeeping is done inline.
+        """
+        table, slot = self._table, self._slot
+        positions, all_weights = table.positions, table._weights
+        record_values, float_columns = self._values, self._float_columns
+        for column_name, value in values:
+            position = positions.get(column_name)
+            if position is None:
+                position = table.position(column_name)
+            weights = all_weights[position]
+            if slot < len(weights):
+                current = weights[slot]
+                if data_weight < (0 if current == _NO_WEIGHT else current):
+                    continue
+                weights[slot] = data_weight
+            elif data_weight < 0:
+                continue
+            else:
+                table.set_weight(position, slot, data_weight)
+
+            if column_name in float_columns:
+                self._store(position, column_name, value)
+                continue
+            if position >= len(record_values):
+                record_values.extend(
+                    [_MISSING] * (position + 1 - len(record_values)))
+            elif record_values[position] == value:
+                continue
+            if column_name in CATEGORICAL_COLUMNS and type(value) is str:
+                value = intern(value)
+            record_values[position] = value
+            self._feature = None
+
+        return self
+
+
+class Site(_Record):
     """Atomic object representing a physiscal site.
 
     A site is a physical place that is approximtly 5m X 5m.
+
+    Coordinates are kept as parsed floats. The serialized feature is cached
+    until a loaded value actually changes.
     """
 
+    __slots__ = ('_longitude', '_latitude')
+
     _mandatory_properties = {'bill_of_materials': 'Unknown',
                              'status': 'Unknown',
                              'data_type': 'site'}
+    _table = ColumnTable(_mandatory_properties)
+    _float_columns = ('latitude', 'longitude')
+    _merge_exclusions = ('site_id', 'id')
 
     def __init__(self):
         """Initilize the Site object."""
-        self._data_weights = {}
-        self._data = Site._mandatory_properties.copy()
+        self._longitude = self._latitude = 0.0
+        super(Site, self).__init__()
 
     @staticmethod
     def normalize_id(site_name):
@@ -197,110 +1611,178 @@ class Site(object):
         This method can be used to clean up eroneouse naming conventions of
         unique identifiers.
         """
-        if 'id' in self._data:
-            self._data['site_id'] = self._data['id']
-            self._data.pop('id', None)
-        if 'site_id' in self._data:
-            return Site.normalize_id(self._data['site_id'])
+        site_id = self.get('id')
+        if site_id is not None:
+            self._store(self._table.position('site_id'), 'site_id', site_id)
+            self._store(self._table.position('id'), 'id', _MISSING)
+        site_id = self.get('site_id')
+        if site_id is not None:
+            return Site.normalize_id(site_id)
         return 'unknown'
 
+    @property
+    def coordinates(self):
+        """Center point of the site as (lng, lat) with 1m of precision."""
+        return (self._longitude, self._latitude)
+
     @property
     def latitude(self):
         """Latitude of the center point of the site with 1m of precision."""
-        try:
-            return float('{:.6f}'.format(float(self._data['latitude'])))
-        except:
-            return 0.0
+        return self._latitude
 
     @property
     def longitude(self):
         """Longitude of the center point of the site with 1m of precision."""
+        return self._longitude
+
+    def get(self, column_name, default=None):
+        """Return the current value of a column."""
+        if column_name == 'latitude':
+            return self._latitude
+        elif column_name == 'longitude':
+            return self._longitude
+        return super(Site, self).get(column_name, default)
+
+    def _store(self, position, column_name, value):
+        """Set a column value, dropping the cached feature if it changed."""
+        if column_name not in Site._float_columns:
+            return super(Site, self)._store(position, column_name, value)
+
         try:
-            return float('{:.6f}'.format(float(self._data['longitude'])))
+            value = float('{:.6f}'.format(float(value)))
         except:
-            return 0.0
+            value = 0.0
+        attribute = '_' + column_name
+        if getattr(self, attribute) != value:
+            setattr(self, attribute, value)
+            self._feature = None
 
-    def as_geojson(self):
-        """Return the site data as a geoJSON feature object."""
-        properties = {k: v for k, v in self._data.items()
-                      if k not in ['longitude', 'latitude']}
+    def reset(self):
+        """Drop every loaded value and weight, including the coordinates."""
+        super(Site, self).reset()
+        self._longitude = self._latitude = 0.0
 
-        return geojson.Feature(id=self.id,
-                               geometry=geojson.Point((self.longitude,
-                                                       self.latitude)),
-                               properties=properties)
-
-    def update_raw_data(self, raw_data):
-        """Update the site with the appropriate data.
+    @classmethod
+    def snapshot(cls, sites):
+        """Return the data of sites, including coordinates, as plain data."""
+        snapshot = super(Site, cls).snapshot(sites)
+        snapshot['latitudes'] = [site._latitude for site in sites]
+        snapshot['longitudes'] = [site._longitude for site in sites]
+        return snapshot
 
-        Take raw_data weight into consideration for which fields should be
-        updated to new values.
-        """
-        input_data_weight = int(raw_data.get('data_weight', 0))
-        raw_data = {k: v for k, v in raw_data.items() if v != ''}
-        for (column_name, value) in raw_data.iteritems():
-            # Normalize all input data fields.
-            column_name = column_name.lower().replace(' ', '_').strip()
+    @classmethod
+    def restore(cls, snapshot):
+        """Return new sites holding the data of a snapshot."""
+        sites = super(Site, cls).restore(snapshot)
+        for site, latitude, longitude in zip(sites, snapshot['latitudes'],
+                                             snapshot['longitudes']):
+            site._latitude, site._longitude = latitude, longitude
+        return sites
 
-            if input_data_weight >= self._data_weights.get(column_name, 0):
-                self._data_weights[column_name] = input_data_weight
-                self._data.update({column_name: value})
+    def as_geojson(self):
+        """Return the site data as a geoJSON feature object.
 
-        return self
+        The feature is cached, and every caller gets a copy with its own
+        properties dict.
+        """
+        if self._feature is None:
+            import geojson  # Loaded on first use, see backends.
+            self._feature = geojson.Feature(
+                id=self.id,
+                geometry=geojson.Point(self.coordinates),
+                properties=dict(self.items()))
+        return self._copy_feature()
 
 
-class Link(object):
+class Link(_Record):
     """Atomic link object.
 
-    This object represents a link between two sites.
+    This object represents a link between two sites. The serialized feature
+    is cached until a loaded value changes or one of the sites moves.
     """
+
+    __slots__ = ('_source_site', '_destination_site', '_feature_locations')
+
     _mandatory_properties = {'status': 'unknown',
                              'source_id': 'unknown',
                              'destination_id': 'unknown'}
+    _table = ColumnTable(_mandatory_properties)
 
     def __init__(self, source_site, destination_site):
         """Initilize the Link object."""
-        self._data_weights = {}
-        self._data = Link._mandatory_properties.copy()
+        super(Link, self).__init__()
         self._source_site, self._destination_site = \
             sorted([source_site, destination_site], key=lambda x: x.id)
+        self._feature_locations = None
 
     @property
     def id(self):
         return '{}_{}'.format(self._source_site.id, self._destination_site.id)
 
-    def as_geojson(self):
-        """Return the link data as a geoJSON feature object."""
+    @property
+    def coordinates(self):
+        """Endpoint coordinates of the link as ((lng, lat), (lng, lat))."""
+        return (self._source_site.coordinates,
+                self._destination_site.coordinates)
 
-        properties = {k: v for k, v in self._data.items()
-                      if k not in ['longitude', 'latitude']}
+    def reset(self):
+        """Drop every loaded value and weight."""
+        super(Link, self).reset()
+        self._feature_locations = None
 
-        properties.update({'source_id': self._source_site.id,
-                           'destination_id': self._destination_site.id})
+    def store_endpoint_ids(self):
+        """Set the source_id and destination_id columns to the linked sites.
 
-        line = geojson.LineString(((self._source_site.longitude,
-                                    self._source_site.latitude),
-                                   (self._destination_site.longitude,
-                                    self._destination_site.latitude)))
+        The data weights of the columns are kept.
+        """
+        for column_name, site in (('source_id', self._source_site),
+                                  ('destination_id', self._destination_site)):
+            self._store(self._table.position(column_name), column_name,
+                        site.id)
+        return self
 
-        return geojson.Feature(id=self.id,
-                               geometry=line,
-                               properties=properties)
+    @classmethod
+    def snapshot(cls, links):
+        """Return the data of links, including endpoint ids, as plain data."""
+        snapshot = super(Link, cls).snapshot(links)
+        snapshot['endpoints'] = [(link._source_site.id,
+                                  link._destination_site.id)
+                                 for link in links]
+        return snapshot
 
-    def update_raw_data(self, raw_data):
-        """Update the link with the appropriate data.
+    @classmethod
+    def restore(cls, snapshot, sites):
+        """Return new links holding the data of a snapshot.
 
-        Take raw_data weight into consideration for which fields should be
-        updated to new values.
+        :param sites: site id => Site holding every link endpoint
+        :type sites: dict
         """
-        input_data_weight = int(raw_data.get('data_weight', 0))
-        raw_data = {k: v for k, v in raw_data.items() if v != ''}
-        for (column_name, value) in raw_data.iteritems():
-            # Normalize all input data fields.
-            column_name = column_name.lower().replace(' ', '_').strip()
+        links = super(Link, cls).restore(snapshot)
+        for link, (source_id, destination_id) in zip(links,
+                                                     snapshot['endpoints']):
+            link._source_site = sites[source_id]
+            link._destination_site = sites[destination_id]
+            link._feature_locations = None
+        return links
 
-            if input_data_weight >= self._data_weights.get(column_name, 0):
-                self._data_weights[column_name] = input_data_weight
-                self._data.update({column_name: value})
+    def as_geojson(self):
+        """Return the link data as a geoJSON feature object.
 
-        return self
+        The feature is cached, and every caller gets a copy with its own
+        properties dict.
+        """
+        coordinates = self.coordinates
+        if self._feature is None or self._feature_locations != coordinates:
+            import geojson  # Loaded on first use, see backends.
+            properties = {k: v for k, v in self.items()
+                          if k not in ['longitude', 'latitude']}
+
+            properties.update({'source_id': self._source_site.id,
+                               'destination_id': self._destination_site.id})
+
+            self._feature = geojson.Feature(
+                id=self.id,
+                geometry=geojson.LineString(coordinates),
+                properties=properties)
+            self._feature_locations = coordinates
+        return self._copy_feature()
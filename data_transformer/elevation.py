@@ -0,0 +1,424 @@
+"""Elevation providers for adding altitude to deployment data.
+
+A provider returns the ground elevation of arrays of coordinates in one call,
+see ElevationProvider. DemElevationProvider reads a local digital elevation
+model (DEM) raster through a memory map, so lookups need no network and only
+the pages of the raster around the looked up points are read from disk.
+ElevationClient looks elevations up in an online API with batched requests
+and keeps them in a persistent cache.
+"""
+
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import os
+import struct
+import threading
+import time
+import utilities
+
+# Elevation API queried by ElevationClient, see utilities.get_altitude.
+DEFAULT_ELEVATION_URL = 'http://maps.google.com/maps/api/elevation/json'
+
+
+class ElevationProvider(object):
+    """Source of ground elevations in meters."""
+
+    def elevations(self, latitudes, longitudes):
+        """Return the elevations of arrays of coordinates.
+
+        :param latitudes: N latitudes in degrees
+        :type latitudes: sequence or numpy.ndarray
+        :param longitudes: N longitudes in degrees
+        :type longitudes: sequence or numpy.ndarray
+        :returns: numpy.ndarray of N elevations, NaN where unknown
+        """
+        raise NotImplementedError
+
+    def elevation(self, latitude, longitude):
+        """Return the elevation of one point, NaN if unknown."""
+        return self.elevations([latitude], [longitude])[0].item()
+
+
+class DemElevationProvider(ElevationProvider):
+    """Elevations interpolated from a memory mapped DEM raster.
+
+    The raster is a grid of rows from north to south, each holding the
+    elevations of its columns from west to east. Elevations between the grid
+    points are interpolated bilinearly from the four surrounding points.
+    Points outside of the grid or next to a nodata value are unknown.
+    """
+
+    def __init__(self, path, rows, columns, north, west, row_step,
+                 column_step, dtype='<f4', offset=0, nodata=None):
+        """Map a raw raster file.
+
+        :param path: raster file
+        :type path: str
+        :param rows: number of rows of the grid
+        :param columns: number of columns of the grid
+        :param north: latitude of the center of the first row
+        :param west: longitude of the center of the first column
+        :param row_step: degrees of latitude between two rows
+        :param column_step: degrees of longitude between two columns
+        :param dtype: numpy dtype of the values including the byte order,
+            such as '<i2' or '>f4'
+        :param offset: bytes before the first value of the grid
+        :param nodata: value marking grid points without data
+        """
+        if rows < 2 or columns < 2:
+            raise ValueError('A DEM needs at least 2 rows and 2 columns')
+        self.path = path
+        self.grid = np.memmap(path, dtype=np.dtype(dtype), mode='r',
+                              offset=offset, shape=(rows, columns))
+        self.north, self.west = float(north), float(west)
+        self.row_step, self.column_step = float(row_step), float(column_step)
+        self.nodata = nodata
+
+    @classmethod
+    def from_header(cls, path):
+        """Map a raw raster described by an ESRI .hdr file next to it.
+
+        This is the header of the BIL and FLT formats exported by most GIS
+        tools, holding NROWS, NCOLS, NBITS, PIXELTYPE, BYTEORDER, ULXMAP,
+        ULYMAP, XDIM, YDIM and NODATA. FLT style headers with XLLCORNER,
+        YLLCORNER and CELLSIZE are read as well.
+        :raises ValueError: if the header does not describe a single band
+        """
+        header = {}
+        with open(os.path.splitext(path)[0] + '.hdr', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2:
+                    header[fields[0].upper()] = fields[1]
+
+        if int(header.get('NBANDS', 1)) != 1:
+            raise ValueError('Only single band DEMs are supported')
+        rows, columns = int(header['NROWS']), int(header['NCOLS'])
+        cell_size = float(header.get('CELLSIZE', 1))
+        column_step = float(header.get('XDIM', cell_size))
+        row_step = float(header.get('YDIM', cell_size))
+        if 'ULXMAP' in header:
+            west, north = float(header['ULXMAP']), float(header['ULYMAP'])
+        else:
+            west = float(header['XLLCORNER']) + column_step / 2
+            north = (float(header['YLLCORNER']) + row_step * rows -
+                     row_step / 2)
+
+        byte_order = '>' if header.get('BYTEORDER', 'I').upper() in \
+            ('M', 'MSBFIRST') else '<'
+        if path.lower().endswith('.flt'):
+            kind, bits = 'f', 32
+        else:
+            bits = int(header.get('NBITS', 16))
+            kind = {'FLOAT': 'f', 'UNSIGNEDINT': 'u'}.get(
+                header.get('PIXELTYPE', '').upper(), 'i')
+        nodata = header.get('NODATA', header.get('NODATA_VALUE'))
+        return cls(path, rows, columns, north, west, row_step, column_step,
+                   dtype='{}{}{}'.format(byte_order, kind, bits // 8),
+                   offset=int(header.get('SKIPBYTES', 0)),
+                   nodata=None if nodata is None else float(nodata))
+
+    @classmethod
+    def from_geotiff(cls, path):
+        """Map an uncompressed single band GeoTIFF.
+
+        The strips of the image must follow each other in the file, which is
+        how GIS tools write uncompressed GeoTIFFs by default.
+        :raises ValueError: if the file cannot be memory mapped
+        """
+        with open(path, 'rb') as f:
+            tags = _read_tiff_tags(f)
+
+        def tag(code, default=None):
+            values = tags.get(code, default)
+            if values is None:
+                raise ValueError('GeoTIFF tag {} is missing'.format(code))
+            return values
+
+        if tag(259, [1])[0] != 1:
+            raise ValueError('Compressed GeoTIFFs are not supported')
+        if tag(277, [1])[0] != 1 or 322 in tags:
+            raise ValueError('Only single band striped GeoTIFFs are supported')
+        columns, rows = tag(256)[0], tag(257)[0]
+        offsets, counts = tag(273), tag(279)
+        if any(offset != offsets[0] + sum(counts[:index])
+               for index, offset in enumerate(offsets)):
+            raise ValueError('GeoTIFF strips are not contiguous')
+
+        kind = {1: 'u', 2: 'i', 3: 'f'}[tag(339, [1])[0]]
+        dtype = '{}{}{}'.format(tags['byte_order'], kind,
+                                tag(258)[0] // 8)
+        column_step, row_step = tag(33550)[:2]
+        _, _, _, west, north = tag(33922)[:5]
+        # Pixels are areas unless the GeoKey directory says they are points,
+        # so the tie point is the corner of the first pixel by default.
+        geokeys = tags.get(34735, [])
+        point_pixels = any(geokeys[index:index + 4] == [1025, 0, 1, 2]
+                           for index in range(4, len(geokeys), 4))
+        if not point_pixels:
+            west += column_step / 2
+            north -= row_step / 2
+        nodata = tags.get(42113)
+        return cls(path, rows, columns, north, west, row_step, column_step,
+                   dtype=dtype, offset=offsets[0],
+                   nodata=None if nodata is None else float(nodata))
+
+    def elevations(self, latitudes, longitudes):
+        """Return bilinearly interpolated elevations of arrays of points."""
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        rows, columns = self.grid.shape
+        y = (self.north - latitudes) / self.row_step
+        x = (longitudes - self.west) / self.column_step
+        # Points on the edge of the grid may fall a rounding error outside.
+        slack = 1e-6
+        inside = ((y >= -slack) & (y <= rows - 1 + slack) &
+                  (x >= -slack) & (x <= columns - 1 + slack))
+
+        # Points on the last row or column interpolate from the cell before.
+        row = np.clip(np.floor(y), 0, rows - 2).astype(np.intp)
+        column = np.clip(np.floor(x), 0, columns - 2).astype(np.intp)
+        row[~inside] = column[~inside] = 0
+        dy = np.clip(y - row, 0, 1)
+        dx = np.clip(x - column, 0, 1)
+
+        corners = [self.grid[row + r, column + c].astype(float)
+                   for r in (0, 1) for c in (0, 1)]
+        result = ((corners[0] * (1 - dx) + corners[1] * dx) * (1 - dy) +
+                  (corners[2] * (1 - dx) + corners[3] * dx) * dy)
+        if self.nodata is not None:
+            for corner in corners:
+                inside &= corner != self.nodata
+        result[~inside] = np.nan
+        return result
+
+
+class ElevationClient(ElevationProvider):
+    """Elevations looked up in an online elevation API.
+
+    Locations are sent batch_size at a time in one request, as the pipe
+    separated 'locations' parameter understood by the Google elevation API,
+    by a bounded pool of worker threads. Requests are started at most
+    requests_per_second times a second across all workers. Every elevation
+    received is kept in an ElevationCache, so locations are only requested
+    once across runs.
+    """
+
+    def __init__(self, base_url=DEFAULT_ELEVATION_URL, cache_path=None,
+                 batch_size=100, workers=4, requests_per_second=10.0,
+                 api_key=None, timeout=30):
+        """Initilize the ElevationClient.
+
+        :param base_url: URL of the elevation API, such as a local stub
+            server for tests
+        :type base_url: str
+        :param cache_path: file of the persistent cache, no cache if None
+        :type cache_path: str
+        :param batch_size: locations per request
+        :type batch_size: int
+        :param workers: requests run at the same time
+        :type workers: int
+        :param requests_per_second: maximum rate of requests
+        :type requests_per_second: float
+        :param api_key: key sent with every request if given
+        :type api_key: str
+        :param timeout: seconds to wait for a response
+        :type timeout: float
+        """
+        self.base_url = base_url
+        self.cache = ElevationCache(cache_path)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.api_key = api_key
+        self.timeout = timeout
+        self._interval = 1.0 / requests_per_second
+        self._next_request = 0.0
+        self._lock = threading.Lock()
+
+    def elevations(self, latitudes, longitudes):
+        """Return the elevations of arrays of points, NaN where unknown.
+
+        Points already in the cache are not requested and points within the
+        same hash_location are requested once. Batches that fail are
+        reported and left unknown.
+        """
+        keys = [utilities.hash_location((latitude, longitude))
+                for latitude, longitude in zip(latitudes, longitudes)]
+        missing = {}
+        for key, latitude, longitude in zip(keys, latitudes, longitudes):
+            if key not in self.cache and key not in missing:
+                missing[key] = (latitude, longitude)
+
+        if missing:
+            missing = sorted(missing.items())
+            batches = [missing[start:start + self.batch_size]
+                       for start in range(0, len(missing), self.batch_size)]
+            pool = ThreadPool(min(self.workers, len(batches)))
+            try:
+                for batch, batch_elevations in zip(
+                        batches, pool.imap(self._request_safely, batches)):
+                    if batch_elevations is not None:
+                        self.cache.update(
+                            zip([key for key, _ in batch], batch_elevations))
+            finally:
+                pool.close()
+                pool.join()
+
+        return np.array([self.cache.get(key, np.nan) for key in keys],
+                        dtype=float)
+
+    def _wait_for_turn(self):
+        """Sleep until the rate limit allows another request."""
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_request)
+            self._next_request = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+    def _request_safely(self, batch):
+        """Return the elevations of a batch, None if the request failed."""
+        try:
+            return self._request(batch)
+        except Exception as error:
+            print('ERROR: Requesting altitude data for {} locations: {}'
+                  ''.format(len(batch), error))
+            return None
+
+    def _request(self, batch):
+        """Request the elevations of a batch of (key, (lat, lng)) pairs."""
+        # Only needed for online lookups, so not loaded with the module.
+        import json
+        import urllib
+        import urllib2
+        parameters = {'locations': '|'.join(
+            '{:.6f},{:.6f}'.format(latitude, longitude)
+            for _, (latitude, longitude) in batch)}
+        if self.api_key:
+            parameters['key'] = self.api_key
+        self._wait_for_turn()
+        response = json.load(urllib2.urlopen(
+            self.base_url + '?' + urllib.urlencode(parameters),
+            timeout=self.timeout))
+        if response.get('status', 'OK') != 'OK':
+            raise ValueError(response.get('error_message',
+                                          response['status']))
+        results = response['results']
+        if len(results) != len(batch):
+            raise ValueError('{} results for {} locations'.format(
+                len(results), len(batch)))
+        return [float(result['elevation']) for result in results]
+
+
+class ElevationCache(object):
+    """Persistent map of utilities.hash_location => elevation.
+
+    Entries are appended to a text file as 'hash elevation' lines, so a run
+    that is interrupted keeps every elevation it already received.
+    """
+
+    def __init__(self, path=None):
+        """Load the cache file, only keeping the cache in memory if None."""
+        self.path = path
+        self._elevations = {}
+        self._lock = threading.Lock()
+        # New entries start on a new line after a line cut short.
+        self._cut_short = False
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    fields = line.split()
+                    # A line cut short by an interrupted run is ignored.
+                    self._cut_short = not line.endswith('\n')
+                    if len(fields) == 2 and not self._cut_short:
+                        self._elevations[fields[0]] = float(fields[1])
+
+    def __contains__(self, key):
+        return key in self._elevations
+
+    def __len__(self):
+        return len(self._elevations)
+
+    def get(self, key, default=None):
+        """Return the cached elevation of a hash_location."""
+        return self._elevations.get(key, default)
+
+    def update(self, elevations):
+        """Add (hash_location, elevation) pairs and save them."""
+        elevations = list(elevations)
+        with self._lock:
+            self._elevations.update(elevations)
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    if self._cut_short:
+                        f.write('\n')
+                        self._cut_short = False
+                    f.writelines('{} {!r}\n'.format(key, elevation)
+                                 for key, elevation in elevations)
+
+
+def open_dem(path):
+    """Return a DemElevationProvider of a GeoTIFF or a raster with a .hdr."""
+    if path.lower().endswith(('.tif', '.tiff')):
+        return DemElevationProvider.from_geotiff(path)
+    return DemElevationProvider.from_header(path)
+
+
+_TIFF_TYPES = {1: 'B', 2: 's', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i',
+               11: 'f', 12: 'd', 16: 'Q'}
+
+
+def _read_tiff_tags(f):
+    """Return tag code => list of values of the first image of a TIFF.
+
+    The byte order of the file is stored under 'byte_order'. BigTIFF files
+    are supported.
+    """
+    byte_order = {'II': '<', 'MM': '>'}.get(f.read(2))
+    if byte_order is None:
+        raise ValueError('Not a TIFF file')
+    version, = struct.unpack(byte_order + 'H', f.read(2))
+    if version == 43:
+        big, count_format, entry_size = True, 'Q', 20
+        f.read(4)
+        first_ifd, = struct.unpack(byte_order + 'Q', f.read(8))
+    elif version == 42:
+        big, count_format, entry_size = False, 'H', 12
+        first_ifd, = struct.unpack(byte_order + 'I', f.read(4))
+    else:
+        raise ValueError('Not a TIFF file')
+
+    f.seek(first_ifd)
+    entries, = struct.unpack(byte_order + count_format,
+                             f.read(8 if big else 2))
+    directory = f.read(entries * entry_size)
+    tags = {'byte_order': byte_order}
+    for index in range(entries):
+        entry = directory[index * entry_size:(index + 1) * entry_size]
+        code, kind = struct.unpack(byte_order + 'HH', entry[:4])
+        if kind not in _TIFF_TYPES:
+            continue
+        count, = struct.unpack(byte_order + ('Q' if big else 'I'),
+                               entry[4:12 if big else 8])
+        value_format = _TIFF_TYPES[kind]
+        size = struct.calcsize(value_format) * count
+        inline = entry[12:] if big else entry[8:]
+        if size <= len(inline):
+            data = inline[:size]
+        else:
+            position = f.tell()
+            f.seek(struct.unpack(byte_order + ('Q' if big else 'I'),
+                                 inline)[0])
+            data = f.read(size)
+            f.seek(position)
+        if value_format == 's':
+            # Text tags such as GDAL_NODATA hold a number as ASCII.
+            text = data.rstrip('\0').strip()
+            try:
+                tags[code] = float(text)
+            except ValueError:
+                pass
+            continue
+        tags[code] = list(struct.unpack(
+            '{}{}{}'.format(byte_order, count, value_format), data))
+    return tags
@@ -16,22 +16,39 @@ def remove_unused_properties(feature):
     return feature
 
 
-def add_altitude_property(feature, height_offset=0.0):
+def add_altitude_property(feature, height_offset=0.0, provider=None):
     """Return the feature with updated elevation data.
 
+    The altitude is added to the coordinates of a Point, or to both ends of
+    a LineString.
     :param feature: Identifier assigned to the object.
     :type feature: geojson.Feature
+    :param provider: source of the elevation, the online elevation API of
+        utilities.get_altitude when not given
+    :type provider: elevation.ElevationProvider
     """
-    if isinstance(feature.geometry, geojson.Point):
-        lng, lat = feature.coordinates[0:2]
-    elif isinstance(feature.geometry, geojson.LineString):
-        coord1, coord2 = feature.coordinates[0:2]
-
-        try:
+    def with_altitude(coordinates):
+        """Return [lng, lat, alt] of [lng, lat] coordinates."""
+        lng, lat = coordinates[0:2]
+        if provider is None:
             alt = utilities.get_altitude(lat, lng, height_offset)
-            feature.geometry['coordinates'] = [lng, lat, alt]
-        except:
-            print('ERROR: Requesting altitude data')
+        else:
+            alt = provider.elevation(lat, lng) + height_offset
+            if alt != alt:  # NaN, no elevation data.
+                raise ValueError('No elevation data at {},{}'.format(lat, lng))
+            alt = float('{:.1f}'.format(alt))
+        return [lng, lat, alt]
+
+    try:
+        if isinstance(feature.geometry, geojson.Point):
+            feature.geometry = geojson.Point(
+                with_altitude(feature.geometry.coordinates))
+        elif isinstance(feature.geometry, geojson.LineString):
+            feature.geometry = geojson.LineString([
+                with_altitude(coordinates)
+                for coordinates in feature.geometry.coordinates[0:2]])
+    except (IOError, KeyError, IndexError, ValueError) as error:
+        print('ERROR: Requesting altitude data: {}'.format(error))
     return feature
 
 
@@ -70,8 +87,9 @@ def add_length_property(feature):
         try:
             coords1, coords2 = feature.geometry.coordinates
         except:
-            coords1, coords2 = '0.0,0.0', '0.0,0.0'
+            coords1, coords2 = (0.0, 0.0), (0.0, 0.0)
 
-        length = utilities.distance(coords1, coords2)
+        # GeoJSON coordinates are (lng, lat), distance() reads (lat, lng).
+        length = utilities.distance(coords1[1::-1], coords2[1::-1])
         feature.properties['length'] = length
     return feature
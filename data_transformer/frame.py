@@ -0,0 +1,296 @@
+"""Columnar snapshots of deployment data for analytics and reports.
+
+A Frame holds sites and links as parallel NumPy arrays instead of one object
+per feature, so summaries over a whole design run as array operations.
+Property columns are dictionary encoded: every distinct value is stored once
+and rows hold an integer code into the list of distinct values.
+"""
+
+import numpy as np
+import utilities
+
+
+class EncodedColumn(object):
+    """Dictionary encoded column of property values.
+
+    codes[i] is the position of the value of row i in categories, or -1 when
+    the row has no value for the column.
+    """
+
+    def __init__(self, values):
+        """Encode a sequence of values, None marking rows without a value."""
+        lookup = {}
+        self.categories = []
+        self.codes = np.empty(len(values), dtype=np.int32)
+        for index, value in enumerate(values):
+            if value is None:
+                self.codes[index] = -1
+                continue
+            key = value
+            try:
+                code = lookup.get(key)
+            except TypeError:
+                key = repr(value)
+                code = lookup.get(key)
+            if code is None:
+                code = lookup[key] = len(self.categories)
+                self.categories.append(value)
+            self.codes[index] = code
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def present(self):
+        """Return a boolean array of the rows that have a value."""
+        return self.codes >= 0
+
+    def value(self, row):
+        """Return the value of one row, None if the row has no value."""
+        code = self.codes[row]
+        return self.categories[code] if code >= 0 else None
+
+    def counts(self):
+        """Return the number of rows holding each category."""
+        codes = self.codes[self.codes >= 0]
+        return np.bincount(codes, minlength=len(self.categories))
+
+    def map(self, function, dtype=float, missing=0):
+        """Return function(value) of every row as an array.
+
+        function is called once per distinct value rather than once per row.
+        :param missing: result for rows without a value
+        """
+        mapped = np.array([function(value) for value in self.categories] +
+                          [missing], dtype=dtype)
+        return mapped[self.codes]
+
+    def take(self, rows):
+        """Return a new column holding only the given rows."""
+        column = EncodedColumn(())
+        column.categories = self.categories
+        column.codes = self.codes[rows]
+        return column
+
+
+class Frame(object):
+    """Columnar snapshot of sites and links.
+
+    Sites are rows of site_ids, latitudes and longitudes. Links are rows of
+    link_ids, lengths and the row numbers of their source and destination
+    sites, -1 for an endpoint that is not a site of the frame. Every other
+    property is an EncodedColumn in site_columns or link_columns.
+    """
+
+    def __init__(self, site_ids, latitudes, longitudes, site_columns,
+                 link_ids, sources, destinations, lengths, link_columns):
+        """Initilize the Frame from prebuilt arrays, see Frame.build."""
+        self.site_ids = site_ids
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.site_columns = site_columns
+        self.link_ids = link_ids
+        self.sources = sources
+        self.destinations = destinations
+        self.lengths = lengths
+        self.link_columns = link_columns
+
+    @classmethod
+    def build(cls, sites, links):
+        """Build a Frame from plain site and link rows.
+
+        :param sites: (site_id, latitude, longitude, properties) per site
+        :type sites: iterable
+        :param links: (link_id, source_id, destination_id, properties) per
+            link. A 'length' property is parsed into the lengths array, NaN
+            where it is missing or not a number.
+        :type links: iterable
+        """
+        sites, links = list(sites), list(links)
+        site_rows = {site[0]: row for row, site in enumerate(sites)}
+
+        def columns(rows, properties_index):
+            """Dictionary encode every property of a list of rows."""
+            values = {}
+            for row, record in enumerate(rows):
+                for name, value in record[properties_index]:
+                    if name not in values:
+                        values[name] = [None] * len(rows)
+                    values[name][row] = value
+            return {name: EncodedColumn(column)
+                    for name, column in values.iteritems()}
+
+        def length(properties):
+            """Parse the length property of a link."""
+            try:
+                return float(dict(properties)['length'])
+            except (KeyError, TypeError, ValueError):
+                return np.nan
+
+        return cls(
+            site_ids=np.array([site[0] for site in sites], dtype=object),
+            latitudes=np.array([site[1] for site in sites], dtype=float),
+            longitudes=np.array([site[2] for site in sites], dtype=float),
+            site_columns=columns(sites, 3),
+            link_ids=np.array([link[0] for link in links], dtype=object),
+            sources=np.array([site_rows.get(link[1], -1) for link in links],
+                             dtype=np.int64),
+            destinations=np.array([site_rows.get(link[2], -1)
+                                   for link in links], dtype=np.int64),
+            lengths=np.array([length(link[3]) for link in links],
+                             dtype=float),
+            link_columns=columns(links, 3))
+
+    @classmethod
+    def from_features(cls, sites, links):
+        """Build a Frame from site and link geojson.Features."""
+        return cls.build(
+            sites=[(site.id, site.geometry.coordinates[1],
+                    site.geometry.coordinates[0],
+                    site.properties.items()) for site in sites],
+            links=[(link.id, link.properties.get('source_id'),
+                    link.properties.get('destination_id'),
+                    link.properties.items()) for link in links])
+
+    @property
+    def site_count(self):
+        return len(self.site_ids)
+
+    @property
+    def link_count(self):
+        return len(self.link_ids)
+
+    def degrees(self):
+        """Return the number of links attached to every site.
+
+        A link from a site to itself is counted once.
+        """
+        size = self.site_count
+        sources = self.sources[self.sources >= 0]
+        destinations = self.destinations[(self.destinations >= 0) &
+                                         (self.destinations != self.sources)]
+        return (np.bincount(sources, minlength=size) +
+                np.bincount(destinations, minlength=size))
+
+    def select_sites(self, rows):
+        """Return a Frame of the given site rows and the links between them.
+
+        :param rows: boolean mask or row numbers of the sites to keep
+        """
+        rows = np.arange(self.site_count)[rows]
+        new_rows = np.full(self.site_count + 1, -1, dtype=np.int64)
+        new_rows[rows] = np.arange(len(rows))
+        # Endpoint -1 reads the trailing -1 so missing sites stay missing.
+        sources, destinations = new_rows[self.sources], \
+            new_rows[self.destinations]
+        links = ((sources >= 0) | (self.sources < 0)) & \
+            ((destinations >= 0) | (self.destinations < 0))
+
+        return Frame(
+            site_ids=self.site_ids[rows],
+            latitudes=self.latitudes[rows],
+            longitudes=self.longitudes[rows],
+            site_columns={name: column.take(rows)
+                          for name, column in self.site_columns.iteritems()},
+            link_ids=self.link_ids[links],
+            sources=sources[links],
+            destinations=destinations[links],
+            lengths=self.lengths[links],
+            link_columns={name: column.take(links)
+                          for name, column in self.link_columns.iteritems()})
+
+    def connected(self):
+        """Return a Frame of only the sites with at least one link."""
+        return self.select_sites(self.degrees() > 0)
+
+    def edges_per_node(self):
+        """Return {number of links: number of sites} for connected sites."""
+        counts = np.bincount(self.degrees())
+        return {degree: int(count) for degree, count in enumerate(counts)
+                if degree and count}
+
+    def length_buckets(self, thresholds):
+        """Count the links in each length bucket.
+
+        Bucket 0 holds links longer than 0m and shorter than thresholds[0],
+        bucket i links between thresholds[i - 1] and thresholds[i], and the
+        last bucket links longer than thresholds[-1]. Links with no length or
+        a length exactly on a threshold are not counted.
+
+        Only two counters are kept per threshold, the links shorter than it
+        and the links on it, and the buckets are their differences.
+        :param thresholds: ascending lengths in meters, such as (100, 175)
+        :returns: list of len(thresholds) + 1 counts
+        """
+        lengths = self.lengths[~np.isnan(self.lengths)]
+        lengths = lengths[lengths > 0]
+        below, on = [0], [0]
+        for threshold in thresholds:
+            below.append(np.count_nonzero(lengths < threshold))
+            on.append(np.count_nonzero(lengths == threshold))
+        below.append(len(lengths))
+        return [int(upper - lower - on_lower) for lower, upper, on_lower in
+                zip(below, below[1:], on)]
+
+    def length_extremes(self):
+        """Return the rows of the shortest and longest link.
+
+        Ties go to the earliest row for the shortest link and the latest row
+        for the longest link. Links without a length are ignored.
+        """
+        rows = np.flatnonzero(~np.isnan(self.lengths))
+        if not len(rows):
+            return None, None
+        lengths = self.lengths[rows]
+        return (int(rows[np.argmin(lengths)]),
+                int(rows[len(rows) - 1 - np.argmax(lengths[::-1])]))
+
+    def bom_counts(self):
+        """Total the devices listed in the bill_of_materials of every site.
+
+        Each distinct bill of materials is parsed once and weighted by the
+        number of sites sharing it.
+        :returns: dict of device counts and the number of sites whose bill of
+            materials is missing or 'unknown'
+        """
+        column = self.site_columns.get('bill_of_materials')
+        if column is None:
+            column = EncodedColumn([None] * self.site_count)
+
+        def devices(bom):
+            """Return [client, primary, secondary, odroid, unknown] counts."""
+            bom = bom.lower()
+            if bom == 'unknown':
+                return [0, 0, 0, 0, 1]
+            dn = bom.count('dn')
+            return [bom.count('cn'), min(dn, 1), max(dn - 1, 0),
+                    bom.count('odroid'), 0]
+
+        per_category = np.array([devices(bom) for bom in column.categories],
+                                dtype=np.int64).reshape(-1, 5)
+        totals = column.counts().dot(per_category)
+        missing = int(np.count_nonzero(~column.present))
+        return {'client_devices': int(totals[0]),
+                'primary_devices': int(totals[1]),
+                'secondary_devices': int(totals[2]),
+                'odroid_devices': int(totals[3]),
+                'sites_missing_data': int(totals[4]) + missing}
+
+    def missing_fields(self, site_fields, link_fields):
+        """Return (id, missing field names) for every site and link."""
+        def missing(ids, columns, fields):
+            present = [(field, columns[field].present) if field in columns
+                       else (field, np.zeros(len(ids), dtype=bool))
+                       for field in fields]
+            for row, item_id in enumerate(ids):
+                yield item_id, [field for field, mask in present
+                                if not mask[row]]
+
+        return (list(missing(self.site_ids, self.site_columns, site_fields)) +
+                list(missing(self.link_ids, self.link_columns, link_fields)))
+
+    def close_sites(self, radius=1.0):
+        """Return groups of site ids chained within radius meters."""
+        return utilities.cluster_locations(
+            zip(self.site_ids.tolist(), self.latitudes.tolist(),
+                self.longitudes.tolist()), radius=radius)
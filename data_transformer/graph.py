@@ -0,0 +1,211 @@
+"""Compact graph of the sites and links of a design.
+
+A Graph numbers sites 0..N-1 and stores the links as compressed sparse rows
+(CSR): the neighbours of site i are targets[offsets[i]:offsets[i + 1]]. Every
+link is stored in both directions, so the graph is undirected. A link from a
+site to itself is stored once, so it counts as one link like in Frame.degrees.
+"""
+
+import itertools
+import numpy as np
+from collections import deque
+
+# Sites whose site_type is one of POP_VALUES, compared without case, are the
+# points of presence hop counts are measured from.
+POP_COLUMN = 'site_type'
+POP_VALUES = ('pop',)
+
+# Site properties set by site_properties.
+SITE_PROPERTIES = ('component_id', 'hops_to_pop', 'island')
+
+
+class Graph(object):
+    """Undirected graph of integer indexed sites in CSR form."""
+
+    def __init__(self, node_ids, offsets, targets):
+        """Initilize the Graph from prebuilt arrays, see Graph.build.
+
+        :param node_ids: id of every site, in row order
+        :param offsets: N + 1 positions of the first neighbour of each site
+        :param targets: rows of the neighbours of all sites
+        """
+        self.node_ids = node_ids
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def build(cls, node_ids, sources, destinations):
+        """Build a Graph from the endpoint rows of links.
+
+        Links with an endpoint of -1 are left out.
+        :param node_ids: id of every site, in row order
+        :param sources: source row of every link
+        :param destinations: destination row of every link
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        destinations = np.asarray(destinations, dtype=np.int64)
+        keep = (sources >= 0) & (destinations >= 0)
+        reverse = keep & (sources != destinations)
+        ends = np.concatenate([sources[keep], destinations[reverse]])
+        other_ends = np.concatenate([destinations[keep], sources[reverse]])
+
+        order = np.argsort(ends, kind='mergesort')
+        counts = np.bincount(ends, minlength=len(node_ids))
+        offsets = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(np.asarray(node_ids, dtype=object), offsets,
+                   other_ends[order])
+
+    @classmethod
+    def from_frame(cls, frame):
+        """Build the Graph of the sites and links of a Frame."""
+        return cls.build(frame.site_ids, frame.sources, frame.destinations)
+
+    @property
+    def node_count(self):
+        return len(self.node_ids)
+
+    @property
+    def edge_count(self):
+        rows = np.repeat(np.arange(self.node_count), self.degrees())
+        loops = np.count_nonzero(self.targets == rows)
+        return (len(self.targets) + loops) // 2
+
+    def degrees(self):
+        """Return the number of links of every site.
+
+        A link from a site to itself is counted once.
+        """
+        return np.diff(self.offsets)
+
+    def neighbors(self, rows):
+        """Return the rows of every neighbour of the given rows.
+
+        Rows reached from more than one of the given rows are repeated.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        counts = self.offsets[rows + 1] - starts
+        # Position of every neighbour: the start of its row plus its rank
+        # within the row.
+        ranks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                    counts)
+        return self.targets[np.repeat(starts, counts) + ranks]
+
+    def components(self):
+        """Return the connected component number of every site.
+
+        Components are numbered from 0 in the order of their first site.
+        Every site and link is visited once.
+        """
+        offsets, targets = self.offsets.tolist(), self.targets.tolist()
+        labels = [-1] * self.node_count
+        component = 0
+        for start in range(self.node_count):
+            if labels[start] >= 0:
+                continue
+            labels[start] = component
+            queue = deque([start])
+            while queue:
+                row = queue.popleft()
+                for target in targets[offsets[row]:offsets[row + 1]]:
+                    if labels[target] < 0:
+                        labels[target] = component
+                        queue.append(target)
+            component += 1
+        return np.array(labels, dtype=np.int64)
+
+    def hops(self, sources):
+        """Return the number of links between every site and the nearest
+        source site, -1 for sites no source reaches.
+
+        The breadth first search expands a whole level at a time.
+        :param sources: rows of the sites to count from, such as POPs
+        """
+        hops = np.full(self.node_count, -1, dtype=np.int64)
+        frontier = np.unique(np.asarray(sources, dtype=np.int64))
+        hops[frontier] = 0
+        level = 0
+        while len(frontier):
+            level += 1
+            reached = self.neighbors(frontier)
+            frontier = np.unique(reached[hops[reached] < 0])
+            hops[frontier] = level
+        return hops
+
+    def islands(self, pops, labels=None):
+        """Return the groups of linked sites cut off from every POP.
+
+        Sites without any link are not part of a group. Without POPs every
+        group but the largest is an island.
+        :param pops: boolean mask of the POP sites
+        :param labels: components() if already computed
+        :returns: list of site id tuples ordered by their first id
+        """
+        labels = self.components() if labels is None else labels
+        linked = self.degrees() > 0
+        if not linked.any():
+            return []
+        sizes = np.bincount(labels[linked], minlength=labels.max() + 1)
+        connected = np.zeros(len(sizes), dtype=bool)
+        pops = np.asarray(pops, dtype=bool)
+        if pops.any():
+            connected[labels[pops]] = True
+        else:
+            connected[np.argmax(sizes)] = True
+
+        island_rows = np.flatnonzero(linked & ~connected[labels])
+        groups = {}
+        for row in island_rows.tolist():
+            groups.setdefault(labels[row], []).append(self.node_ids[row])
+        return sorted(tuple(sorted(ids)) for ids in groups.values())
+
+
+def is_pop(value, pop_values=POP_VALUES):
+    """Return True if a POP_COLUMN value marks a POP site.
+
+    :param value: property value of the site, None if missing
+    :param pop_values: values marking a POP, compared without case
+    """
+    if value is None:
+        return False
+    return str(value).lower() in set(str(pop).lower() for pop in pop_values)
+
+
+def frame_pops(frame, pop_column=POP_COLUMN, pop_values=POP_VALUES):
+    """Return a boolean mask of the POP sites of a Frame."""
+    column = frame.site_columns.get(pop_column)
+    if column is None:
+        return np.zeros(frame.site_count, dtype=bool)
+    return column.map(lambda value: is_pop(value, pop_values), dtype=bool,
+                      missing=False)
+
+
+def site_properties(graph, pops):
+    """Return the graph properties of every linked site.
+
+    component_id numbers the groups of linked sites from 0 in the order of
+    their first site, hops_to_pop is left out for sites no POP reaches and
+    island is True for sites cut off from every POP, see Graph.islands.
+    :param graph: graph of the design
+    :type graph: Graph
+    :param pops: boolean mask of the POP sites
+    :returns: {site id: {property name: value}}
+    """
+    labels = graph.components()
+    linked = graph.degrees() > 0
+    components = np.unique(labels[linked], return_inverse=True)[1]
+    hops = graph.hops(np.flatnonzero(pops))
+    island_ids = set(itertools.chain.from_iterable(
+        graph.islands(pops, labels=labels)))
+
+    properties = {}
+    rows = np.flatnonzero(linked)
+    for row, component in zip(rows.tolist(), components.tolist()):
+        site_id = graph.node_ids[row]
+        values = {'component_id': component,
+                  'island': site_id in island_ids}
+        if hops[row] >= 0:
+            values['hops_to_pop'] = hops[row].item()
+        properties[site_id] = values
+    return properties
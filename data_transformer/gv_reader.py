@@ -0,0 +1,258 @@
+"""Stream graph records out of GraphViz documents.
+
+Parses the subset of the DOT language used for deployment designs without
+building a graph object model. Statements are turned into plain site and link
+records as they are read so large .gv files can be loaded in one pass.
+"""
+
+import re
+
+
+class DotSyntaxError(ValueError):
+    """Raised for DOT syntax outside of the supported subset."""
+
+
+_KEYWORDS = ('strict', 'graph', 'digraph', 'subgraph', 'node', 'edge')
+
+_TOKEN = re.compile(r'''
+    (?P<space>\s+)
+    | (?P<comment>//.*)
+    | (?P<block>/\*)
+    | (?P<quote>")
+    | (?P<edgeop>--|->)
+    | (?P<punct>[{}\[\]=;,:])
+    | (?P<id>[A-Za-z_\x80-\xff][\w\x80-\xff]*
+        |[0-9]+[A-Za-z_\x80-\xff][\w\x80-\xff]*)
+    | (?P<numeral>-?(?:\.[0-9]+|[0-9]+(?:\.[0-9]*)?))
+    ''', re.VERBOSE)
+
+# Characters that may not directly follow a numeral.
+_AFTER_NUMERAL = re.compile(r'[\w.\x80-\xff]')
+
+# Ids that can be written without quotes.
+_PLAIN_ID = re.compile(r'[A-Za-z_][A-Za-z_0-9]*\Z')
+
+
+def format_id(value):
+    """Return a value as a DOT id, quoted unless it is a plain identifier.
+
+    Keywords and values with spaces, hyphens or a leading digit are quoted.
+    """
+    value = str(value)
+    if _PLAIN_ID.match(value) and value.lower() not in _KEYWORDS:
+        return value
+    return '"{}"'.format(value.replace('"', '\\"'))
+
+
+def tokenize(lines):
+    """Yield (kind, value) tokens from an iterable of DOT lines.
+
+    Kinds are 'id' for identifiers and numerals, 'string' for quoted strings,
+    'edgeop' for -- and ->, and the punctuation character itself for
+    punctuation. Comments and preprocessor style '#' lines are skipped.
+
+    Site ids such as 12L198 start with a digit. Like pydot, an unquoted id
+    of digits followed by letters, digits and underscores is read as one id
+    rather than the numeral 12 followed by the id L198. Other numerals that
+    run into an id, such as -12L198 or 1.5e3, are rejected.
+    """
+    in_block = False
+    quoted = None
+    for line_number, line in enumerate(lines, 1):
+        position = 0
+        if quoted is None and not in_block and line.lstrip().startswith('#'):
+            continue
+        while position < len(line):
+            if in_block:
+                end = line.find('*/', position)
+                if end == -1:
+                    break
+                in_block, position = False, end + 2
+                continue
+
+            if quoted is not None:
+                end = position
+                while end < len(line) and line[end] != '"':
+                    end += 2 if line[end] == '\\' else 1
+                if end >= len(line):
+                    quoted.append(line[position:])
+                    break
+                quoted.append(line[position:end])
+                value = ''.join(quoted).replace('\\"', '"')
+                # A trailing backslash continues a quoted string on the next
+                # line without a line break.
+                yield 'string', value.replace('\\\n', '').replace('\\\r\n',
+                                                             '')
+                quoted, position = None, end + 1
+                continue
+
+            match = _TOKEN.match(line, position)
+            if match is None:
+                raise DotSyntaxError('Unsupported syntax on line {}: {}'
+                                     ''.format(line_number, line.strip()))
+            position = match.end()
+            kind = match.lastgroup
+            if kind == 'numeral':
+                if _AFTER_NUMERAL.match(line, position):
+                    raise DotSyntaxError('Unsupported id on line {}: {}'
+                                         ''.format(line_number, line.strip()))
+                kind = 'id'
+            if kind in ('space', 'comment'):
+                continue
+            elif kind == 'block':
+                in_block = True
+            elif kind == 'quote':
+                quoted = []
+            elif kind == 'punct':
+                yield match.group(), match.group()
+            else:
+                yield kind, match.group()
+
+    if quoted is not None or in_block:
+        raise DotSyntaxError('Unterminated string or comment.')
+
+
+def _is(token, kind):
+    """Return True if a token is of a kind, counting strings as ids."""
+    return token[0] == kind or (kind == 'id' and token[0] == 'string')
+
+
+class _Parser(object):
+    """Recursive descent parser over a DOT token stream.
+
+    Quoted strings are accepted wherever an id is, but are never keywords.
+    """
+
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._next = next(self._tokens, None)
+
+    def _peek(self):
+        return self._next
+
+    def _take(self, kind=None):
+        token = self._next
+        if token is None or (kind is not None and not _is(token, kind)):
+            raise DotSyntaxError('Expected {} but found {}'.format(
+                kind or 'a statement', token[1] if token else 'end of file'))
+        self._next = next(self._tokens, None)
+        return token[1]
+
+    def _at(self, kind, keyword=None):
+        token = self._next
+        if token is None or not _is(token, kind):
+            return False
+        return keyword is None or (token[0] == 'id' and
+                                   token[1].lower() == keyword)
+
+    def graphs(self):
+        """Yield records for every graph in the stream."""
+        while self._peek() is not None:
+            if self._at('id', 'strict'):
+                self._take()
+            if not (self._at('id', 'graph') or self._at('id', 'digraph')):
+                raise DotSyntaxError('Expected graph or digraph but found {}'
+                                     ''.format(self._peek()[1]))
+            self._take()
+            if self._at('id'):
+                self._take()
+            for record in self._block({}, {}):
+                yield record
+
+    def _block(self, node_defaults, edge_defaults):
+        """Yield records for a braced statement list with its own scope."""
+        node_defaults, edge_defaults = dict(node_defaults), dict(edge_defaults)
+        self._take('{')
+        while not self._at('}'):
+            for record in self._statement(node_defaults, edge_defaults):
+                yield record
+            while self._at(';'):
+                self._take()
+        self._take('}')
+
+    def _statement(self, node_defaults, edge_defaults):
+        """Yield records for one statement and update the default scope."""
+        if self._at('{') or self._at('id', 'subgraph'):
+            if self._at('id', 'subgraph'):
+                self._take()
+                if self._at('id'):
+                    self._take()
+            for record in self._block(node_defaults, edge_defaults):
+                yield record
+            if self._at('edgeop'):
+                raise DotSyntaxError('Edges to subgraphs are not supported.')
+            return
+
+        if self._at('id', 'graph') or self._at('id', 'node') or \
+                self._at('id', 'edge'):
+            keyword = self._take().lower()
+            attributes = self._attributes()
+            if keyword == 'node':
+                node_defaults.update(attributes)
+            elif keyword == 'edge':
+                edge_defaults.update(attributes)
+            return
+
+        node_ids = [self._node_id()]
+        if self._at('='):
+            self._take()
+            self._take('id')  # Graph attribute assignment.
+            return
+        while self._at('edgeop'):
+            self._take()
+            if self._at('{') or self._at('id', 'subgraph'):
+                raise DotSyntaxError('Edges to subgraphs are not supported.')
+            node_ids.append(self._node_id())
+        attributes = self._attributes()
+
+        if len(node_ids) == 1:
+            if attributes:
+                record = dict(node_defaults)
+                record.update(attributes)
+                yield 'node', node_ids[0], record
+            return
+
+        record = dict(edge_defaults)
+        record.update(attributes)
+        for source_id, destination_id in zip(node_ids, node_ids[1:]):
+            yield 'edge', (source_id, destination_id), dict(record)
+
+    def _node_id(self):
+        """Return a node id, discarding any port."""
+        quoted = self._at('string')
+        node_id = self._take('id')
+        if not quoted and node_id.lower() in _KEYWORDS:
+            raise DotSyntaxError('Unexpected keyword {}'.format(node_id))
+        while self._at(':'):
+            self._take()
+            self._take('id')
+        return node_id
+
+    def _attributes(self):
+        """Return the attributes of any following [a=b, ...] lists."""
+        attributes = {}
+        while self._at('['):
+            self._take()
+            while not self._at(']'):
+                name = self._take('id')
+                value = 'true'
+                if self._at('='):
+                    self._take()
+                    value = self._take('id')
+                attributes[name] = value
+                while self._at(',') or self._at(';'):
+                    self._take()
+            self._take(']')
+        return attributes
+
+
+def iter_records(lines):
+    """Yield ('node', id, attributes) and ('edge', (a, b), attributes).
+
+    Records are yielded in document order for every graph in the document.
+    Node statements are only reported when they carry attributes, which
+    include any node defaults in scope. Edge chains such as a -- b -- c yield
+    one record per edge.
+    :raises DotSyntaxError: for syntax outside of the supported subset
+    """
+    return _Parser(tokenize(lines)).graphs()
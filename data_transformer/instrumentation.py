@@ -0,0 +1,251 @@
+"""Measure where a run spends its time and memory.
+
+Code marks the stages it runs with stage() or the measured decorator. Marks
+are only recorded while a Recorder is active, see recording(), so they cost
+next to nothing in other runs. Every stage records its wall time, the rows it
+handled and the rows per second, and the peak resident memory of the process
+while it ran, sampled only while a stage is open. A Recorder is written as a
+JSON timing report.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+# Seconds between two samples of the resident memory of the process.
+MEMORY_SAMPLE_INTERVAL = 0.1
+
+_active = None
+
+
+def resident_memory():
+    """Return the resident memory of this process in bytes, None if unknown.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def peak_resident_memory():
+    """Return the highest resident memory of this process in bytes so far,
+    None if unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if os.uname()[0] == 'Darwin' else peak * 1024
+
+
+class Stage(object):
+    """A running stage, handed to the body of a stage() block.
+
+    The body sets rows to the number of rows it handled so the rows per
+    second are reported.
+    """
+
+    def __init__(self, entry=None):
+        self._entry = entry
+        self.rows = None
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name == 'rows' and self._entry is not None:
+            self._entry['rows'] = value
+
+
+class Recorder(object):
+    """Collect the measurements of the stages of a run.
+
+    stages holds one entry per stage in the order the stages started. Nested
+    stages have the depth of their parent plus one. While any stage is open a
+    daemon thread samples the resident memory, so memory allocated and
+    released within a stage is caught.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.started = time.time()
+        self._open = []
+        # Guards the open entries shared with the sampling thread.
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._sampling = threading.Event()
+
+    def start_stage(self, name, **details):
+        """Start measuring a stage and return its entry."""
+        memory = resident_memory()
+        entry = OrderedDict([('stage', name)])
+        entry.update(sorted(details.items()))
+        entry.update([('depth', len(self._open)), ('seconds', None),
+                      ('rows', None), ('rows_per_second', None),
+                      ('peak_memory', memory)])
+        entry['_start'] = time.time()
+        entry['_peak_before'] = peak_resident_memory()
+        self.stages.append(entry)
+        with self._lock:
+            self._open.append(entry)
+        if len(self._open) == 1:
+            self._start_sampling()
+        return entry
+
+    def end_stage(self, entry):
+        """Stop measuring a stage started with start_stage."""
+        seconds = time.time() - entry.pop('_start')
+        with self._lock:
+            self._open.remove(entry)
+        if not self._open:
+            self._stop_sampling()
+        entry['seconds'] = round(seconds, 4)
+        if entry['rows'] is not None and seconds > 0:
+            entry['rows_per_second'] = round(entry['rows'] / seconds, 1)
+
+        peak_before = entry.pop('_peak_before')
+        peak = peak_resident_memory()
+        candidates = [entry['peak_memory'], resident_memory()]
+        # A stage that raised the high water mark of the process reached it.
+        if peak is not None and peak != peak_before:
+            candidates.append(peak)
+        entry['peak_memory'] = max(candidates) if any(
+            value is not None for value in candidates) else None
+
+    def record(self, name, seconds, rows=None, **details):
+        """Add a stage measured elsewhere, such as in a worker process."""
+        entry = OrderedDict([('stage', name)])
+        entry.update(sorted(details.items()))
+        entry.update([('depth', len(self._open)),
+                      ('seconds', round(seconds, 4)), ('rows', rows),
+                      ('rows_per_second', round(rows / seconds, 1)
+                       if rows is not None and seconds > 0 else None),
+                      ('peak_memory', None)])
+        self.stages.append(entry)
+
+    def stage_seconds(self):
+        """Return stage name => seconds of the stages that are not nested.
+
+        The seconds of stages run more than once are added up.
+        """
+        seconds = OrderedDict()
+        for entry in self.stages:
+            if entry['depth'] == 0 and entry['seconds'] is not None:
+                seconds[entry['stage']] = round(
+                    seconds.get(entry['stage'], 0) + entry['seconds'], 4)
+        return seconds
+
+    def _start_sampling(self):
+        """Sample the resident memory of open stages in a daemon thread."""
+        if self._sampler is not None or resident_memory() is None:
+            return
+        self._sampling.clear()
+
+        def sample():
+            while not self._sampling.wait(MEMORY_SAMPLE_INTERVAL):
+                memory = resident_memory()
+                with self._lock:
+                    for entry in self._open:
+                        if memory > entry['peak_memory']:
+                            entry['peak_memory'] = memory
+
+        self._sampler = threading.Thread(target=sample,
+                                         name='memory sampler')
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def _stop_sampling(self):
+        """Stop the thread started by _start_sampling."""
+        if self._sampler is not None:
+            self._sampling.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def as_plain_data(self):
+        """Return the timing report as builtin types."""
+        return OrderedDict([
+            ('total_seconds', round(time.time() - self.started, 4)),
+            ('peak_memory', peak_resident_memory()),
+            ('stages', [OrderedDict((k, v) for k, v in entry.items()
+                                    if not k.startswith('_'))
+                        for entry in self.stages])])
+
+    def write(self, file_path):
+        """Write the timing report to a JSON file."""
+        with open(file_path, 'w') as f:
+            json.dump(self.as_plain_data(), f, indent=4,
+                      separators=(',', ': '))
+            f.write('\n')
+
+
+def active():
+    """Return the active Recorder, None when nothing is recorded."""
+    return _active
+
+
+@contextlib.contextmanager
+def recording(recorder=None, profile_path=None):
+    """Record the stages run inside the block.
+
+    :param recorder: Recorder to add the stages to, a new one by default
+    :type recorder: Recorder
+    :param profile_path: also run cProfile over the block and save its
+        statistics to this path, to be read with the pstats module
+    :type profile_path: str
+    :returns: the active Recorder
+    """
+    global _active
+    recorder = recorder or Recorder()
+    previous, _active = _active, recorder
+    profiler = None
+    if profile_path:
+        import cProfile  # Only needed for profiling.
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield recorder
+    finally:
+        _active = previous
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+
+
+@contextlib.contextmanager
+def stage(name, **details):
+    """Measure the block as a stage of the active Recorder.
+
+    :param name: name of the stage
+    :param details: extra values of the entry, such as the file
+    :returns: Stage whose rows the block can set
+    """
+    recorder = _active
+    if recorder is None:
+        yield Stage()
+        return
+    entry = recorder.start_stage(name, **details)
+    try:
+        yield Stage(entry)
+    finally:
+        recorder.end_stage(entry)
+
+
+def measured(name):
+    """Decorate a function to measure every call as a stage."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,186 @@
+"""Write features as KML documents.
+
+lxml and pykml are only needed for KML output, so this module is loaded
+through the backends registry the first time a KML file is written.
+"""
+
+import collections
+from lxml import etree, objectify
+from pykml.factory import nsmap as KML_NAMESPACES
+from pykml.parser import Schema
+import StringIO
+
+
+_kml_schema = None
+
+
+def get_kml_schema():
+    """Return the KML schema, parsing it once for the life of the process."""
+    global _kml_schema
+    if _kml_schema is None:
+        _kml_schema = Schema('kml22gx.xsd')
+    return _kml_schema
+
+
+def export_to_kml(sites, links, validation='full'):
+    """Export site data to kml format.
+
+    Return an empty string if the document does not pass validation.
+    """
+    output = StringIO.StringIO()
+    if write_kml(output, sites=sites, links=links, validation=validation):
+        return output.getvalue()
+    return ''
+
+
+# Elements are built without a namespace and inherit the default kml
+# namespace declared once on the document root.
+KML = objectify.ElementMaker(annotate=False)
+
+
+def write_kml(file_obj, sites, links, validation='sample', chunk_size=100,
+              **options):
+    """Write site and link features to a file as a KML document.
+
+    Placemarks are built and written one at a time into a Sites folder and a
+    Links folder holding one folder per link data_source. Validation against
+    the KML schema can be:
+        'off': skipped.
+        'sample': only the first chunk_size placemarks of each folder are
+            validated.
+        'full': every placemark is validated, chunk_size at a time.
+    :param file_obj: writable file like object
+    :returns: False if any validated placemark is not valid KML
+    """
+    if validation not in ('off', 'sample', 'full'):
+        raise ValueError('Unknown KML validation mode {}'.format(validation))
+
+    link_source_folders = collections.defaultdict(list)
+    for link in links:
+        link_source_folders[link.properties.get('data_source', 'unknown')
+                            ].append(link)
+
+    results = {'valid': True}
+
+    def validate(chunk):
+        """Validate serialized placemarks as one KML folder."""
+        if not chunk:
+            return
+        schema = get_kml_schema()
+        document = etree.fromstring('<kml xmlns="{}"><Folder>{}</Folder></kml>'
+                                    ''.format(KML_NAMESPACES[None],
+                                              ''.join(chunk)))
+        if not schema.validate(document):
+            results['valid'] = False
+            print('KML validation failed: {}'.format(
+                schema.schema.error_log.last_error))
+
+    def write(element):
+        """Serialize an element to the file and return its text."""
+        text = etree.tostring(element, pretty_print=True)
+        file_obj.write(text)
+        return text
+
+    def write_placemarks(placemarks):
+        """Write placemarks and validate them according to the mode."""
+        chunk = []
+        for placemark in placemarks:
+            text = write(placemark)
+            if validation == 'off' or (validation == 'sample' and
+                                       len(chunk) >= chunk_size):
+                continue
+            chunk.append(text)
+            if validation == 'full' and len(chunk) >= chunk_size:
+                validate(chunk)
+                chunk = []
+        validate(chunk)
+
+    file_obj.write('<kml {}>\n<Document>\n'.format(' '.join(
+        'xmlns{}="{}"'.format(':' + prefix if prefix else '', uri)
+        for prefix, uri in sorted(KML_NAMESPACES.items()))))
+    write(KML.name('Export.kml'))
+    write(KML.open('1'))
+    write(_kml_site_style())
+    write(_kml_line_style())
+
+    file_obj.write('<Folder>\n')
+    write(KML.name('Sites'))
+    write_placemarks(_kml_site_placemark(site) for site in sites)
+    file_obj.write('</Folder>\n<Folder>\n')
+    write(KML.name('Links'))
+    for name in sorted(link_source_folders):
+        file_obj.write('<Folder>\n')
+        write(KML.name(name))
+        write_placemarks(_kml_link_placemark(link)
+                         for link in link_source_folders[name])
+        file_obj.write('</Folder>\n')
+    file_obj.write('</Folder>\n</Document>\n</kml>\n')
+
+    return results['valid']
+
+
+def _kml_extended_data(datadict):
+    """Convert a dictionary to ExtendedData/Data elements"""
+    edata = KML.ExtendedData()
+    for key, value in datadict.iteritems():
+        try:
+            edata.append(KML.Data(KML.value(value), name=key))
+        except:
+            print('Unable to add {}=>{} to object.'.format(key, value))
+    return edata
+
+
+def _kml_site_style():
+    """Return the style shared by all site placemarks."""
+    return KML.Style(
+        KML.IconStyle(
+            KML.scale(1.2),
+            KML.Icon(
+                KML.href('http://maps.google.com/mapfiles/kml/shapes/'
+                         'placemark_circle_highlight.png'),
+            ),
+            id='icon'),
+        KML.LineStyle(KML.color('00000000'), KML.width('15')),
+        id='site')
+
+
+def _kml_line_style():
+    """Return the style shared by all link placemarks."""
+    return KML.Style(
+        KML.LineStyle(KML.color('7fff0000'), KML.width('4')),
+        KML.PolyStyle(KML.color('7fff0000')),
+        id='link')
+
+
+def _kml_site_placemark(site):
+    """Return a KML.Placemark for a site feature."""
+    lat, lng = site.geometry.coordinates
+    return KML.Placemark(
+        KML.name(site.id),
+        KML.styleUrl('#site'),
+        _kml_extended_data(site.properties),
+        KML.Point(
+            KML.extrude('1'),
+            KML.altitudeMode('relativeToGround'),
+            KML.coordinates('{},{},12'.format(lat, lng))
+        ),
+    )
+
+
+def _kml_link_placemark(link):
+    """Return a KML.Placemark for a link feature."""
+    coords1, coords2 = link.geometry.coordinates
+    lat1, lng1 = coords1
+    lat2, lng2 = coords2
+    return KML.Placemark(
+        KML.name(link.id),
+        KML.styleUrl('#link'),
+        _kml_extended_data(link.properties),
+        KML.LineString(
+            KML.extrude('1'),
+            KML.altitudeMode('relativeToGround'),
+            KML.coordinates(
+                '{},{},6 '.format(lat1, lng1),
+                '{},{},6'.format(lat2, lng2))
+        ),
+    )
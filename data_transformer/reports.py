@@ -3,126 +3,363 @@
 Export formats for various information.
 """
 
+import backends
 import csv
-import lxml
-import geojson
-from pykml.parser import Schema
-from pykml.factory import KML_ElementMaker as KML
+import itertools
 import datetime
-import collections
-import utilities
+import heapq
+import instrumentation
+from frame import Frame
+import graph
+import gv_reader
+import numpy as np
 import os
+import StringIO
+from collections import OrderedDict
+
+
+# Link lengths in meters separating the short, medium and long links of the
+# design analysis.
+DEFAULT_LENGTH_THRESHOLDS = (100, 175)
+
+
+# Design layout formats export_all_files writes next to the reports by
+# default. Any format of backends.export_formats() can be requested.
+EXPORT_FORMATS = ('geojson', 'csv', 'kml')
+
+
+class ExportError(ValueError):
+    """Raised when design layouts fail validation.
+
+    The other export files are still written.
+    :param file_names: layouts that failed validation and were not written
+    :param written: paths of the files written
+    """
+
+    def __init__(self, file_names, written):
+        super(ExportError, self).__init__(
+            'Export failed validation: {}'.format(', '.join(file_names)))
+        self.file_names = file_names
+        self.written = written
+
+
+def export_all_files(to_folder, sites, links, frame=None,
+                     kml_validation='sample',
+                     length_thresholds=DEFAULT_LENGTH_THRESHOLDS,
+                     formats=EXPORT_FORMATS, ordered=False,
+                     pop_column=graph.POP_COLUMN, pop_values=graph.POP_VALUES):
+    """Wrap all other report functions for exporting files.
+
+    summary.txt and data_issues.txt are always written, followed by the
+    requested design layout formats. A layout is written to a temporary
+    file and only moved into place when its writer does not report it as
+    invalid, so a failed validation never leaves an invalid file behind.
+    :param frame: columnar snapshot of the same sites and links, such as
+        Datastore.to_frame(). It is built from the features when not provided.
+    :type frame: frame.Frame
+    :param kml_validation: 'off', 'sample' or 'full', see kml_writer.write_kml
+    :type kml_validation: str
+    :param length_thresholds: ascending link length bucket limits in meters
+    :type length_thresholds: tuple
+    :param formats: any of backends.export_formats()
+    :type formats: iterable
+    :param ordered: sites and links iterate in id order and can be iterated
+        more than once, like the views of a SQLiteDatastore. Features are
+        then streamed to the layout files instead of held in memory.
+    :type ordered: bool
+    :param pop_column: site property marking the POP sites
+    :type pop_column: str
+    :param pop_values: values of pop_column marking a POP, compared without
+        case
+    :type pop_values: tuple
+    :returns: paths of the files written
+    :raises ExportError: after writing the other files, if any layout
+        failed validation
+    """
+    unknown_formats = set(formats) - set(backends.export_formats())
+    if unknown_formats:
+        raise ValueError('Unknown export formats {}'.format(
+            ', '.join(sorted(unknown_formats))))
 
-
-def export_all_files(to_folder, sites, links):
-    """Wrap all other report functions for exporting files."""
-    # TODO: Refactor the as_geojson to align with the new classes in datastore.
-    sites = [s.as_geojson() for s in sites]
-    links = [l.as_geojson() for l in links]
     current_date = datetime.datetime.now().strftime('%Y-%m-%d')
     folder_path = os.path.join(to_folder, current_date)
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
 
-    adjacencies = utilities.get_adjacencies(edges=links, nodes=sites)
-    connected_sites = [site for site in sites if site.id in adjacencies.keys()]
-
-    with open(os.path.join(folder_path, 'summary.txt'), 'w') as f:
-        f.write(export_basic_report(sites=sites, links=links))
-
-    with open(os.path.join(folder_path, 'data_issues.txt'), 'w') as f:
-        f.write(export_data_issues_report(sites=sites, links=links))
-
-    with open(os.path.join(folder_path, 'design_layout.geojson'), 'w') as f:
-        f.write(export_to_geojson(sites=connected_sites, links=links))
-
-    export_sites_to_csv(
-        file_path=os.path.join(folder_path, 'aggregated_site_data.csv'),
-        sites=sites)
-
-    with open(os.path.join(folder_path, 'design_layout.kml'), 'w') as f:
-            f.write(export_to_kml(sites=connected_sites, links=links))
-
+    # Features are only serialized when a layout format or the frame needs
+    # them, so a reports only run never loads the geojson backend.
+    if ordered:
+        records = sites
+        sites, links = _Features(records), _Features(links)
+    elif formats or frame is None:
+        # TODO: Refactor the as_geojson to align with the new classes in
+        # datastore.
+        with instrumentation.stage('features') as stage:
+            sites = [s.as_geojson() for s in sites]
+            links = [l.as_geojson() for l in links]
+            stage.rows = len(sites) + len(links)
+    if frame is None:
+        frame = Frame.from_features(sites=sites, links=links)
+    connected = frame.connected()
+    connected_ids = set(connected.site_ids.tolist())
+    with instrumentation.stage('report_stats') as stage:
+        stats = ReportStats(connected, length_thresholds=length_thresholds,
+                            pop_column=pop_column, pop_values=pop_values)
+        stage.rows = stats.site_count + stats.link_count
+
+    written = []
+
+    def path(file_name):
+        """Return the path of an export file and record it as written."""
+        written.append(os.path.join(folder_path, file_name))
+        return written[-1]
+
+    with instrumentation.stage('write', file='summary.txt'), \
+            open(path('summary.txt'), 'w') as f:
+        f.write(export_basic_report(stats=stats))
+
+    with instrumentation.stage('write', file='data_issues.txt'), \
+            open(path('data_issues.txt'), 'w') as f:
+        f.write(export_data_issues_report(stats=stats))
+
+    if ordered:
+        connected_sites = _Features(records, connected_ids)
+    elif formats:
+        connected_sites = [site for site in sites if site.id in connected_ids]
+
+    invalid = []
+    for export_format in OrderedDict.fromkeys(formats):
+        file_name, all_sites = backends.export_file(export_format)
+        file_path = os.path.join(folder_path, file_name)
+        partial_path = file_path + '.partial'
+        try:
+            with instrumentation.stage('write', file=file_name), \
+                    open(partial_path, 'w') as f:
+                valid = backends.get_writer('.' + export_format)(
+                    f, sites if all_sites else connected_sites, links,
+                    ordered=ordered, validation=kml_validation)
+        except Exception:
+            os.remove(partial_path)
+            raise
+        if valid is False:
+            print('{} failed validation and was not written'.format(
+                file_name))
+            os.remove(partial_path)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            invalid.append(file_name)
+        else:
+            os.rename(partial_path, path(file_name))
+
+    if invalid:
+        raise ExportError(invalid, written)
     print('\nExports complete!')
-
-
-def export_basic_report(sites, links):
-    """Build a report based on sub reports."""
-    adjacency_list = utilities.get_adjacencies(edges=links, nodes=sites)
-    connected_sites = [site for site in sites
-                       if site.id in adjacency_list.keys()]
-
-    return (data_summary_report(sites=connected_sites, links=links) +
-            design_analysis_report(sites=connected_sites, links=links) +
-            material_requirements_report(sites=connected_sites))
-
-
-def export_data_issues_report(sites, links):
-    """Build a report based on sub reports."""
-    adjacency_list = utilities.get_adjacencies(edges=links, nodes=sites)
-    connected_sites = [site for site in sites
-                       if site.id in adjacency_list.keys()]
-
-    return (proximity_issue_report(sites=connected_sites, links=links) +
-            missing_data_fields_report(sites=connected_sites, links=links))
-
-
-def data_summary_report(sites, links):
+    return written
+
+
+class _Features(object):
+    """Re-iterable geojson.Features of an iterable of sites or links.
+
+    :param ids: only yield the features with these ids
+    :type ids: set
+    """
+
+    def __init__(self, records, ids=None):
+        self._records = records
+        self._ids = ids
+
+    def __iter__(self):
+        for record in self._records:
+            if self._ids is None or record.id in self._ids:
+                yield record.as_geojson()
+
+
+def _merge_ordered(*iterables):
+    """Merge features of iterables ordered by id into one ordered iterator.
+
+    Features with the same id are yielded in the order of the iterables,
+    matching a stable sort of their concatenation.
+    """
+    decorated = [((feature.id, index, feature) for feature in iterable)
+                 for index, iterable in enumerate(iterables)]
+    return (feature for _, _, feature in heapq.merge(*decorated))
+
+
+class ReportStats(object):
+    """Every statistic shown in summary.txt and data_issues.txt.
+
+    The statistics are collected once from a Frame of the connected sites and
+    shared by all of the sub reports, which only format them.
+    """
+
+    def __init__(self, frame, length_thresholds=DEFAULT_LENGTH_THRESHOLDS,
+                 proximity_radius=1.0, pop_column=graph.POP_COLUMN,
+                 pop_values=graph.POP_VALUES):
+        """Collect the statistics of a Frame.
+
+        :param frame: Frame holding only connected sites
+        :type frame: frame.Frame
+        :param length_thresholds: ascending link length bucket limits in
+            meters
+        :type length_thresholds: tuple
+        :param proximity_radius: sites closer than this many meters are
+            reported as possible duplicates
+        :type proximity_radius: float
+        :param pop_column: site property marking the POP sites hop counts
+            are measured from
+        :type pop_column: str
+        :param pop_values: values of pop_column marking a POP
+        :type pop_values: tuple
+        """
+        self.site_count = frame.site_count
+        self.link_count = frame.link_count
+        self.edges_per_node = frame.edges_per_node()
+
+        shortest, longest = frame.length_extremes()
+        self.shortest_link = self.longest_link = None
+        if shortest is not None:
+            self.shortest_link = (frame.link_ids[shortest],
+                                  frame.lengths[shortest].item())
+            self.longest_link = (frame.link_ids[longest],
+                                 frame.lengths[longest].item())
+        self.length_thresholds = tuple(length_thresholds)
+        self.length_buckets = frame.length_buckets(self.length_thresholds)
+
+        self.bom = frame.bom_counts()
+        self.missing_fields = frame.missing_fields(
+            site_fields=['bill_of_materials', 'status'],
+            link_fields=['length'])
+        self.proximity_radius = proximity_radius
+        self.close_sites = frame.close_sites(radius=proximity_radius)
+
+        design = graph.Graph.from_frame(frame)
+        labels = design.components()
+        linked = design.degrees() > 0
+        self.component_sizes = sorted(
+            [size for size in np.bincount(labels[linked]).tolist() if size],
+            reverse=True)
+        pops = graph.frame_pops(frame, pop_column, pop_values)
+        self.pop_column = pop_column
+        self.pop_values = tuple(pop_values)
+        self.pop_count = int(pops.sum())
+        hops = design.hops(np.flatnonzero(pops))
+        self.hop_counts = {hop: int(count)
+                           for hop, count in enumerate(np.bincount(
+                               hops[hops >= 0], minlength=1)) if count}
+        self.islands = design.islands(pops, labels=labels)
+
+
+def _report_stats(sites, links, frame, stats):
+    """Return the ReportStats a report is based on.
+
+    A provided frame is expected to hold only connected sites already.
+    """
+    if stats is None:
+        if frame is None:
+            frame = Frame.from_features(sites=sites, links=links).connected()
+        stats = ReportStats(frame)
+    return stats
+
+
+def export_basic_report(sites=None, links=None, frame=None, stats=None):
+    """Build a report based on sub reports.
+
+    Either the site and link features, a Frame of the connected sites or
+    precomputed ReportStats can be provided.
+    """
+    stats = _report_stats(sites, links, frame, stats)
+    return (data_summary_report(stats) +
+            design_analysis_report(stats) +
+            material_requirements_report(stats))
+
+
+def export_data_issues_report(sites=None, links=None, frame=None,
+                              stats=None):
+    """Build a report based on sub reports.
+
+    Either the site and link features, a Frame of the connected sites or
+    precomputed ReportStats can be provided.
+    """
+    stats = _report_stats(sites, links, frame, stats)
+    return (proximity_issue_report(stats) +
+            missing_data_fields_report(stats))
+
+
+def data_summary_report(stats):
     """Generate a report to communicate basic data imported."""
     return ('\n==Data Summary==\n'
             '  {total_num_sites} unique sites imported.\n'
             '  {total_num_links} unique links imported.\n'
-            ''.format(total_num_sites=len(sites),
-                      total_num_links=len(links)))
+            ''.format(total_num_sites=stats.site_count,
+                      total_num_links=stats.link_count))
 
 
-def design_analysis_report(sites, links):
+def design_analysis_report(stats):
     """Generate a report to communicate design related data."""
-    links_per_pole = utilities.get_edges_per_node(edges=links, nodes=sites)
-
     link_count_display = ''
-    for link_counts in links_per_pole.iteritems():
+    for link_counts in sorted(stats.edges_per_node.iteritems()):
         link_count_display += '    {} link sites: {}\n'.format(*link_counts)
 
-    avg_links_per_site = float(len(links))/float(len(sites)) * 2
-
-    link_lengths = [(link.id, link.properties['length']) for link in links]
-    link_lengths.sort(key=lambda x: x[1])
-
-    short_links = [l for l in links if l.properties['length'] < 100 and
-                   l.properties['length'] > 0]
+    avg_links_per_site = (float(stats.link_count) /
+                          float(stats.site_count or 1) * 2)
 
-    med_links = [l for l in links if l.properties['length'] < 175 and
-                 l.properties['length'] > 100]
-
-    long_links = [l for l in links if l.properties['length'] > 175]
+    if stats.longest_link is None:
+        extremes_display = '  No link lengths are known.\n'
+    else:
+        extremes_display = (
+            '  "{}" is the longest link at {}m.\n'
+            '  "{}" is the shortest link at {}m.\n'
+            ''.format(*(stats.longest_link + stats.shortest_link)))
+
+    thresholds = stats.length_thresholds
+    bucket_names = (['shorter than {:g}m'.format(thresholds[0])] +
+                    ['{:g}m to {:g}m'.format(lower, upper)
+                     for lower, upper in zip(thresholds, thresholds[1:])] +
+                    ['longer than {:g}m'.format(thresholds[-1])])
+    bucket_display = ''
+    for name, count in zip(bucket_names, stats.length_buckets):
+        bucket_display += '  {} links are {}.\n'.format(count, name)
+
+    network_display = ('  {} groups of connected sites, the largest holds {} '
+                       'sites.\n'.format(len(stats.component_sizes),
+                                          (stats.component_sizes or [0])[0]))
+    pop_selector = '{} of {}'.format(stats.pop_column,
+                                     ' or '.join(stats.pop_values))
+    if stats.pop_count:
+        network_display += ('  {} POP sites have a {}. Sites by hops to the '
+                            'nearest POP:\n'.format(stats.pop_count,
+                                                     pop_selector))
+        for hop_counts in sorted(stats.hop_counts.iteritems()):
+            network_display += '    {} hops: {}\n'.format(*hop_counts)
+        island_display = '  {} islands are cut off from every POP:\n'
+    else:
+        network_display += ('  No site has a {}, so hops to a POP are not '
+                            'known.\n'.format(pop_selector))
+        island_display = '  {} islands are outside the largest group:\n'
+    network_display += island_display.format(len(stats.islands))
+    for island in stats.islands:
+        network_display += '    {}\n'.format(', '.join(island))
 
     return ('\n==Design Analysis==\n'
             '  Average of {avg_links_per_site:.2f} links per site.\n'
             '  Breakdown of link connectivity per site:\n'
             '{link_connectivity_counts}\n'
-            '  "{longest_link}" is the longest link at {longest_link_len}m.\n'
-            '  "{shortest_link}" is the shortest link at {shortest_link_len}m.'
-            '\n\n'
-            '  {num_short_links} links are shorter than 100m.\n'
-            '  {num_med_links} links are 100m to 175m.\n'
-            '  {num_long_links} links are longer than 175m.\n'
+            '{link_extremes}\n'
+            '{link_buckets}\n'
+            '{network}'
             ''.format(link_connectivity_counts=link_count_display,
                       avg_links_per_site=avg_links_per_site,
-                      longest_link_len=link_lengths[-1][1],
-                      longest_link=link_lengths[-1][0],
-                      shortest_link_len=link_lengths[0][1],
-                      shortest_link=link_lengths[0][0],
-                      num_short_links=len(short_links),
-                      num_med_links=len(med_links),
-                      num_long_links=len(long_links)))
+                      link_extremes=extremes_display,
+                      link_buckets=bucket_display,
+                      network=network_display))
 
 
-def proximity_issue_report(sites, links):
+def proximity_issue_report(stats):
     """Generate a report to identify data issues"""
-    site_proximity_warning = ('  The lat/long site data places sites within a '
-                              'meter of each other:')
-    for close_sites in utilities.find_close_nodes(nodes=sites):
+    site_proximity_warning = ('  The lat/long site data places sites within '
+                              '{:g}m of each other:'
+                              ''.format(stats.proximity_radius))
+    for close_sites in stats.close_sites:
         site_proximity_warning += '    {}\n'.format(', '.join(close_sites))
 
     return ('\n==Location Proximity Data Issues==\n'
@@ -130,12 +367,10 @@ def proximity_issue_report(sites, links):
             ''.format(site_proximity_warning=site_proximity_warning))
 
 
-def missing_data_fields_report(sites, links):
+def missing_data_fields_report(stats):
     """Generate a report to identify data issues"""
-    data_gaps = utilities.get_missing_fields(nodes=sites, edges=links)
-
     missing_data_report = ('  These objects are missing data fileds:\n')
-    for item, missing_data in data_gaps.iteritems():
+    for item, missing_data in stats.missing_fields:
         missing_data_report += ('  {} is missing => {}\n'
                                 ''.format(item, ', '.join(missing_data)))
 
@@ -144,26 +379,9 @@ def missing_data_fields_report(sites, links):
             ''.format(missing_data_report=missing_data_report))
 
 
-def material_requirements_report(sites):
+def material_requirements_report(stats):
     """Generate a report based on BOM properties associated with the site."""
-    complete_bom = {'client_devices': 0,
-                    'primary_devices': 0,
-                    'secondary_devices': 0,
-                    'odroid_devices': 0}
-    sites_missing_data = []
-
-    for site in sites:
-        if site.properties['bill_of_materials'].lower() == 'unknown':
-            sites_missing_data.append(site.id)
-            continue
-        site_bom = site.properties['bill_of_materials'].lower()
-        complete_bom['client_devices'] += site_bom.count('cn')
-        complete_bom['odroid_devices'] += site_bom.count('odroid')
-        if site_bom.count('dn') > 1:
-            complete_bom['secondary_devices'] += site_bom.count('dn') - 1
-            complete_bom['primary_devices'] += 1
-        elif site_bom.count('dn') == 1:
-            complete_bom['primary_devices'] += 1
+    complete_bom = stats.bom
 
     return ('\n==Material Requirements==\n'
             'This section includes information based on what was defined in '
@@ -179,29 +397,67 @@ def material_requirements_report(sites):
                       secondary_devices=complete_bom['secondary_devices'],
                       client_devices=complete_bom['client_devices'],
                       odroids=complete_bom['odroid_devices'],
-                      num_sites_missing_data=len(sites_missing_data),
-                      total_sites=len(sites)))
+                      num_sites_missing_data=complete_bom[
+                          'sites_missing_data'],
+                      total_sites=stats.site_count))
 
 
 def export_to_geojson(sites, links=None):
     """Convert geojson.Features to an ordered geojson txt string."""
-    sites = sites + links
-    if isinstance(sites, list):
-        sites = [geojson.Feature(
-            id=site.id,
-            geometry=site.geometry,
-            properties=site.properties
-            ) for site in sites]
-
-        sites.sort(lambda x, y: cmp(x['id'], y['id']))
-        sites = geojson.FeatureCollection(sites)
-
-    return geojson.dumps(sites, sort_keys=True, indent=4,
-                         separators=(',', ': '))
+    output = StringIO.StringIO()
+    write_geojson(output, sites, links or [])
+    return output.getvalue()
+
+
+def write_geojson(file_obj, sites, links, ordered=False, **options):
+    """Write geojson.Features to a file as an ordered FeatureCollection.
+
+    Features are sorted by id and serialized one at a time straight to the
+    file, producing the same text as dumping the whole FeatureCollection with
+    sorted keys and an indent of 4.
+    :param file_obj: writable file like object
+    :param sites: geojson.Feature objects of the sites to write
+    :type sites: iterable
+    :param links: geojson.Feature objects of the links to write
+    :type links: iterable
+    :param ordered: sites and links are each already in id order and are
+        merged and streamed without being sorted
+    :type ordered: bool
+    """
+    import geojson  # Loaded on first use, see backends.
+    indent = '\n' + ' ' * 8
+    file_obj.write('{\n    "features": [')
+    if ordered:
+        features = _merge_ordered(sites, links)
+    else:
+        features = sorted(itertools.chain(sites, links),
+                          key=lambda feature: feature['id'])
+    index = -1
+    for index, feature in enumerate(features):
+        feature = geojson.Feature(id=feature.id,
+                                  geometry=feature.geometry,
+                                  properties=feature.properties)
+        text = geojson.dumps(feature, sort_keys=True, indent=4,
+                             separators=(',', ': '))
+        file_obj.write((',' if index else '') + indent +
+                       text.replace('\n', indent))
+    file_obj.write('\n    ],' if index >= 0 else '],')
+    file_obj.write('\n    "type": "FeatureCollection"\n}')
 
 
 def export_sites_to_csv(file_path, sites):
     """Export site data to csv format."""
+    with open(file_path, 'w') as csvfile:
+        write_sites_csv(csvfile, sites, [])
+
+
+def write_sites_csv(file_obj, sites, links, **options):
+    """Write one csv row per site feature, links are not written.
+
+    :param file_obj: writable file like object
+    :param sites: geojson.Feature objects of the sites, iterated twice
+    :type sites: iterable
+    """
     column_names = set()
     for site in sites:
         for property_name in site.properties:
@@ -212,110 +468,47 @@ def export_sites_to_csv(file_path, sites):
     column_names.insert(1, 'latitude')
     column_names.insert(2, 'longitude')
 
-    with open(file_path, 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=column_names)
-        writer.writeheader()
-        for site in sites:
-            row = {}
-            row['site_id'] = site.id
-            row['longitude'], row['latitude'] = site.geometry.coordinates
-            for name, value in site.properties.iteritems():
-                row[name] = value
-
-            writer.writerow(row)
-
-
-def export_to_kml(sites, links):
-    """Export site data to kml format."""
-
-    def makeExtendedDataElements(datadict):
-        """Convert a dictionary to ExtendedData/Data elements"""
-        edata = KML.ExtendedData()
-        for key, value in datadict.iteritems():
-            try:
-                edata.append(KML.Data(KML.value(value), name=key))
-            except:
-                print('Unable to add {}=>{} to object.'.format(key, value))
-        return edata
-
-    def makeFolder(name, placemarks):
-        """Add a list of KML.placemarks into to a folder."""
-        folder = KML.Folder(KML.name(name))
-        for placemark in placemarks:
-            folder.append(placemark)
-        return folder
-
-    site_folder = KML.Folder(KML.name("Sites"))
-    link_folder = KML.Folder(KML.name("Links"))
-    link_source_folders = collections.defaultdict(list)
-
-    site_style = KML.Style(
-        KML.IconStyle(
-            KML.scale(1.2),
-            KML.Icon(
-                KML.href('http://maps.google.com/mapfiles/kml/shapes/'
-                         'placemark_circle_highlight.png'),
-            ),
-            id='icon'),
-        KML.LineStyle(KML.color('00000000'), KML.width('15')),
-        id='site')
-
-    line_style = KML.Style(
-        KML.LineStyle(KML.color('7fff0000'), KML.width('4')),
-        KML.PolyStyle(KML.color('7fff0000')),
-        id='link')
-
+    writer = csv.DictWriter(file_obj, fieldnames=column_names)
+    writer.writeheader()
     for site in sites:
-        name = site.id
-        lat, lng = site.geometry.coordinates
-        kml_properties = makeExtendedDataElements(site.properties)
-        placemark = KML.Placemark(
-            KML.name(name),
-            KML.styleUrl('#site'),
-            kml_properties,
-            KML.Point(
-                KML.extrude('1'),
-                KML.altitudeMode('relativeToGround'),
-                KML.coordinates('{},{},12'.format(lat, lng))
-            ),
-        )
-        site_folder.append(placemark)
-
+        row = {}
+        row['site_id'] = site.id
+        row['longitude'], row['latitude'] = site.geometry.coordinates
+        for name, value in site.properties.iteritems():
+            row[name] = value
+
+        writer.writerow(row)
+
+
+def write_gv(file_obj, sites, links, graph_name='design', ordered=False,
+             **options):
+    """Write links to a file as a GraphViz graph readable by load_gv_file.
+
+    Every link is an edge between its source_id and destination_id, with its
+    other properties as edge attributes. The data_type and data_source are
+    left out, as load_gv_file sets them again. Ids, attribute names and
+    values are quoted unless they are plain DOT identifiers. Sites are not
+    written, they are expected to be loaded from their own files.
+    :param file_obj: writable file like object
+    :param links: geojson.Feature objects of the links to write
+    :type links: iterable
+    :param graph_name: name of the graph
+    :type graph_name: str
+    :param ordered: links are already in id order and are not sorted
+    :type ordered: bool
+    """
+    if not ordered:
+        links = sorted(links, key=lambda feature: feature['id'])
+    quote = gv_reader.format_id
+    excluded = ('source_id', 'destination_id', 'data_type', 'data_source')
+    file_obj.write('graph {} {{\n'.format(quote(graph_name)))
     for link in links:
-        name = link.id
-        coords1, coords2 = link.geometry.coordinates
-        lat1, lng1 = coords1
-        lat2, lng2 = coords2
-        kml_properties = makeExtendedDataElements(link.properties)
-        placemark = KML.Placemark(
-            KML.name(name),
-            KML.styleUrl('#link'),
-            kml_properties,
-            KML.LineString(
-                KML.extrude('1'),
-                KML.altitudeMode('relativeToGround'),
-                KML.coordinates(
-                    '{},{},6 '.format(lat1, lng1),
-                    '{},{},6'.format(lat2, lng2))
-            ),
-        )
-        source = link.properties.get('data_source', 'unknown')
-
-        link_source_folders[source].append(placemark)
-
-    for (name, placemarks) in link_source_folders.items():
-        link_folder.append(makeFolder(name, placemarks))
-
-    doc = KML.kml(
-        KML.Document(
-            KML.name('Export.kml'),
-            KML.open('1'),
-            site_style,
-            line_style,
-            site_folder,
-            link_folder))
-
-    if Schema('kml22gx.xsd').validate(doc):
-        return lxml.etree.tostring(doc, pretty_print=True)
-    else:
-        return ''
+        properties = link.properties
+        attributes = ', '.join('{}={}'.format(quote(name), quote(value))
+                               for name, value in sorted(properties.items())
+                               if name not in excluded and value != '')
+        file_obj.write('    {} -- {}{};\n'.format(
+            quote(properties['source_id']),
+            quote(properties['destination_id']),
+            ' [{}]'.format(attributes) if attributes else ''))
+    file_obj.write('}\n')
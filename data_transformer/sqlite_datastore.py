@@ -0,0 +1,784 @@
+"""
+Working data storage in a SQLite database.
+
+SQLiteDatastore keeps sites and links in a database file instead of memory,
+so designs larger than the available RAM can be aggregated and exported.
+Records are only materialized while they are streamed out of the database.
+"""
+import backends
+from datastore import (FileLoader, Link, Site, file_digest, link_geometry,
+                       row_site_id)
+from frame import Frame
+import graph
+import instrumentation
+import itertools
+import json
+import marshal
+import os
+import sqlite3
+import utilities
+from collections import OrderedDict
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sites (
+    row INTEGER PRIMARY KEY,
+    site_id TEXT NOT NULL UNIQUE,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    data_source,
+    status,
+    columns BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS sites_data_source ON sites (data_source);
+CREATE INDEX IF NOT EXISTS sites_status ON sites (status);
+CREATE VIRTUAL TABLE IF NOT EXISTS site_locations USING rtree (
+    row, min_latitude, max_latitude, min_longitude, max_longitude);
+CREATE TABLE IF NOT EXISTS links (
+    link_id TEXT PRIMARY KEY,
+    source_id TEXT NOT NULL,
+    destination_id TEXT NOT NULL,
+    data_source,
+    status,
+    columns BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS links_source_id ON links (source_id);
+CREATE INDEX IF NOT EXISTS links_destination_id ON links (destination_id);
+CREATE INDEX IF NOT EXISTS links_data_source ON links (data_source);
+CREATE INDEX IF NOT EXISTS links_status ON links (status);
+CREATE TABLE IF NOT EXISTS imports (
+    position INTEGER PRIMARY KEY,
+    source TEXT NOT NULL UNIQUE,
+    size INTEGER,
+    modified REAL,
+    sha1 TEXT,
+    loads TEXT);
+'''
+
+LINK_QUERY = '''
+SELECT links.link_id, links.source_id, links.destination_id,
+       sources.longitude, sources.latitude,
+       destinations.longitude, destinations.latitude, links.columns
+FROM links
+JOIN sites AS sources ON sources.site_id = links.source_id
+JOIN sites AS destinations ON destinations.site_id = links.destination_id
+'''
+
+
+class SQLiteDatastore(FileLoader):
+    """
+    Manage deployment data stored in a SQLite database.
+
+    The interface follows Datastore: data is loaded with add, add_many and
+    the load and import methods, and sites and links are read back as
+    records with the same id, get, items and as_geojson methods as Site and
+    Link. Reads stream from the database ordered by id.
+
+    Site ids are indexed and site coordinates are kept in an R*Tree, see
+    sites_within. Every data_weight and value of a record is stored with it,
+    so values are merged exactly like the in memory Datastore merges them.
+    Writes are buffered and written batch_size records at a time, and every
+    imported file is loaded in one transaction.
+    """
+
+    _indexed_properties = ('data_source', 'status')
+
+    def __init__(self, path, batch_size=1000):
+        """Open or create the database of a SQLiteDatastore.
+
+        :param path: database file, ':memory:' for a temporary database
+        :type path: str
+        :param batch_size: records buffered before they are written
+        :type batch_size: int
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._connection = sqlite3.connect(path)
+        self._connection.text_factory = str
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.executescript(SCHEMA)
+        self._next_row = self._scalar('SELECT COALESCE(MAX(row), 0) + 1 '
+                                      'FROM sites')
+        self._pending_sites = {}
+        self._pending_links = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is None:
+            self.commit()
+        self.close()
+
+    def commit(self):
+        """Write the buffered records and commit the current transaction."""
+        self._flush()
+        self._connection.commit()
+
+    def rollback(self):
+        """Drop the buffered records and undo the current transaction."""
+        self._pending_sites.clear()
+        self._pending_links.clear()
+        self._connection.rollback()
+        self._next_row = self._scalar('SELECT COALESCE(MAX(row), 0) + 1 '
+                                      'FROM sites')
+
+    def close(self):
+        """Close the database. Uncommitted changes are lost."""
+        self._connection.close()
+
+    def _scalar(self, query, parameters=()):
+        """Return the first column of the first row of a query."""
+        return self._connection.execute(query, parameters).fetchone()[0]
+
+    def _flush(self):
+        """Write the buffered sites and links to the database."""
+        # Stored rows are updated in place rather than replaced, so only the
+        # indexes of changed columns are written.
+        if self._pending_sites:
+            new, stored, moved = [], [], []
+            for site_id, (row, latitude, longitude, columns, location) in \
+                    self._pending_sites.iteritems():
+                values = (latitude, longitude,
+                          _indexed(columns, 'data_source'),
+                          _indexed(columns, 'status'),
+                          sqlite3.Binary(marshal.dumps(columns)), row)
+                if location is None:
+                    new.append((site_id,) + values)
+                else:
+                    stored.append(values)
+                    if location != (latitude, longitude):
+                        moved.append((latitude, latitude, longitude,
+                                      longitude, row))
+            self._connection.executemany(
+                'INSERT INTO sites (site_id, latitude, longitude, data_source, '
+                'status, columns, row) VALUES (?, ?, ?, ?, ?, ?, ?)', new)
+            self._connection.executemany(
+                'UPDATE sites SET latitude = ?, longitude = ?, '
+                'data_source = ?, status = ?, columns = ? WHERE row = ?',
+                stored)
+            self._connection.executemany(
+                'INSERT INTO site_locations (min_latitude, max_latitude, '
+                'min_longitude, max_longitude, row) VALUES (?, ?, ?, ?, ?)',
+                [(values[1], values[1], values[2], values[2], values[-1])
+                 for values in new])
+            self._connection.executemany(
+                'UPDATE site_locations SET min_latitude = ?, '
+                'max_latitude = ?, min_longitude = ?, max_longitude = ? '
+                'WHERE row = ?', moved)
+            self._pending_sites.clear()
+        if self._pending_links:
+            new, stored = [], []
+            for link_id, (source_id, destination_id, columns, is_stored) in \
+                    self._pending_links.iteritems():
+                values = (_indexed(columns, 'data_source'),
+                          _indexed(columns, 'status'),
+                          sqlite3.Binary(marshal.dumps(columns)), link_id)
+                if is_stored:
+                    stored.append(values)
+                else:
+                    new.append((source_id, destination_id) + values)
+            self._connection.executemany(
+                'INSERT INTO links (source_id, destination_id, data_source, '
+                'status, columns, link_id) VALUES (?, ?, ?, ?, ?, ?)', new)
+            self._connection.executemany(
+                'UPDATE links SET data_source = ?, status = ?, columns = ? '
+                'WHERE link_id = ?', stored)
+            self._pending_links.clear()
+
+    def _site_state(self, site_id):
+        """Return the loaded state of a site or None if it does not exist.
+
+        The state is [row, latitude, longitude, columns, location], where
+        location holds the stored (latitude, longitude) or None for a site
+        that was not written yet.
+        """
+        state = self._pending_sites.get(site_id)
+        if state is None:
+            stored = self._connection.execute(
+                'SELECT row, latitude, longitude, columns FROM sites '
+                'WHERE site_id = ?', (site_id,)).fetchone()
+            if stored is not None:
+                state = list(stored[:3]) + [marshal.loads(stored[3]),
+                                            stored[1:3]]
+        return state
+
+    def _link_state(self, link_id):
+        """Return the loaded state of a link or None if it does not exist.
+
+        The state is [source_id, destination_id, columns, stored], stored
+        being False for a link that was not written yet.
+        """
+        state = self._pending_links.get(link_id)
+        if state is None:
+            stored = self._connection.execute(
+                'SELECT source_id, destination_id, columns FROM links '
+                'WHERE link_id = ?', (link_id,)).fetchone()
+            if stored is not None:
+                state = list(stored[:2]) + [marshal.loads(stored[2]), True]
+        return state
+
+    def _store_site(self, site_id, state):
+        """Buffer the new state of a site."""
+        self._pending_sites[site_id] = state
+        if len(self._pending_sites) >= self.batch_size:
+            self._flush()
+
+    def _store_link(self, link_id, state):
+        """Buffer the new state of a link."""
+        self._pending_links[link_id] = state
+        if len(self._pending_links) >= self.batch_size:
+            self._flush()
+
+    def _update_site(self, site_id, values, weight):
+        """Merge weighted values into a site, creating it if needed."""
+        state = self._site_state(site_id)
+        if state is None:
+            state = [self._next_row, 0.0, 0.0,
+                     _default_columns(Site._mandatory_properties), None]
+            self._next_row += 1
+        columns = state[3]
+        _merge_columns(columns, values, weight, Site._float_columns)
+        if 'id' in columns:
+            columns['site_id'] = columns.pop('id')
+        state[1] = columns.get('latitude', (None, 0.0))[1]
+        state[2] = columns.get('longitude', (None, 0.0))[1]
+        self._store_site(site_id, state)
+
+    def add(self, raw_data):
+        """Validate and add raw_data to the database.
+
+        :param raw_data: raw_data to add to the store, see Datastore.add
+        :type raw_data: a dict of keys
+        :returns: 1 if successful and 0 if unsuccessful
+        """
+        values, weight = Site.parse_raw_data(raw_data)
+        if raw_data.get('data_type') == 'site':
+            self._update_site(
+                Site.normalize_id(raw_data.get('site_id', 'unknown')),
+                values, weight)
+            return 1
+        elif raw_data.get('data_type') == 'link':
+            source_id = Site.normalize_id(raw_data.get('source_id', ''))
+            if self._site_state(source_id) is None:
+                print('  Source Error:{} is not defined within the data set'
+                      ''.format(raw_data.get('source_id')))
+                return 0
+            destination_id = Site.normalize_id(
+                raw_data.get('destination_id', ''))
+            if self._site_state(destination_id) is None:
+                print('  Destination Error: {} is not defined within the data '
+                      'set'.format(raw_data.get('destination_id')))
+                return 0
+
+            source_id, destination_id = sorted([source_id, destination_id])
+            link_id = '{}_{}'.format(source_id, destination_id)
+            state = self._link_state(link_id) or [
+                source_id, destination_id,
+                _default_columns(Link._mandatory_properties), False]
+            _merge_columns(state[2], values, weight)
+            self._store_link(link_id, state)
+            return 1
+        return 0
+
+    def add_many(self, rows, schema):
+        """Validate and add many rows sharing one ColumnSchema.
+
+        This is the bulk form of add(), see Datastore.add_many.
+        :returns: number of rows successfully added
+        """
+        if schema.data_type != 'site':
+            return sum(self.add(schema.as_dict(row)) for row in rows)
+
+        loads = 0
+        columns, constants = schema.columns, schema.constants
+        weight_index, id_index = schema.weight_index, schema.id_index
+        for row in rows:
+            width = len(row)
+            site_id = row_site_id(row, id_index)
+            if not site_id:
+                continue
+            try:
+                weight = (int(row[weight_index]) if weight_index is not None
+                          and weight_index < width and row[weight_index]
+                          else 0)
+            except ValueError:
+                print('  Weight Error: {} is not an integer data_weight'
+                      ''.format(row[weight_index]))
+                continue
+
+            values = [(name, row[index]) for index, name in columns
+                      if index < width and row[index] not in ('', None)]
+            values.extend(constants)
+            self._update_site(site_id, values, weight)
+            loads += 1
+
+        return loads
+
+    def load_batches(self, file_name, batches):
+        """Merge the record batches parsed from one file in one transaction.
+
+        If loading fails nothing of the file is kept, see
+        FileLoader.load_batches.
+        """
+        try:
+            loads = super(SQLiteDatastore, self).load_batches(file_name,
+                                                              batches)
+            self.commit()
+        except:
+            self.rollback()
+            raise
+        return loads
+
+    def import_all_files(self, folder, files_names, jobs=1, strict=True):
+        """Import files one at a time, see Datastore.import_all_files.
+
+        Files are streamed into the database in this process so no file is
+        ever held in memory as a whole, jobs is accepted for compatibility
+        only. Every import is recorded in the imports manifest, but files are
+        merged again each time they are imported.
+        :returns: OrderedDict of file path => load counts as returned by
+            load_batches or {'error': message} for files that failed
+        """
+        files_names.sort(key=lambda f: os.path.splitext(f)[1])
+        results = OrderedDict()
+        streaming = {'.csv': self.load_csv_file, '.gv': self.load_gv_file}
+
+        for path in [os.path.join(folder, f) for f in files_names]:
+            file_name = os.path.basename(path)
+            extension = os.path.splitext(path)[1]
+            if not backends.has_reader(extension):
+                print('File format not supported for {}'.format(file_name))
+                results[path] = {'error': 'unsupported file format'}
+                continue
+            try:
+                if extension in streaming:
+                    results[path] = streaming[extension](path)
+                else:
+                    results[path] = self.load_batches(
+                        file_name, backends.get_reader(extension)(path))
+            except Exception as error:
+                if strict:
+                    raise
+                print('  Import Error: {} could not be read: {}'
+                      ''.format(file_name, error))
+                results[path] = {'error': str(error)}
+                continue
+
+            self._connection.execute(
+                'INSERT OR REPLACE INTO imports '
+                '(source, size, modified, sha1, loads) VALUES (?, ?, ?, ?, ?)',
+                (os.path.abspath(path), os.path.getsize(path),
+                 os.path.getmtime(path), file_digest(path),
+                 json.dumps(results[path])))
+            self._connection.commit()
+
+        print('\nImports complete!')
+        return results
+
+    @property
+    def imports(self):
+        """Return the manifest of every file imported into the database.
+
+        Maps the absolute file path to its size, modification time, sha1
+        content hash and load counts. Files are listed in import order.
+        """
+        return OrderedDict(
+            (source, {'size': size, 'modified': modified, 'sha1': sha1,
+                      'loads': json.loads(loads)})
+            for source, size, modified, sha1, loads in
+            self._connection.execute(
+                'SELECT source, size, modified, sha1, loads FROM imports '
+                'ORDER BY position'))
+
+    @property
+    def sites(self):
+        """Return an iterable of every site streamed in id order."""
+        return _RecordView(self._iter_sites, self.count_sites)
+
+    @property
+    def links(self):
+        """Return an iterable of every link streamed in id order."""
+        return _RecordView(self._iter_links, self.count_links)
+
+    @property
+    def all_connected(self):
+        """Return an iterable of the sites that have at least one link."""
+        return _RecordView(lambda: self._iter_sites(
+            'EXISTS (SELECT 1 FROM links WHERE source_id = sites.site_id '
+            'OR destination_id = sites.site_id)'))
+
+    def count_sites(self):
+        """Return the number of sites in the database."""
+        self._flush()
+        return self._scalar('SELECT COUNT(*) FROM sites')
+
+    def count_links(self):
+        """Return the number of links in the database."""
+        self._flush()
+        return self._scalar('SELECT COUNT(*) FROM links')
+
+    def _pages(self, query, parameters=(), key_column='site_id',
+               page_size=None):
+        """Yield the rows of a query one page at a time, ordered by key.
+
+        Pages are read by key rather than through one open cursor, so the
+        tables may be written between pages.
+        :param query: SELECT statement whose first column is the key and
+            that ends in a WHERE clause, completed with the key condition
+        """
+        page_size = page_size or self.batch_size
+        last_key = ''
+        while True:
+            self._flush()
+            rows = self._connection.execute(
+                '{} AND {} > ? ORDER BY {} LIMIT ?'.format(
+                    query, key_column, key_column),
+                tuple(parameters) + (last_key, page_size)).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                return
+            last_key = rows[-1][0]
+
+    def _iter_sites(self, condition='1', parameters=()):
+        """Yield the sites matching an SQL condition in id order."""
+        for site_id, latitude, longitude, columns in self._pages(
+                'SELECT site_id, latitude, longitude, columns FROM sites '
+                'WHERE ' + condition, parameters):
+            yield StoredSite(site_id, latitude, longitude,
+                             marshal.loads(columns))
+
+    def _iter_links(self, condition='1', parameters=()):
+        """Yield the links matching an SQL condition in id order."""
+        for row in self._pages(LINK_QUERY + 'WHERE ' + condition, parameters,
+                               key_column='links.link_id'):
+            yield StoredLink(row[0], row[1], row[2], (row[3], row[4]),
+                             (row[5], row[6]), marshal.loads(row[7]))
+
+    def _sites_by_id(self, site_ids):
+        """Return site id => site of the sites with the given ids."""
+        site_ids = list(site_ids)
+        sites = {}
+        # Stay below the default limit of 999 parameters per statement.
+        for start in range(0, len(site_ids), 900):
+            chunk = site_ids[start:start + 900]
+            sites.update((site.id, site) for site in self._iter_sites(
+                'site_id IN ({})'.format(', '.join('?' * len(chunk))),
+                chunk))
+        return sites
+
+    def get(self, key, default=None):
+        """Return the site or link with an id."""
+        for record in itertools.chain(
+                self._iter_sites('site_id = ?', (key,)),
+                self._iter_links('links.link_id = ?', (key,))):
+            return record
+        return default
+
+    def lookup(self, property_name, value):
+        """Return all sites and links with an indexed property value.
+
+        :param property_name: 'data_source' or 'status'
+        :type property_name: str
+        :param value: property value to match exactly
+        :returns: list of site and link records ordered by id
+        """
+        if property_name not in self._indexed_properties:
+            raise KeyError(property_name)
+        condition = '{} = ?'.format(property_name)
+        return sorted(
+            itertools.chain(
+                self._iter_sites(condition, (value,)),
+                self._iter_links('links.' + condition, (value,))),
+            key=lambda record: record.id)
+
+    def connected_links(self, site_id):
+        """Return the ordered ids of all links attached to a site."""
+        self._flush()
+        return [link_id for link_id, in self._connection.execute(
+            'SELECT link_id FROM links WHERE source_id = ? UNION '
+            'SELECT link_id FROM links WHERE destination_id = ? '
+            'ORDER BY link_id', (site_id, site_id))]
+
+    def sites_within(self, south, west, north, east):
+        """Return the sites inside a bounding box, ordered by id.
+
+        The box is looked up in the R*Tree index of site coordinates.
+        :param south: minimum latitude
+        :param west: minimum longitude
+        :param north: maximum latitude
+        :param east: maximum longitude
+        """
+        # The R*Tree holds 32 bit floats rounded outwards, so candidates are
+        # checked against the exact coordinates as well.
+        return list(self._iter_sites(
+            'row IN (SELECT row FROM site_locations WHERE '
+            'max_latitude >= ? AND min_latitude <= ? AND '
+            'max_longitude >= ? AND min_longitude <= ?) AND '
+            'latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?',
+            (south, north, west, east, south, north, west, east)))
+
+    @instrumentation.measured('update_all_properties')
+    def update_all_properties(self, pop_column=graph.POP_COLUMN,
+                              pop_values=graph.POP_VALUES):
+        """Traverse the database and add/update properties.
+
+        Sites are given their connected_links and graph properties and links
+        their link_id, length and geometry, like
+        Datastore.update_all_properties.
+        """
+        design = self.to_graph()
+        pops, stale = [], []
+        for site in self._iter_sites():
+            pops.append(graph.is_pop(site.get(pop_column), pop_values))
+            if any(name in site._columns for name in graph.SITE_PROPERTIES):
+                stale.append(site.id)
+        graph_properties = graph.site_properties(design, pops)
+
+        # Graph properties of an earlier run are dropped first.
+        for site_id in stale:
+            state = self._site_state(site_id)
+            for name in graph.SITE_PROPERTIES:
+                state[3].pop(name, None)
+            self._store_site(site_id, state)
+
+        # Only the sites table is written while the links are read.
+        adjacency = self._connection.execute(
+            'SELECT source_id, link_id FROM links UNION '
+            'SELECT destination_id, link_id FROM links ORDER BY 1, 2')
+        for site_id, rows in itertools.groupby(adjacency,
+                                               key=lambda row: row[0]):
+            updates = [('connected_links',
+                        ', '.join(link_id for _, link_id in rows))]
+            updates.extend(sorted(graph_properties.get(site_id, {}).items()))
+            self._update_site(site_id, updates, 0)
+
+        for links in _chunks(self._iter_links(), self.batch_size):
+            sites = self._sites_by_id(
+                set(link.source_id for link in links) |
+                set(link.destination_id for link in links))
+            lengths = utilities.distances(
+                [(sites[link.source_id].latitude,
+                  sites[link.source_id].longitude) for link in links],
+                [(sites[link.destination_id].latitude,
+                  sites[link.destination_id].longitude) for link in links])
+            geometry = link_geometry(
+                [sites[link.source_id] for link in links],
+                [sites[link.destination_id] for link in links])
+            # Every page is read after the previous one was written, so the
+            # streamed columns are the stored state of the links.
+            for link, length, pointing in zip(links, lengths.tolist(),
+                                              geometry):
+                _merge_columns(link._columns, [('link_id', link.id),
+                                               ('length', length)] +
+                               sorted(pointing.items()), 0)
+                self._store_link(link.id, [link.source_id,
+                                           link.destination_id,
+                                           link._columns, True])
+        self.commit()
+
+    def add_altitudes(self, provider, offset=0.0):
+        """Set the altitude of every site from an elevation provider.
+
+        Sites are looked up batch_size at a time, see
+        Datastore.add_altitudes.
+        :returns: number of sites given an altitude
+        """
+        updated = 0
+        for sites in _chunks(self._iter_sites(), self.batch_size):
+            altitudes = provider.elevations(
+                [site.latitude for site in sites],
+                [site.longitude for site in sites])
+            for site, altitude in zip(sites, (altitudes + offset).round(1)):
+                if altitude != altitude:  # NaN, no elevation data.
+                    continue
+                self._update_site(site.id, [('altitude', altitude.item())], 0)
+                updated += 1
+        self.commit()
+        return updated
+
+    def to_graph(self):
+        """Return a graph.Graph of all sites and links, rows ordered by id.
+
+        Only the ids of the sites and the endpoints of the links are read.
+        """
+        self._flush()
+        site_ids = [site_id for site_id, in self._connection.execute(
+            'SELECT site_id FROM sites ORDER BY site_id')]
+        rows = {site_id: row for row, site_id in enumerate(site_ids)}
+        sources, destinations = [], []
+        for source_id, destination_id in self._connection.execute(
+                'SELECT source_id, destination_id FROM links'):
+            sources.append(rows.get(source_id, -1))
+            destinations.append(rows.get(destination_id, -1))
+        return graph.Graph.build(site_ids, sources, destinations)
+
+    def to_frame(self):
+        """Return a columnar Frame snapshot of all sites and links.
+
+        Rows are ordered by id, see Datastore.to_frame.
+        """
+        def link_row(link):
+            """Return a link as a Frame row with the properties it exports."""
+            properties = [(k, v) for k, v in link.items()
+                          if k not in ('longitude', 'latitude', 'source_id',
+                                       'destination_id')]
+            properties.extend([('source_id', link.source_id),
+                               ('destination_id', link.destination_id)])
+            return link.id, link.source_id, link.destination_id, properties
+
+        return Frame.build(
+            sites=((site.id, site.latitude, site.longitude, site.items())
+                   for site in self._iter_sites()),
+            links=(link_row(link) for link in self._iter_links()))
+
+
+class _RecordView(object):
+    """Iterable of records streamed from a SQLiteDatastore.
+
+    Every iteration runs the query again, so the view follows later changes
+    to the database.
+    """
+
+    ordered = True
+
+    def __init__(self, iterate, count=None):
+        self._iterate = iterate
+        self._count = count
+
+    def __iter__(self):
+        return self._iterate()
+
+    def __len__(self):
+        if self._count is None:
+            return sum(1 for _ in self)
+        return self._count()
+
+
+class StoredSite(object):
+    """Site read from a SQLiteDatastore.
+
+    The site is a copy of the stored data and is not written back.
+    """
+
+    __slots__ = ('id', 'latitude', 'longitude', '_columns')
+
+    def __init__(self, site_id, latitude, longitude, columns):
+        self.id = site_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self._columns = columns
+
+    @property
+    def coordinates(self):
+        """Center point of the site as (lng, lat) with 1m of precision."""
+        return (self.longitude, self.latitude)
+
+    def get(self, column_name, default=None):
+        """Return the current value of a column."""
+        if column_name == 'latitude':
+            return self.latitude
+        elif column_name == 'longitude':
+            return self.longitude
+        return self._columns.get(column_name, (None, default))[1]
+
+    def items(self):
+        """Return (column_name, value) pairs of all set columns."""
+        return [(name, value) for name, (_, value) in self._columns.items()
+                if name not in Site._float_columns]
+
+    def weight(self, column_name):
+        """Return the data weight that set a column, 0 if never set."""
+        weight = self._columns.get(column_name, (None, None))[0]
+        return 0 if weight is None else weight
+
+    def as_geojson(self):
+        """Return the site data as a geoJSON feature object."""
+        import geojson  # Loaded on first use, see backends.
+        return geojson.Feature(id=self.id,
+                               geometry=geojson.Point(self.coordinates),
+                               properties=dict(self.items()))
+
+
+class StoredLink(object):
+    """Link read from a SQLiteDatastore.
+
+    The link is a copy of the stored data and is not written back.
+    """
+
+    __slots__ = ('id', 'source_id', 'destination_id', 'coordinates',
+                 '_columns')
+
+    def __init__(self, link_id, source_id, destination_id,
+                 source_coordinates, destination_coordinates, columns):
+        self.id = link_id
+        self.source_id = source_id
+        self.destination_id = destination_id
+        self.coordinates = (source_coordinates, destination_coordinates)
+        self._columns = columns
+
+    def get(self, column_name, default=None):
+        """Return the current value of a column."""
+        return self._columns.get(column_name, (None, default))[1]
+
+    def items(self):
+        """Return (column_name, value) pairs of all set columns."""
+        return [(name, value) for name, (_, value) in self._columns.items()]
+
+    def weight(self, column_name):
+        """Return the data weight that set a column, 0 if never set."""
+        weight = self._columns.get(column_name, (None, None))[0]
+        return 0 if weight is None else weight
+
+    def as_geojson(self):
+        """Return the link data as a geoJSON feature object."""
+        import geojson  # Loaded on first use, see backends.
+        properties = {k: v for k, v in self.items()
+                      if k not in ['longitude', 'latitude']}
+        properties.update({'source_id': self.source_id,
+                           'destination_id': self.destination_id})
+        return geojson.Feature(id=self.id,
+                               geometry=geojson.LineString(self.coordinates),
+                               properties=properties)
+
+
+def _default_columns(mandatory_properties):
+    """Return the stored columns of a new record, defaults have no weight."""
+    return {name: (None, value)
+            for name, value in mandatory_properties.items()}
+
+
+def _merge_columns(columns, values, data_weight, float_columns=()):
+    """Merge normalized (column_name, value) pairs loaded at one weight.
+
+    Follows _Record.update_columns: a value replaces the current value of a
+    column unless the current value was loaded with a higher weight, and a
+    column that was never loaded counts as weight 0.
+    :param columns: column_name => (weight, value), updated in place
+    :type columns: dict
+    """
+    for column_name, value in values:
+        current = columns.get(column_name)
+        if data_weight < (current[0] if current and current[0] is not None
+                          else 0):
+            continue
+        if column_name in float_columns:
+            try:
+                value = float('{:.6f}'.format(float(value)))
+            except:
+                value = 0.0
+        columns[column_name] = (data_weight, value)
+
+
+def _indexed(columns, column_name):
+    """Return the value of an indexed column, None if not set."""
+    return columns.get(column_name, (None, None))[1]
+
+
+def _chunks(iterable, size):
+    """Yield lists of up to size items of an iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
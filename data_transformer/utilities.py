@@ -1,10 +1,9 @@
 """Simple utilities to manipulate geospatial data."""
 
-from math import radians, cos, sin, atan2, sqrt
+from math import radians, cos, sin, atan2, sqrt, floor
 from time import sleep
-import urllib
-from simplejson import load
 from collections import defaultdict
+import numpy as np
 
 
 def get_altitude(lattitude, longitude, offset=0.0):
@@ -14,6 +13,9 @@ def get_altitude(lattitude, longitude, offset=0.0):
     NOTE: the geojson spec of x, y, z order (easting, northing,
     altitude for coordinates) and not lat, lng, alt.
     """
+    # Only needed for online lookups, so not loaded with the module.
+    import urllib
+    from simplejson import load
     coordinates = '{},{}'.format(lattitude, longitude)
     BASE_URL = 'http://maps.google.com/maps/api/elevation/json'
     url = BASE_URL + '?' + urllib.urlencode({'locations': coordinates})
@@ -27,8 +29,9 @@ def distance(source_coordinates, destination_coordinates):
     """
     Return the distance in meters between two points.
 
-    Accept coordinates in [x, y, z] or [lng, lat, alt]. Ignore altitude due to
-    common accuracy issues.
+    Accept coordinates as (lat, lng) or (lat, lng, alt). GeoJSON coordinates
+    are (lng, lat) and must be swapped first. Ignore altitude due to common
+    accuracy issues.
     """
     lat1, long1 = (float(x) for x in source_coordinates[0:2])
     lat2, long2 = (float(x) for x in destination_coordinates[0:2])
@@ -43,9 +46,162 @@ def distance(source_coordinates, destination_coordinates):
     return float('{:.1f}'.format(d))
 
 
+def distances(source_coordinates, destination_coordinates):
+    """
+    Return the distances in meters between two arrays of points.
+
+    Vectorized form of distance(). Row i of the result is the distance between
+    source_coordinates[i] and destination_coordinates[i], which are read in the
+    same axis order as distance() and rounded to the same 0.1m precision.
+
+    :param source_coordinates: N coordinates as (lat, lng) or
+        (lat, lng, alt)
+    :type source_coordinates: sequence or numpy.ndarray
+    :param destination_coordinates: N coordinates as (lat, lng) or
+        (lat, lng, alt)
+    :type destination_coordinates: sequence or numpy.ndarray
+    :returns: numpy.ndarray of N distances
+    """
+    source = np.asarray(source_coordinates, dtype=float)
+    destination = np.asarray(destination_coordinates, dtype=float)
+    if source.size == 0:
+        return np.zeros(0)
+
+    lat1, long1 = np.radians(source[:, 0]), np.radians(source[:, 1])
+    lat2, long2 = np.radians(destination[:, 0]), np.radians(destination[:, 1])
+    radius = 6371 * 1000  # radius of earth in meters
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return np.round(radius * c, 1)
+
+
+class PointGrid(object):
+    """Spatial bucket index for finding points near a location.
+
+    Points are projected onto the unit sphere and bucketed into cubes whose
+    side is the search radius (in earth radii). A great circle distance is
+    never shorter than the straight chord between two points, so every point
+    within the radius of a query lies in one of the 27 cells around it.
+    """
+
+    def __init__(self, radius):
+        """Initilize an empty grid for searches within radius meters."""
+        self.radius = float(radius)
+        self._cell_size = max(self.radius, 0.01) / (6371 * 1000)
+        self._cells = defaultdict(list)
+
+    def _cell(self, latitude, longitude):
+        """Return the grid cell containing a point."""
+        lat, lng = radians(latitude), radians(longitude)
+        return (int(floor(cos(lat) * cos(lng) / self._cell_size)),
+                int(floor(cos(lat) * sin(lng) / self._cell_size)),
+                int(floor(sin(lat) / self._cell_size)))
+
+    def insert(self, item, latitude, longitude):
+        """Add an item located at a point to the grid."""
+        self._cells[self._cell(latitude, longitude)].append(item)
+
+    def near(self, latitude, longitude):
+        """Yield every item that may be within the radius of a point.
+
+        The result is a superset of the items within the radius. Callers
+        should confirm candidates with an exact distance check.
+        """
+        x, y, z = self._cell(latitude, longitude)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    for item in self._cells.get((x + dx, y + dy, z + dz), ()):
+                        yield item
+
+
+def link_geometry(source_latitudes, source_longitudes, destination_latitudes,
+                  destination_longitudes, source_altitudes=0.0,
+                  destination_altitudes=0.0):
+    """
+    Return the pointing geometry of arrays of links in one vectorized pass.
+
+    Endpoints are placed on a spherical earth of the radius used by
+    distances() and the line of sight between them is expressed in the
+    local east, north, up frame of each endpoint. Azimuths are in degrees
+    clockwise from true north and elevation angles in degrees above the
+    horizon, negative when the other end is lower. Both are rounded to 0.1
+    degree and slant ranges to 0.1m.
+
+    :param source_latitudes: N latitudes in degrees
+    :param source_longitudes: N longitudes in degrees
+    :param destination_latitudes: N latitudes in degrees
+    :param destination_longitudes: N longitudes in degrees
+    :param source_altitudes: N altitudes in meters, or one for all links
+    :param destination_altitudes: N altitudes in meters, or one for all links
+    :returns: dict of numpy.ndarrays 'azimuth' and 'elevation_angle' seen
+        from the source, 'reverse_azimuth' and 'reverse_elevation_angle'
+        seen from the destination and 'slant_range' in meters
+    """
+    radius = 6371 * 1000  # radius of earth in meters
+
+    def endpoint(latitudes, longitudes, altitudes):
+        """Return the latitudes and longitudes in radians and the position
+        of the endpoints in earth centered coordinates."""
+        lat = np.radians(np.asarray(latitudes, dtype=float))
+        lng = np.radians(np.asarray(longitudes, dtype=float))
+        r = radius + np.asarray(altitudes, dtype=float)
+        return lat, lng, np.array([r * np.cos(lat) * np.cos(lng),
+                                   r * np.cos(lat) * np.sin(lng),
+                                   r * np.sin(lat)])
+
+    def pointing(lat, lng, offset):
+        """Return the azimuth and elevation angle of offset vectors seen
+        from points, in degrees."""
+        dx, dy, dz = offset
+        east = -np.sin(lng) * dx + np.cos(lng) * dy
+        north = (-np.sin(lat) * np.cos(lng) * dx -
+                 np.sin(lat) * np.sin(lng) * dy + np.cos(lat) * dz)
+        up = (np.cos(lat) * np.cos(lng) * dx +
+              np.cos(lat) * np.sin(lng) * dy + np.sin(lat) * dz)
+        azimuth = np.degrees(np.arctan2(east, north)) % 360
+        elevation = np.degrees(np.arctan2(up, np.hypot(east, north)))
+        # Adding 0.0 turns the -0.0 of level links into 0.0.
+        return np.round(azimuth, 1) % 360, np.round(elevation, 1) + 0.0
+
+    lat1, lng1, position1 = endpoint(source_latitudes, source_longitudes,
+                                     source_altitudes)
+    lat2, lng2, position2 = endpoint(destination_latitudes,
+                                     destination_longitudes,
+                                     destination_altitudes)
+    offset = position2 - position1
+    azimuth, elevation = pointing(lat1, lng1, offset)
+    reverse_azimuth, reverse_elevation = pointing(lat2, lng2, -offset)
+    return {'azimuth': azimuth,
+            'elevation_angle': elevation,
+            'reverse_azimuth': reverse_azimuth,
+            'reverse_elevation_angle': reverse_elevation,
+            'slant_range': np.round(np.sqrt((offset ** 2).sum(axis=0)), 1)}
+
+
+def parse_altitude(value):
+    """Return an altitude property in meters, 0.0 if missing or invalid."""
+    try:
+        return float(value or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
 def calc_azimuth_elevation(source, destination):
-    """Calculate the magnetic azimuth between two points."""
-    pass
+    """Calculate the azimuth and elevation angle between two points.
+
+    Coordinates are read in the same axis order as distance(), with an
+    optional altitude in meters. The azimuth is relative to true north, see
+    link_geometry.
+    :returns: (azimuth, elevation angle) in degrees seen from the source
+    """
+    altitude = lambda point: point[2] if len(point) > 2 else 0.0
+    geometry = link_geometry([source[0]], [source[1]], [destination[0]],
+                             [destination[1]], [altitude(source)],
+                             [altitude(destination)])
+    return (geometry['azimuth'][0].item(),
+            geometry['elevation_angle'][0].item())
 
 
 def normalize_edge_id(edge_name):
@@ -62,22 +218,30 @@ def normalize_node_id(node_name):
     return node_name
 
 
-def get_adjacencies_by_proximity(edges, nodes):
+def get_adjacencies_by_proximity(edges, nodes, threshold=2):
     """Return a dict relationship of a graph.
 
-    Based on the assumption that any node proximity( < 2m) of an
-    edge endpoint is likely connected to the node / vertex.
+    Based on the assumption that any node proximity( < threshold meters) of an
+    edge endpoint is likely connected to the node / vertex. Edge endpoints are
+    bucketed in a PointGrid so each node only measures nearby endpoints.
     """
+    grid = PointGrid(threshold)
+    for index, edge in enumerate(edges):
+        for lng, lat in (coords[0:2] for coords in edge.geometry.coordinates):
+            grid.insert((index, edge.id, (lat, lng)), lat, lng)
 
     prox_graph = defaultdict(list)
     for node in nodes:
-        node_coords = node.geometry.coordinates
-        for edge in edges:
-            edge_coords1, edge_coords2 = edge.geometry.coordinates
-            dist1 = distance(node_coords, edge_coords1)
-            dist2 = distance(node_coords, edge_coords2)
-            if (dist1 < 2) or (dist2 < 2):
-                prox_graph[node.id].append(edge.id)
+        lng, lat = node.geometry.coordinates[0:2]
+        node_coords = (lat, lng)
+        matches = {}
+        for index, edge_id, edge_coords in grid.near(node_coords[0],
+                                                     node_coords[1]):
+            if (index not in matches and
+                    distance(node_coords, edge_coords) < threshold):
+                matches[index] = edge_id
+        for index in sorted(matches):
+            prox_graph[node.id].append(matches[index])
 
     return prox_graph
 
@@ -96,20 +260,21 @@ def get_adjacencies_by_ref(edges, nodes):
     return adjacency_list
 
 
-def get_adjacencies(edges, nodes):
+def get_adjacencies(edges, nodes, proximity_threshold=2):
     """Wrap the two adjacency identification functions.
 
     Under normal insertions, all edges will contain a reference to the source
     and destination of the edge. This will be faster to calc than the proximity
-    method, which calculates the distance to all sites.
+    method, which calculates the distance to nearby sites.
     """
     try:
         return get_adjacencies_by_ref(edges, nodes)
 
     except:
-        print('Fast adjacency identification method failed. This may take some'
-              'time.')
-        return get_adjacencies_by_proximity(edges, nodes)
+        print('Fast adjacency identification method failed. Falling back to '
+              'proximity matching.')
+        return get_adjacencies_by_proximity(edges, nodes,
+                                            threshold=proximity_threshold)
 
 
 def hash_location(coordinates):
@@ -127,22 +292,89 @@ def hash_location(coordinates):
     return '{:.5f}_{:.5f}_{:.0f}'.format(lat, lng, height)
 
 
-def find_close_nodes(nodes):
-    """Identify nodes that are within ~1m distance of each other.
+def cluster_locations(locations, radius=1.0):
+    """Group locations that are chained within radius meters of each other.
+
+    Each location is only compared with the locations in neighbouring
+    PointGrid cells and pairs within the radius are joined with a union-find,
+    so grouping runs in near linear time. Groups are transitive: if A is near
+    B and B is near C, then A, B and C form one group.
+
+    :param locations: (key, latitude, longitude) for every location
+    :type locations: iterable of tuples
+    :param radius: maximum distance in meters between neighbouring locations
+    :type radius: float
+    :returns: list of key tuples with two or more members, ordered by key
+    """
+    parents = {}
+
+    def find(key):
+        """Return the root key of the group containing key."""
+        while parents[key] != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    grid = PointGrid(radius)
+    for key, lat, lng in locations:
+        parents[key] = key
+        for other_key, other_lat, other_lng in grid.near(lat, lng):
+            if distance((lat, lng), (other_lat, other_lng)) <= radius:
+                root, other_root = find(key), find(other_key)
+                if root != other_root:
+                    parents[max(root, other_root)] = min(root, other_root)
+        grid.insert((key, lat, lng), lat, lng)
+
+    groups = defaultdict(list)
+    for key in parents:
+        groups[find(key)].append(key)
+
+    return sorted(tuple(sorted(keys)) for keys in groups.values()
+                  if len(keys) >= 2)
+
+
+def pairs_within(locations, min_distance, max_distance):
+    """Yield every pair of locations between min and max distance apart.
+
+    Each location is only compared with the locations in neighbouring
+    PointGrid cells of max_distance, and the distances to all of them are
+    computed in one vectorized call.
+
+    :param locations: (key, latitude, longitude) for every location
+    :type locations: iterable of tuples
+    :param min_distance: minimum distance in meters, inclusive
+    :type min_distance: float
+    :param max_distance: maximum distance in meters, inclusive
+    :type max_distance: float
+    :returns: iterator of (key, other_key, distance) with the key of the
+        location listed first, each pair once
+    """
+    grid = PointGrid(max_distance)
+    for key, lat, lng in locations:
+        candidates = list(grid.near(lat, lng))
+        if candidates:
+            lengths = distances([(lat, lng)] * len(candidates),
+                                [(other_lat, other_lng) for _, other_lat,
+                                 other_lng in candidates])
+            for (other_key, _, _), length in zip(candidates,
+                                                 lengths.tolist()):
+                if min_distance <= length <= max_distance:
+                    yield other_key, key, length
+        grid.insert((key, lat, lng), lat, lng)
+
+
+def find_close_nodes(nodes, radius=1.0):
+    """Identify nodes that are within radius meters of each other.
 
     Useful for identifying locations that may represent the same physical
     location.
     """
-    location_map = defaultdict(list)
-    close_nodes = []
+    locations = []
     for node in nodes:
-        location_map[hash_location(node.geometry.coordinates)].append(node.id)
+        lng, lat = node.geometry.coordinates[0:2]
+        locations.append((node.id, lat, lng))
 
-    for (loc, ids) in location_map.iteritems():
-        if len(ids) >= 2:
-            close_nodes.append(tuple(ids))
-
-    return close_nodes
+    return cluster_locations(locations, radius=radius)
 
 
 def get_missing_fields(edges, nodes):
@@ -163,10 +395,16 @@ def get_missing_fields(edges, nodes):
     return data_gaps
 
 
-def get_edges_per_node(edges, nodes):
-    """Get edges attatched to a node in the graph."""
+def get_edges_per_node(edges, nodes, adjacencies=None):
+    """Get edges attatched to a node in the graph.
+
+    :param adjacencies: a prebuilt adjacency list to count instead of
+        deriving one from the edges.
+    :type adjacencies: dict
+    """
     edges_per_node = defaultdict(int)
-    adjacency_list = get_adjacencies(edges=edges, nodes=nodes)
-    for adjacentcies in adjacency_list.values():
+    if adjacencies is None:
+        adjacencies = get_adjacencies(edges=edges, nodes=nodes)
+    for adjacentcies in adjacencies.values():
         edges_per_node[len(adjacentcies)] += 1
     return edges_per_node
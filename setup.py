@@ -14,7 +14,7 @@ config = {
     'author_email': 'thadeus.hickman@gmail.com',
     'version': '0.2',
     'install_requires': ['nose', 'geojson', 'pykml',
-                         'simplejson', 'pydot'],
+                         'simplejson', 'pydot', 'numpy'],
     'packages': ['data_transformer'],
     'scripts': [],
     'name': 'data_transformer',
@@ -2,9 +2,932 @@
 
 import nose.tools
 import data_transformer
+from data_transformer import (datastore, elevation, features, graph,
+                              gv_reader, instrumentation, sqlite_datastore,
+                              utilities)
+import gc
+import geojson
+import json
+import numpy as np
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+
+SITES_CSV = ('site_id,latitude,longitude,bill_of_materials\n'
+             'A,37.3300,-121.8800,CN\n'
+             'B,37.3310,-121.8800,DN\n'
+             'C,37.3320,-121.8800,DN\n'
+             'D,37.3330,-121.8800,CN\n'
+             '12L198,37.3340,-121.8800,DN\n'
+             '12L197,37.3350,-121.8800,DN\n')
 
 
 def setup():
     """Setup."""
     ds = data_transformer.datastore.Datastore()
     print("SETUP!")
+
+
+def write_files(files):
+    """Write {file name: text} to a new folder and return its path."""
+    folder = tempfile.mkdtemp()
+    for file_name, text in files.items():
+        with open(os.path.join(folder, file_name), 'w') as f:
+            f.write(text)
+    return folder
+
+
+def import_files(files, store=None):
+    """Import {file name: text} into a new or given Datastore."""
+    folder = write_files(files)
+    try:
+        store = datastore.Datastore() if store is None else store
+        store.import_all_files(folder, sorted(files))
+        return store
+    finally:
+        shutil.rmtree(folder)
+
+
+def store_state(store):
+    """Return every record with its values and weights, and the links of
+    every site, for comparing two datastores.
+    """
+    records = sorted((key, sorted(record.items()), sorted(record.weights()))
+                     for key, record in store.items())
+    adjacencies = dict((site_id, sorted(link_ids))
+                       for site_id, link_ids in store.adjacencies.items())
+    return records, adjacencies
+
+
+def test_gv_digit_first_ids():
+    """The README example links 12L198 and 12L197, not 12 and L198."""
+    records = list(gv_reader.iter_records([
+        'graph example_format {\n', '\n', '// Some note about a link\n',
+        '12L198 -- 12L197\n', '\n', '}\n']))
+    nose.tools.assert_equal(records, [('edge', ('12L198', '12L197'), {})])
+
+    ds = import_files({'sites.csv': SITES_CSV,
+                       'links.gv': 'graph g {\n12L198 -- 12L197\n}\n'})
+    nose.tools.assert_equal(ds.connected_links('12L198'), ['12L197_12L198'])
+
+
+def test_gv_numerals():
+    """Numerals are still ids, numerals running into an id are rejected."""
+    records = list(gv_reader.iter_records(['graph g { a -- b [w=-1.5] }']))
+    nose.tools.assert_equal(records, [('edge', ('a', 'b'), {'w': '-1.5'})])
+    for statement in ('-12L -- a', 'a -- b [w=1.5e3]'):
+        with nose.tools.assert_raises(gv_reader.DotSyntaxError):
+            list(gv_reader.iter_records(['graph g { ' + statement + ' }']))
+
+
+def test_gv_fallback_after_records():
+    """A late syntax error falls back to pydot without loading twice."""
+    ds = import_files({
+        'sites.csv': SITES_CSV,
+        'links.gv': 'graph g {\nA [label]\nA -- B\nC -- D\nD -- {A}\n}\n'})
+    nose.tools.assert_equal(sorted(link.id for link in ds.links),
+                            ['A_B', 'C_D'])
+    loads = ds.imports.values()[-1]['loads']
+    nose.tools.assert_equal((loads['link'], loads['site']), (2, 1))
+    nose.tools.assert_equal(ds['A'].get('label'), 'true')
+
+
+def test_add_many_blank_rows():
+    """Rows without a site_id are rejected instead of becoming a site."""
+    schema = datastore.ColumnSchema(['site_id', 'latitude', 'status'],
+                                    data_source='sites.csv')
+    rows = [['A', '37.33', 'planned'], [], ['', '', ''], ['', '37.1', 'x'],
+            [' b ', '37.34']]
+    for store in (datastore.Datastore(),
+                  sqlite_datastore.SQLiteDatastore(':memory:')):
+        loads = store.load_batches('sites.csv', [(schema, iter(rows))])
+        nose.tools.assert_equal(loads, {'site': 2, 'rejected': 3})
+        nose.tools.assert_equal(sorted(site.id for site in store.sites),
+                                ['A', 'B'])
+
+
+class StubElevationProvider(elevation.ElevationProvider):
+    """Elevation of 100m north of the equator, unknown south of it."""
+
+    def elevations(self, latitudes, longitudes):
+        latitudes = np.asarray(latitudes, dtype=float)
+        return np.where(latitudes > 0, 100.04, np.nan)
+
+
+def test_add_altitude_property_provider():
+    """Points and both ends of lines get the altitude of a provider."""
+    provider = StubElevationProvider()
+    point = geojson.Feature(id='A', geometry=geojson.Point((-121.9, 37.3)))
+    features.add_altitude_property(point, height_offset=2.0,
+                                   provider=provider)
+    nose.tools.assert_equal(point.geometry.coordinates, [-121.9, 37.3, 102.0])
+
+    line = geojson.Feature(id='A_B', geometry=geojson.LineString(
+        [(-121.9, 37.3), (-121.8, 37.4)]))
+    features.add_altitude_property(line, provider=provider)
+    nose.tools.assert_equal(line.geometry.coordinates,
+                            [[-121.9, 37.3, 100.0], [-121.8, 37.4, 100.0]])
+
+    unknown = geojson.Feature(id='C', geometry=geojson.Point((10.0, -5.0)))
+    features.add_altitude_property(unknown, provider=provider)
+    nose.tools.assert_equal(list(unknown.geometry.coordinates), [10.0, -5.0])
+
+
+def test_elevation_client_cache():
+    """Locations are requested once, failed batches again in the next run."""
+    import BaseHTTPServer
+    import threading
+    import urlparse
+    requests = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """Elevation API stub answering lat + lng, failing at first."""
+
+        def do_GET(self):
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            locations = [tuple(float(value) for value in location.split(','))
+                         for location in query['locations'][0].split('|')]
+            requests.append(locations)
+            response = {'status': 'OK', 'results': [
+                {'elevation': latitude + longitude}
+                for latitude, longitude in locations]}
+            if len(requests) == 1:
+                response = {'status': 'OVER_QUERY_LIMIT'}
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(json.dumps(response))
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    folder = tempfile.mkdtemp()
+    cache_path = os.path.join(folder, 'elevations.txt')
+
+    def elevations():
+        client = elevation.ElevationClient(
+            base_url='http://127.0.0.1:{}/'.format(server.server_address[1]),
+            cache_path=cache_path, batch_size=2, requests_per_second=1000)
+        return client.elevations(latitudes, longitudes)
+
+    latitudes = [37.1, 37.2, 37.3, 37.4, 37.5] * 2
+    longitudes = [-121.9, -121.8, -121.7, -121.6, -121.5] * 2
+    expected = np.add(latitudes, longitudes)
+    try:
+        first = elevations()
+        nose.tools.assert_equal(len(requests), 3)
+        nose.tools.assert_equal(
+            sorted(location for batch in requests for location in batch),
+            sorted(zip(latitudes[:5], longitudes[:5])))
+        unknown = np.isnan(first)
+        nose.tools.assert_equal(unknown.tolist(), unknown[:5].tolist() * 2)
+        nose.tools.assert_equal(unknown.sum(), 2 * len(requests[0]))
+        np.testing.assert_allclose(first[~unknown], expected[~unknown])
+
+        # A line cut short by an interrupted run is ignored.
+        with open(cache_path, 'a') as f:
+            f.write('37.60000_-121.40000_0 1')
+        np.testing.assert_allclose(elevations(), expected)
+        nose.tools.assert_equal(len(requests), 4)
+        nose.tools.assert_equal(sorted(requests[3]), sorted(requests[0]))
+
+        np.testing.assert_allclose(elevations(), expected)
+        nose.tools.assert_equal(len(requests), 4)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        shutil.rmtree(folder)
+
+
+def test_build_summary_on_stdout():
+    """With --summary - stdout holds nothing but the JSON run summary."""
+    from data_transformer import __main__
+    folder = write_files({'sites.csv': SITES_CSV,
+                          'links.gv': 'graph g {\nA -- B\nC -- {D}\n}\n'})
+    streams = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+    try:
+        args = __main__.build_argument_parser().parse_args([
+            'build', '--input', folder, '--output', folder, '--formats',
+            'geojson', '--summary', '-'])
+        exit_code = __main__.build_command(args)
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout, sys.stderr = streams
+        shutil.rmtree(folder)
+    nose.tools.assert_equal(exit_code, __main__.EXIT_OK)
+    summary = json.loads(output)
+    nose.tools.assert_equal(summary['counts']['links'], 1)
+    nose.tools.assert_equal(sorted(summary['timings']),
+                            ['export', 'import', 'total',
+                             'update_all_properties'])
+
+
+def test_memory_sampled_only_in_stages():
+    """The memory sampler only runs while a stage is open."""
+    recorder = instrumentation.Recorder()
+    with instrumentation.recording(recorder):
+        nose.tools.assert_is_none(recorder._sampler)
+        for _ in range(2):
+            with instrumentation.stage('outer'):
+                with instrumentation.stage('inner'):
+                    nose.tools.assert_is_not_none(recorder._sampler)
+                nose.tools.assert_is_not_none(recorder._sampler)
+            nose.tools.assert_is_none(recorder._sampler)
+    nose.tools.assert_equal(list(recorder.stage_seconds()), ['outer'])
+
+
+def test_length_matches_slant_range():
+    """length is the ground distance of slant_range at any latitude."""
+    files = {'sites.csv': ('site_id,latitude,longitude,altitude\n'
+                           'N1,60.0000,10.0000,10\n'
+                           'N2,60.0010,10.0020,40\n'
+                           'E1,0.0000,10.0000,0\n'
+                           'E2,0.0010,10.0020,0\n'),
+             'links.gv': 'graph g {\nN1 -- N2\nE1 -- E2\n}\n'}
+    for store in (datastore.Datastore(),
+                  sqlite_datastore.SQLiteDatastore(':memory:')):
+        import_files(files, store).update_all_properties()
+        for link in store.links:
+            source = store.get(link.get('source_id'))
+            destination = store.get(link.get('destination_id'))
+            expected = utilities.distance(
+                (source.latitude, source.longitude),
+                (destination.latitude, destination.longitude))
+            rise = (float(destination.get('altitude')) -
+                    float(source.get('altitude')))
+            nose.tools.assert_equal(link.get('length'), expected)
+            nose.tools.assert_almost_equal(
+                link.get('slant_range'), np.hypot(expected, rise), delta=0.2)
+
+
+def test_record_slots_are_reused():
+    """Dropped sites hand their weight slots to new sites."""
+    table = datastore.Site._table
+    ds = import_files({'sites.csv': SITES_CSV})
+    ds.add({'data_type': 'site', 'site_id': 'A', 'status': 'x'})
+    ds.add({'data_type': 'site', 'site_id': 'B', 'data_weight': '7',
+            'bill_of_materials': 'CN'})
+    in_use = table.slot_count
+    del ds['B']
+    ds.add({'data_type': 'site', 'site_id': 'E', 'data_weight': '5'})
+    nose.tools.assert_equal(table.slot_count, in_use)
+    nose.tools.assert_equal(ds['E'].weight('bill_of_materials'), 0)
+    nose.tools.assert_equal(ds['E'].weight('site_id'), 5)
+
+    path = tempfile.mktemp()
+    try:
+        ds.save_snapshot(path)
+        for _ in range(2):
+            ds.clear()
+            ds = datastore.Datastore()
+            ds.load_snapshot(path)
+            nose.tools.assert_equal(table.slot_count, in_use)
+        nose.tools.assert_equal(ds['A'].get('status'), 'x')
+        nose.tools.assert_equal(ds['D'].weight('site_id'), 0)
+        nose.tools.assert_equal(ds['E'].weight('site_id'), 5)
+    finally:
+        os.remove(path)
+
+    # Records have no finalizer, so a cycle through one is collected.
+    link = datastore.Link(ds['A'], ds['C'])
+    link.update_raw_data({'data_type': 'link', 'note': [link]})
+    del link
+    gc.collect()
+    nose.tools.assert_equal(gc.garbage, [])
+
+
+def test_features_are_copies():
+    """Changing an exported feature never changes the cached feature."""
+    ds = import_files({'sites.csv': SITES_CSV,
+                       'links.gv': 'graph g {\nA -- B\n}\n'})
+    provider = StubElevationProvider()
+    for record in (ds['A'], ds['A_B']):
+        feature = record.as_geojson()
+        expected = geojson.dumps(feature, sort_keys=True)
+        feature.properties['bill_of_materials'] = 'changed'
+        features.add_length_property(feature)
+        features.add_altitude_property(feature, provider=provider)
+        nose.tools.assert_equal(
+            geojson.dumps(record.as_geojson(), sort_keys=True), expected)
+
+
+def test_dict_methods_keep_indexes():
+    """update, setdefault, pop, popitem and clear keep the indexes current."""
+    ds = import_files({'sites.csv': SITES_CSV,
+                       'links.gv': 'graph g {\nA -- B\nC -- D\n}\n'})
+    sites = dict((site.id, site) for site in ds.sites)
+    link = ds.pop('A_B')
+    nose.tools.assert_equal(ds.connected_links('A'), [])
+    nose.tools.assert_equal(ds.pop('A_B', None), None)
+    with nose.tools.assert_raises(KeyError):
+        ds.pop('A_B')
+
+    ds.update({'A_B': link})
+    nose.tools.assert_equal(ds.connected_links('A'), ['A_B'])
+    nose.tools.assert_equal(ds.setdefault('A_B', None), link)
+    other_link = ds.pop('C_D')
+    nose.tools.assert_equal(ds.setdefault('C_D', other_link), other_link)
+    nose.tools.assert_equal(ds.connected_links('C'), ['C_D'])
+
+    while ds:
+        key, _ = ds.popitem()
+        nose.tools.assert_not_in(key, ds)
+    nose.tools.assert_equal((ds.count_sites(), ds.count_links()), (0, 0))
+    nose.tools.assert_equal(ds.connected_links('C'), [])
+    ds.update(sites)
+    nose.tools.assert_equal(ds.count_sites(), len(sites))
+    ds.clear()
+    nose.tools.assert_equal((len(ds), ds.count_sites(), ds.count_links(),
+                             list(ds.sites)), (0, 0, 0, []))
+
+
+def test_adjacency_index_stays_live():
+    """The adjacency index always equals a rebuild from the link features."""
+    def assert_adjacency_rebuilt(store):
+        rebuilt = utilities.get_adjacencies_by_ref(
+            [link.as_geojson() for link in store.links], [])
+        nose.tools.assert_equal(
+            dict((site_id, sorted(link_ids))
+                 for site_id, link_ids in store.adjacencies.items()),
+            dict((site_id, sorted(link_ids))
+                 for site_id, link_ids in rebuilt.items()))
+
+    folder = write_files({
+        'sites.csv': SITES_CSV + 'A2,37.330001,-121.8800,DN\n',
+        'links.gv': 'graph g {\nA -- B\nC -- D\nA2 -- 12L198\n}\n'})
+    try:
+        ds = datastore.Datastore()
+        ds.import_all_files(folder, ['links.gv', 'sites.csv'])
+        assert_adjacency_rebuilt(ds)
+        ds.add({'data_type': 'link', 'source_id': 'C', 'destination_id': 'B',
+                'status': 'planned'})
+        ds.add({'data_type': 'link', 'source_id': 'A', 'destination_id': 'B',
+                'status': 'installed'})
+        assert_adjacency_rebuilt(ds)
+        del ds['C_D']
+        link = ds.pop('B_C')
+        assert_adjacency_rebuilt(ds)
+        ds.update({link.id: link})
+        assert_adjacency_rebuilt(ds)
+        nose.tools.assert_equal(ds.connected_links('B'), ['A_B', 'B_C'])
+
+        nose.tools.assert_equal(ds.merge_close_sites(), [('A', 'A2')])
+        assert_adjacency_rebuilt(ds)
+        nose.tools.assert_equal(ds.connected_links('A'), ['12L198_A', 'A_B'])
+        nose.tools.assert_equal(sorted(site.id for site in ds.all_connected),
+                                ['12L198', 'A', 'B', 'C'])
+
+        ds.retract_source(os.path.join(folder, 'links.gv'))
+        assert_adjacency_rebuilt(ds)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_graph_components_and_hops():
+    """Components, hops and islands of a graph with a self-loop."""
+    design = graph.Graph.build(['A', 'B', 'C', 'D', 'E', 'F', 'G'],
+                               [0, 1, 3, 5, -1], [1, 2, 4, 5, 0])
+    nose.tools.assert_equal(design.degrees().tolist(), [1, 2, 1, 1, 1, 1, 0])
+    nose.tools.assert_equal(design.edge_count, 4)
+    nose.tools.assert_equal(design.components().tolist(),
+                            [0, 0, 0, 1, 1, 2, 3])
+    nose.tools.assert_equal(design.hops([0]).tolist(),
+                            [0, 1, 2, -1, -1, -1, -1])
+    nose.tools.assert_equal(design.hops([2, 5]).tolist(),
+                            [2, 1, 0, -1, -1, 0, -1])
+    pops = [True, False, False, False, False, False, False]
+    nose.tools.assert_equal(design.islands(pops), [('D', 'E'), ('F',)])
+    properties = graph.site_properties(design, pops)
+    nose.tools.assert_equal(properties['B'], {
+        'component_id': 0, 'island': False, 'hops_to_pop': 1})
+    nose.tools.assert_equal(properties['F'], {'component_id': 2,
+                                              'island': True})
+    nose.tools.assert_not_in('G', properties)
+
+
+def test_graph_properties_are_recomputed():
+    """Graph properties of an earlier run never outlive their cause."""
+    files = {'sites.csv': SITES_CSV.replace('bill_of_materials',
+                                            'site_type').replace(
+                                                'A,37.3300,-121.8800,CN',
+                                                'A,37.3300,-121.8800,POP'),
+             'links.gv': 'graph g {\nA -- B\nC -- D\nD -- 12L198\n}\n'}
+    for store in (datastore.Datastore(),
+                  sqlite_datastore.SQLiteDatastore(':memory:')):
+        import_files(files, store).update_all_properties()
+        nose.tools.assert_equal(store.get('B').get('hops_to_pop'), 1)
+        nose.tools.assert_equal(store.get('C').get('island'), True)
+
+        store.add({'data_type': 'site', 'site_id': 'A', 'site_type': 'CN',
+                   'data_weight': '1'})
+        store.update_all_properties()
+        for site_id in ('A', 'B', 'C', 'D', '12L198'):
+            nose.tools.assert_equal(store.get(site_id).get('hops_to_pop'),
+                                    None)
+        nose.tools.assert_equal(store.get('B').get('island'), True)
+        nose.tools.assert_equal(store.get('C').get('island'), False)
+        nose.tools.assert_equal(store.get('A').get('component_id'), 1)
+        nose.tools.assert_equal(store.get('C').get('component_id'), 0)
+
+
+def test_merge_close_sites_moves_links():
+    """Links of merged sites connect the survivor in their id and columns."""
+    ds = import_files({
+        'sites.csv': 'site_id,latitude,longitude,data_weight\n'
+                     'A,37.3300,-121.8800,5\nA2,37.330001,-121.8800,0\n'
+                     'C,37.3320,-121.8800,0\nD,37.3340,-121.8800,0\n',
+        'links.gv': 'graph g {\nC -- A2 [status=planned]\nA -- D\n'
+                    'A2 -- D [status=installed]\n}\n'})
+    nose.tools.assert_equal(ds.merge_close_sites(), [('A', 'A2')])
+    nose.tools.assert_equal(sorted(link.id for link in ds.links),
+                            ['A_C', 'A_D'])
+    for link_id, status in (('A_C', 'planned'), ('A_D', 'installed')):
+        link = ds[link_id]
+        nose.tools.assert_equal(
+            (link.get('source_id'), link.get('destination_id')),
+            tuple(link_id.split('_')))
+        nose.tools.assert_equal(link.get('status'), status)
+    nose.tools.assert_equal(ds.connected_links('A'), ['A_C', 'A_D'])
+    nose.tools.assert_not_in('A2', ds.adjacencies)
+
+
+def test_candidate_links_distance_bands():
+    """Candidate links join unlinked pairs whose distance is in the band."""
+    ds = import_files({'sites.csv': SITES_CSV,
+                       'links.gv': 'graph g {\nA -- B\n}\n'})
+    # Neighbouring sites of SITES_CSV are 111m apart.
+    links = ds.candidate_links(min_distance=100.0, max_distance=150.0)
+    nose.tools.assert_equal([link.id for link in links],
+                            ['12L197_12L198', '12L198_D', 'B_C', 'C_D'])
+    for link in links:
+        nose.tools.assert_equal(link.get('status'), 'candidate')
+        nose.tools.assert_true(100.0 <= link.get('length') <= 150.0)
+
+    links = ds.candidate_links(min_distance=200.0, max_distance=250.0,
+                               bill_of_materials='DN')
+    nose.tools.assert_equal([link.id for link in links], ['12L198_C'])
+    nose.tools.assert_equal(ds.candidate_links(max_distance=100.0), [])
+
+
+def test_write_gv_round_trip():
+    """Links written with write_gv load back with the same properties."""
+    from data_transformer import reports
+    sites_csv = ('site_id,latitude,longitude\n'
+                 'NODE,37.3300,-121.8800\n'
+                 '"SITE A",37.3310,-121.8800\n'
+                 'X-1,37.3320,-121.8800\n'
+                 '12L198,37.3330,-121.8800\n')
+    ds = import_files({'sites.csv': sites_csv})
+    links = ds.candidate_links(min_distance=0.0, max_distance=150.0)
+    for link in links:
+        link.update_raw_data({'link-type': 'a "b"', 'graph': 'edge'})
+    text = StringIO.StringIO()
+    reports.write_gv(text, [], [link.as_geojson() for link in links],
+                     graph_name='candidate links')
+
+    loaded = import_files({'sites.csv': sites_csv,
+                           'links.gv': text.getvalue()})
+    nose.tools.assert_equal(sorted(link.id for link in loaded.links),
+                            [link.id for link in links])
+    for link in links:
+        nose.tools.assert_equal(
+            dict((k, str(v)) for k, v in link.items() if k != 'data_type'),
+            dict(item for item in loaded.get(link.id).items()
+                 if item[0] not in ('data_type', 'data_source')))
+
+
+def test_streamed_geojson_matches_dumps():
+    """write_geojson writes the text of dumping the whole collection."""
+    from data_transformer import reports
+
+    def dumped(sites, links):
+        features = sorted(sites + links, key=lambda feature: feature['id'])
+        return geojson.dumps(geojson.FeatureCollection(features),
+                             sort_keys=True, indent=4, separators=(',', ': '))
+
+    ds = import_files({'sites.csv': SITES_CSV,
+                       'more.csv': 'site_id,latitude,longitude,note\n'
+                                   'E,37.3,-121.8,"caf\xc3\xa9 ""x"""\n',
+                       'links.gv': 'graph g {\nB -- A [h=1.5]\nC -- D\n}\n'})
+    ds.update_all_properties()
+    sites = [site.as_geojson() for site in ds.sites]
+    links = [link.as_geojson() for link in ds.links]
+    for site_features, link_features in ((sites, links), (sites, []),
+                                         ([], [])):
+        text = StringIO.StringIO()
+        reports.write_geojson(text, site_features, link_features)
+        nose.tools.assert_equal(text.getvalue(),
+                                dumped(site_features, link_features))
+        text = StringIO.StringIO()
+        reports.write_geojson(
+            text, sorted(site_features, key=lambda feature: feature.id),
+            sorted(link_features, key=lambda feature: feature.id),
+            ordered=True)
+        nose.tools.assert_equal(text.getvalue(),
+                                dumped(site_features, link_features))
+
+
+def test_geojson_round_trip():
+    """A geojson layout loads back with the same sites and links."""
+    from data_transformer import reports
+    ds = import_files({'sites.csv': SITES_CSV,
+                       'links.gv': 'graph g {\nA -- B\nC -- D\n}\n'})
+    text = StringIO.StringIO()
+    reports.write_geojson(text, [site.as_geojson() for site in ds.sites],
+                          [link.as_geojson() for link in ds.links])
+    loaded = import_files({'design.geojson': text.getvalue()})
+    nose.tools.assert_equal(sorted(loaded), sorted(ds))
+    for site in ds.sites:
+        nose.tools.assert_equal(loaded[site.id].coordinates, site.coordinates)
+        nose.tools.assert_equal(loaded[site.id].get('bill_of_materials'),
+                                site.get('bill_of_materials'))
+
+    invalid = ('{"type": "FeatureCollection", "features": [{"type": '
+               '"Feature", "geometry": {"type": "Point", "coordinates": '
+               '[1.0]}, "properties": {}}]}')
+    with nose.tools.assert_raises(ValueError):
+        import_files({'invalid.json': invalid})
+
+
+def test_export_registered_format():
+    """A registered writer is exported without changes to reports."""
+    from data_transformer import backends, reports
+    ds = import_files({'sites.csv': SITES_CSV,
+                       'links.gv': 'graph g {\nB -- A\nC -- D\n}\n'})
+    backends.register_writer('.dot', 'reports:write_gv',
+                             file_name='design_layout.dot')
+    folder = tempfile.mkdtemp()
+    try:
+        written = reports.export_all_files(
+            folder, ds.sites, ds.links, frame=ds.to_frame(),
+            formats=['dot', 'csv'])
+        nose.tools.assert_equal(
+            [os.path.basename(path) for path in written],
+            ['summary.txt', 'data_issues.txt', 'design_layout.dot',
+             'aggregated_site_data.csv'])
+        loaded = import_files({'sites.csv': SITES_CSV,
+                               'links.gv': open(written[2]).read()})
+        nose.tools.assert_equal(sorted(link.id for link in loaded.links),
+                                ['A_B', 'C_D'])
+        with open(written[3]) as f:
+            nose.tools.assert_equal(len(f.readlines()), 7)
+        with nose.tools.assert_raises(ValueError):
+            reports.export_all_files(folder, ds.sites, ds.links,
+                                     formats=['txt'])
+    finally:
+        backends._WRITERS.pop('.dot')
+        backends._EXPORT_FILES.pop('.dot')
+        shutil.rmtree(folder)
+
+
+def test_kml_validation_modes():
+    """Only validated placemarks fail, and invalid KML is never exported."""
+    from data_transformer import kml_writer, reports
+    ds = import_files({'sites.csv': SITES_CSV,
+                       'links.gv': 'graph g {\nA -- B\nC -- D\n}\n'})
+    sites = [site.as_geojson() for site in ds.sites]
+    site_placemark, schema = kml_writer._kml_site_placemark, kml_writer.Schema
+    schema_files = []
+
+    def invalid_placemark(site):
+        placemark = site_placemark(site)
+        if site.id == 'D':
+            placemark.append(kml_writer.KML.unknown('x'))
+        return placemark
+
+    def counted_schema(file_name):
+        schema_files.append(file_name)
+        return schema(file_name)
+
+    kml_writer._kml_site_placemark = invalid_placemark
+    kml_writer.Schema, kml_writer._kml_schema = counted_schema, None
+    folder = tempfile.mkdtemp()
+    try:
+        for validation, valid in (('off', True), ('sample', True),
+                                  ('full', False)):
+            nose.tools.assert_equal(kml_writer.write_kml(
+                StringIO.StringIO(), sites, [], validation=validation,
+                chunk_size=2), valid)
+        nose.tools.assert_equal(schema_files, ['kml22gx.xsd'])
+        with nose.tools.assert_raises(reports.ExportError) as context:
+            reports.export_all_files(folder, ds.sites, ds.links,
+                                     kml_validation='sample',
+                                     formats=['kml', 'csv'])
+        nose.tools.assert_equal(context.exception.file_names,
+                                ['design_layout.kml'])
+        export_folder = os.path.dirname(context.exception.written[0])
+        nose.tools.assert_equal(
+            sorted(os.listdir(export_folder)),
+            ['aggregated_site_data.csv', 'data_issues.txt', 'summary.txt'])
+    finally:
+        kml_writer._kml_site_placemark = site_placemark
+        kml_writer.Schema = schema
+        shutil.rmtree(folder)
+
+
+def test_length_buckets():
+    """Links on a threshold or without a length are in no bucket."""
+    ds = import_files({'sites.csv': SITES_CSV,
+                       'links.gv': 'graph g {\nA -- B\nA -- C\nA -- D\n'
+                                   'B -- C\n}\n'})
+    ds.update_all_properties()
+    frame = ds.to_frame()
+    nose.tools.assert_equal(sorted(frame.lengths.tolist()),
+                            [111.2, 111.2, 222.4, 333.6])
+    nose.tools.assert_equal(frame.length_buckets((100, 175)), [0, 2, 2])
+    nose.tools.assert_equal(frame.length_buckets((111.2, 300)), [0, 1, 1])
+    nose.tools.assert_equal(frame.length_buckets((400,)), [4, 0])
+    frame.lengths = np.append(frame.lengths, np.nan)
+    with np.errstate(invalid='raise'):
+        nose.tools.assert_equal(frame.length_buckets((400,)), [4, 0])
+
+
+# summary.txt of the feature based reports before the Frame. The sites are on
+# the prime meridian, where the (lng, lat) lengths of that version are right.
+OLD_BASIC_REPORT = '''
+==Data Summary==
+  7 unique sites imported.
+  7 unique links imported.
+
+==Design Analysis==
+  Average of 2.00 links per site.
+  Breakdown of link connectivity per site:
+    1 link sites: 1
+    2 link sites: 5
+    3 link sites: 1
+
+  "12L198_A" is the longest link at 1111.9m.
+  "12L197_E" is the shortest link at 0.0m.
+
+  2 links are shorter than 100m.
+  1 links are 100m to 175m.
+  3 links are longer than 175m.
+
+==Material Requirements==
+This section includes information based on what was defined in the ''' \
+    '''"bill_of_materials" field of the input data set.
+1 of 7 sites ARE MISSING this data. This will affect results.
+
+4 primary devices required.
+1 secondary devices required.
+2 client node devices required.
+1 odroid devices required.
+
+'''
+
+
+def test_frame_reports_match_old_reports():
+    """The Frame reports show what the feature based reports showed.
+
+    Only the connectivity lines are new, and issues are listed by id.
+    """
+    from data_transformer import reports
+    from data_transformer.frame import Frame
+    ds = import_files({
+        'sites.csv': 'site_id,latitude,longitude,bill_of_materials,status\n'
+                     'A,0.0,0.0,CN,planned\n'
+                     'B,0.0005,0.0,DN,planned\n'
+                     'C,0.0015,0.0,DN DN,\n'
+                     'D,0.0035,0.0,CN odroid,\n'
+                     '12L198,0.01,0.0,DN,\n'
+                     '12L197,0.0104,0.0,DN,\n'
+                     'E,0.010400005,0.0,,\n'
+                     'F,0.02,0.0,CN,\n',
+        'links.gv': 'graph g {\nA -- B\nB -- C\nC -- D\nA -- D\n'
+                    '12L198 -- 12L197\nE -- 12L197\nA -- 12L198\n}\n'})
+    ds.update_all_properties()
+    head, tail = OLD_BASIC_REPORT.split('\n==Material')
+    missing = ['A', 'B', 'C', 'D', 'E', '12L197', '12L198', 'A_B', 'A_D',
+               'B_C', 'C_D', '12L197_E', '12L198_A', '12L197_12L198']
+    sites = [site.as_geojson() for site in ds.sites]
+    links = [link.as_geojson() for link in ds.links]
+    for frame in (ds.to_frame().connected(),
+                  Frame.from_features(sites, links).connected(), None):
+        basic = reports.export_basic_report(sites, links, frame=frame)
+        nose.tools.assert_true(basic.startswith(head), basic)
+        nose.tools.assert_true(basic.endswith('\n==Material' + tail), basic)
+        nose.tools.assert_in('1 groups of connected sites', basic)
+
+        issues = reports.export_data_issues_report(sites, links, frame=frame)
+        nose.tools.assert_in('within 1m of each other:    12L197, E\n', issues)
+        nose.tools.assert_equal(
+            sorted(line for line in issues.splitlines()
+                   if line.endswith(' is missing => ')),
+            sorted('  {} is missing => '.format(object_id)
+                   for object_id in missing))
+
+
+def test_distances_match_distance():
+    """The vectorized distances equal distance for every pair."""
+    rng = np.random.RandomState(0)
+    sources = np.column_stack([rng.uniform(-80, 80, 500),
+                               rng.uniform(-180, 180, 500)])
+    destinations = sources + rng.normal(0, 0.01, sources.shape)
+    destinations[:100] = rng.uniform(-80, 80, (100, 2))
+    expected = [utilities.distance(source, destination)
+                for source, destination in zip(sources, destinations)]
+    nose.tools.assert_equal(
+        utilities.distances(sources, destinations).tolist(), expected)
+    nose.tools.assert_equal(utilities.distances([], []).tolist(), [])
+
+
+def test_proximity_matches_brute_force():
+    """The proximity grid finds the same edges as checking every pair."""
+    rng = np.random.RandomState(1)
+    # Sites 0 to 20m apart, with link ends up to 4m from their sites.
+    latitudes = 37.33 + rng.uniform(0, 0.0002, 150)
+    longitudes = -121.88 + rng.uniform(0, 0.0002, 150)
+    nodes = [geojson.Feature(id='S{}'.format(index),
+                             geometry=geojson.Point((lng, lat)))
+             for index, (lat, lng) in enumerate(zip(latitudes, longitudes))]
+    pairs = rng.randint(0, 150, (100, 2))
+    jitter = rng.uniform(-0.00004, 0.00004, (100, 2, 2))
+    edges = [geojson.Feature(
+        id='L{}'.format(index),
+        geometry=geojson.LineString(
+            [(longitudes[end] + jitter[index, side, 0],
+              latitudes[end] + jitter[index, side, 1])
+             for side, end in enumerate(pair)]))
+        for index, pair in enumerate(pairs)]
+
+    for threshold in (0.5, 2, 10):
+        expected = {}
+        for node in nodes:
+            lng, lat = node.geometry.coordinates
+            for edge in edges:
+                if any(utilities.distance((lat, lng), (end[1], end[0])) <
+                       threshold for end in edge.geometry.coordinates):
+                    expected.setdefault(node.id, []).append(edge.id)
+        nose.tools.assert_true(expected)
+        nose.tools.assert_equal(
+            dict(utilities.get_adjacencies_by_proximity(
+                edges, nodes, threshold=threshold)), expected)
+
+
+def test_parallel_import_matches_serial_import():
+    """Workers merge files in the serial order, so weight ties agree."""
+    folder = write_files({
+        'sites.csv': SITES_CSV,
+        'a.csv': 'site_id,status,bill_of_materials,data_weight\n'
+                 'A,planned,DN,3\nB,installed,,1\nC,x,CN,\n',
+        'b.csv': 'site_id,status,bill_of_materials,data_weight\n'
+                 'A,removed,CN,3\nB,planned,DN,1\nC,y,,0\n',
+        'c.csv': 'site_id,status,data_weight\nA,proposed,2\nD,z,0\n',
+        'links.gv': 'graph g {\nA -- B [status=planned]\nC -- D\n}\n',
+        'more.gv': 'graph g {\nA -- B [status=installed]\n}\n'})
+    try:
+        states = []
+        for jobs in (1, 2):
+            ds = datastore.Datastore()
+            ds.import_all_files(folder, sorted(os.listdir(folder)),
+                                jobs=jobs)
+            states.append(store_state(ds))
+    finally:
+        shutil.rmtree(folder)
+    nose.tools.assert_equal(states[1], states[0])
+    records = dict((key, dict(items)) for key, items, _ in states[0][0])
+    nose.tools.assert_equal(records['A']['status'], 'removed')
+    nose.tools.assert_equal(records['B']['bill_of_materials'], 'DN')
+    nose.tools.assert_equal(records['A_B']['status'], 'installed')
+
+
+def test_snapshot_round_trip():
+    """A loaded snapshot holds the same data, weights and imports."""
+    ds = import_files({'sites.csv': SITES_CSV,
+                       'over.csv': 'site_id,status,data_weight\n'
+                                   'A,planned,5\nB,installed,0\n',
+                       'links.gv': 'graph g {\nA -- B [note="x y"]\n'
+                                   'C -- D\n}\n'})
+    ds.update_all_properties()
+    path = tempfile.mktemp()
+    try:
+        ds.save_snapshot(path)
+        loaded = datastore.Datastore()
+        loaded.load_snapshot(path)
+    finally:
+        os.remove(path)
+    nose.tools.assert_equal(store_state(loaded), store_state(ds))
+    nose.tools.assert_equal(loaded.imports, ds.imports)
+    nose.tools.assert_equal(
+        [site.id for site in loaded.lookup('status', 'planned')], ['A'])
+
+
+def test_import_other_folder_keeps_snapshot():
+    """Importing another folder keeps the files of a loaded snapshot."""
+    folder = write_files({'sites.csv': SITES_CSV,
+                          'links.gv': 'graph g {\nA -- B\n}\n'})
+    path = tempfile.mktemp()
+    try:
+        ds = datastore.Datastore()
+        ds.import_all_files(folder, ['links.gv', 'sites.csv'])
+        ds.save_snapshot(path)
+    finally:
+        shutil.rmtree(folder)
+    try:
+        loaded = datastore.Datastore()
+        loaded.load_snapshot(path)
+    finally:
+        os.remove(path)
+    import_files({'more.csv': 'site_id,latitude,longitude\n'
+                              'E,37.34,-121.88\n'}, loaded)
+    nose.tools.assert_equal(len(loaded.sites), 7)
+    nose.tools.assert_equal(len(loaded.links), 1)
+    nose.tools.assert_equal(len(loaded.imports), 3)
+
+
+def test_incremental_import_matches_fresh_import():
+    """Re-importing changed and deleted files equals a fresh import."""
+    folder = write_files({'sites.csv': SITES_CSV,
+                          'more.csv': 'site_id,latitude,longitude\n'
+                                      'E,37.34,-121.88\n',
+                          'over.csv': 'site_id,status,data_weight\n'
+                                      'A,planned,5\nB,installed,1\n',
+                          'links.gv': 'graph g {\nA -- B\nC -- E\n}\n'})
+
+    def fresh_import():
+        store = datastore.Datastore()
+        store.import_all_files(folder, sorted(os.listdir(folder)))
+        return store
+
+    try:
+        ds = fresh_import()
+        snapshot_path = os.path.join(folder, 'design.snapshot')
+        ds.save_snapshot(snapshot_path)
+        from_snapshot = datastore.Datastore()
+        from_snapshot.load_snapshot(snapshot_path)
+        os.remove(snapshot_path)
+
+        with open(os.path.join(folder, 'over.csv'), 'w') as f:
+            f.write('site_id,status,data_weight\nB,removed,2\nC,x,0\n')
+        os.remove(os.path.join(folder, 'more.csv'))
+        for store in (ds, from_snapshot):
+            results = store.import_all_files(folder,
+                                             sorted(os.listdir(folder)))
+            nose.tools.assert_equal(
+                results[os.path.join(folder, 'sites.csv')],
+                {'unchanged': True})
+            nose.tools.assert_equal(store_state(store),
+                                    store_state(fresh_import()))
+        nose.tools.assert_equal(ds['A'].get('status'), 'Unknown')
+        nose.tools.assert_not_in('E', ds)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_sqlite_matches_memory():
+    """A SQLiteDatastore holds and exports what a Datastore does."""
+    from data_transformer import reports
+    folder = write_files({
+        'sites.csv': SITES_CSV,
+        'over.csv': 'site_id,status,site_type,data_weight\n'
+                    'A,planned,pop,5\nB,installed,,0\nE,x,,1\n',
+        'more.csv': 'site_id,latitude,longitude,bill_of_materials\n'
+                    'E,37.3351,-121.8801,CN odroid\nF,37.40,-121.88,CN\n',
+        'links.gv': 'graph g {\nA -- B [status=planned]\nB -- C -- D\n'
+                    '12L198 -- 12L197\nE -- 12L197\n}\n'})
+    db_folder = tempfile.mkdtemp()
+    stores = [datastore.Datastore(), sqlite_datastore.SQLiteDatastore(
+        os.path.join(db_folder, 'design.db'), batch_size=2)]
+    try:
+        outputs = []
+        for store in stores:
+            store.import_all_files(folder, sorted(os.listdir(folder)))
+            store.update_all_properties()
+            output = os.path.join(db_folder, str(len(outputs)))
+            written = reports.export_all_files(
+                output, store.sites, store.links, frame=store.to_frame(),
+                formats=('geojson', 'csv'),
+                ordered=store is stores[1])
+            texts = {}
+            for path in written:
+                with open(path) as f:
+                    texts[os.path.basename(path)] = f.read()
+            texts['design_layout.geojson'] = sorted(
+                (feature['id'], feature) for feature in
+                json.loads(texts['design_layout.geojson'])['features'])
+            texts['aggregated_site_data.csv'] = sorted(
+                texts['aggregated_site_data.csv'].splitlines())
+            records = dict(
+                (record.id, (dict(record.as_geojson().properties),
+                             record.as_geojson().geometry.coordinates))
+                for record in list(store.sites) + list(store.links))
+            outputs.append((
+                records, texts, sorted(store.imports),
+                [record.id for record in store.lookup('status', 'planned')],
+                sorted(store.connected_links('12L197')),
+                len(store.all_connected)))
+    finally:
+        stores[1].close()
+        shutil.rmtree(folder)
+        shutil.rmtree(db_folder)
+    nose.tools.assert_equal(outputs[1], outputs[0])
+    records = outputs[0][0]
+    nose.tools.assert_equal(records['A'][0]['status'], 'planned')
+    nose.tools.assert_equal(records['E'][0]['bill_of_materials'], 'CN odroid')
+    nose.tools.assert_in('hops', outputs[0][1]['summary.txt'])